@@ -1,9 +1,6 @@
 #/usr/bin/env python
 # -*- coding: utf-8 -*-
-import locale
 import os
-import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
 from config import Config
 from flask import Flask
 from flask_babel import Babel
@@ -12,6 +9,8 @@ from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
+from app.log import init_logging
+from app.profiling import init_profiling
 
 
 # Set pool_pre_ping in SQLAlchemy to True to prevent closed psycopg2
@@ -40,54 +39,17 @@ login_manager.init_app(app)
 login_manager.login_message = u"Log in om verder te gaan"
 login_manager.login_view = "login"
 
-locale.setlocale(locale.LC_ALL, 'nl_NL.UTF-8')
+# Opt-in profiling of requests, before the routes register their request
+# handlers so these are profiled too, see app/profiling.py
+init_profiling(app)
 
 from app import routes, models, errors
 
-if not app.debug:
-    # Send email on errors
-    if app.config['MAIL_SERVER']:
-        auth = None
-        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-        secure = None
-        if app.config['MAIL_USE_TLS']:
-            secure = ()
-        mail_handler = SMTPHandler(
-            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-            fromaddr=app.config['FROM'],
-            toaddrs=app.config['ADMINS'],
-            subject=f'[Open Poen {app.config["VERSION"]}] website error',
-            credentials=auth,
-            secure=secure
-        )
-        mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
-
-# Log info messages and up to file
+# Log info messages and up to file and mail errors, through a queue so
+# logging doesn't block, see app/log.py
 if not os.path.exists('log'):
     os.mkdir('log')
 # Disable this when running tests locally, or fix file permission for the
 # files.
-file_handler = RotatingFileHandler(
-    'log/open_poen.log',
-    maxBytes=1000000,
-    backupCount=10
-)
-file_handler.setFormatter(
-    logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s '
-        '[in %(pathname)s:%(lineno)d]'
-    )
-)
-
-if app.debug:
-    file_handler.setLevel(logging.DEBUG)
-else:
-    file_handler.setLevel(logging.INFO)
-app.logger.addHandler(file_handler)
-if app.debug:
-    app.logger.setLevel(logging.DEBUG)
-else:
-    app.logger.setLevel(logging.INFO)
+init_logging(app, 'log/open_poen.log')
 app.logger.info('Open Poen startup')
@@ -7,8 +7,6 @@ import 'bootstrap-table';
 import 'bootstrap-table/dist/locale/bootstrap-table-nl-NL.min.js';
 import 'bootstrap-table/dist/extensions/sticky-header/bootstrap-table-sticky-header.min.js';
 import 'bootstrap-table/dist/extensions/mobile/bootstrap-table-mobile.min.js';
-import 'tableexport.jquery.plugin/tableExport.min.js';
-import 'bootstrap-table/dist/extensions/export/bootstrap-table-export.min.js';
 import 'bootstrap-table/dist/extensions/cookie/bootstrap-table-cookie.min.js';
 import naturalSort from 'javascript-natural-sort';
 import datepicker from 'js-datepicker';
@@ -202,40 +200,7 @@ if ($(".datepicker").length > 0) {
   var picker = datepicker(".datepicker", datepickerConfig);
 }
 
-// Setting datepickers for the detail views of the bootstrap tables.
-// The ordinary way is impossible, because of the way the page loads.
-// We therefore have to dynamically assign and remove these date pickers
-// on expanding and collapsing detail views respectively. Nevertheless,
-// there is surely a better way of doing this.
-window.datepicker = datepicker;
-window.tableDatePickers = {};
-
-$('.payment-table').bootstrapTable({
-  onExpandRow: function (index, row, detailView) {
-    var dateInput = $(detailView).find(".table-datepicker");
-    if (dateInput.length > 0) {
-      var className = "active-table-datepicker" + index;
-      dateInput.addClass(className)
-      window.tableDatePickers[className] = window.datepicker("." + className, datepickerConfig);
-    }
-  },
-  onCollapseRow: function (index, row, detailView) {
-    var className = "active-table-datepicker" + index;
-    if (className in window.tableDatePickers) {
-      window.tableDatePickers[className].remove();
-      delete window.tableDatePickers[className];
-    }
-  },
-  // Sorting changes the indices of the table rows and collapses all
-  // of them. To ensure window.tableDatePickers stays in sync, we
-  // delete all datepickers previously instantiated.
-  onSort: function (name, order) {
-    for (var key in window.tableDatePickers) {
-      window.tableDatePickers[key].remove();
-      delete window.tableDatePickers[key];
-    }
-  }
-});
+$('.payment-table').bootstrapTable();
 
 $(window).on('load', function() {
   if (window.paymentId !== undefined) {
@@ -248,4 +213,302 @@ $(window).on('load', function() {
       }, 400);
     }
   }
-});
\ No newline at end of file
+});
+// Ids of the payments selected to edit at once
+window.selectedPayments = new Set();
+
+// Don't open the detail view when clicking a selection checkbox
+$(document).on('click', '.payment-select', function(e) {
+  e.stopPropagation();
+});
+
+$(document).on('change', '.payment-select', function() {
+  var id = parseInt($(this).val());
+  if (this.checked) {
+    window.selectedPayments.add(id);
+  } else {
+    window.selectedPayments.delete(id);
+  }
+  $('.payment-batch-count').text(window.selectedPayments.size);
+});
+
+// Bootstrap Table renders the rows again after paginating or sorting, so
+// restore the checkboxes of the selected payments
+$(document).on('post-body.bs.table', '.payment-table', function() {
+  $('.payment-select').each(function() {
+    this.checked = window.selectedPayments.has(parseInt($(this).val()));
+  });
+});
+
+// Edit the selected payments with a single request
+$(document).on('submit', '#payment-batch-form', function(e) {
+  e.preventDefault();
+  var form = $(this);
+  var data = {payment_ids: Array.from(window.selectedPayments)};
+
+  var category = form.find('[name=category_id]').val();
+  if (category) {
+    data.category_id = category === 'none' ? null : parseInt(category);
+  }
+  var route = form.find('[name=route]').val();
+  if (route) {
+    data.route = route;
+  }
+  var hidden = form.find('[name=hidden]').val();
+  if (hidden) {
+    data.hidden = hidden === 'true';
+  }
+  var description = form.find('[name=short_user_description]').val();
+  if (description) {
+    data.short_user_description = description;
+  }
+
+  $.ajax({
+    url: form.data('url'),
+    method: 'POST',
+    contentType: 'application/json',
+    data: JSON.stringify(data),
+    headers: {'X-CSRFToken': form.data('csrf-token')}
+  }).done(function() {
+    window.location.reload();
+  }).fail(function(xhr) {
+    var error = 'Transacties bijwerken mislukt';
+    if (xhr.responseJSON && xhr.responseJSON.error) {
+      error = xhr.responseJSON.error;
+    }
+    form.find('.payment-batch-error').text(error);
+  });
+});
+
+// Fill in the single edit payment modal with the data of the payment of the
+// 'Bewerken' button that opened it (see Payment.get_edit_data)
+$(document).on('show.bs.modal', '#payment-edit-modal', function(e) {
+  var button = $(e.relatedTarget);
+  if (!button.data('payment')) {
+    return;
+  }
+  var payment = button.data('payment');
+  var modal = $(this);
+  var field = function(name) {
+    return modal.find('[name="payment_form_edit-' + name + '"]');
+  };
+
+  modal.find('.payment-form').data('url', button.data('url'));
+  modal.find('.payment-form-errors').remove();
+  field('id').val(payment.id);
+  field('created').val(payment.created);
+  field('amount_value').val(payment.amount_value);
+  field('route').val(payment.route);
+  field('short_user_description').val(payment.short_user_description);
+  field('long_user_description').val(payment.long_user_description);
+  field('hidden').prop('checked', payment.hidden);
+  modal.find('[name="transaction_attachment_form-payment_id"]').val(payment.id);
+
+  var categories = JSON.parse($('#payment-category-choices').text())[payment.categories] || [];
+  field('category_id').html(categories.map(function(category) {
+    return $('<option></option>').val(category[0]).text(category[1]);
+  }));
+  field('category_id').val(payment.category_id);
+
+  // Only the date and amount of manually added payments can be edited and
+  // only these payments can be removed
+  modal.find('.payment-edit-manual').toggle(payment.manual);
+  modal.find('.payment-edit-manual :input').prop('disabled', !payment.manual);
+});
+
+// Fill in the single edit attachment modal
+$(document).on('show.bs.modal', '#attachment-edit-modal', function(e) {
+  var button = $(e.relatedTarget);
+  $(this).find('[name="edit_attachment_form-id"]').val(button.data('attachment-id'));
+  $(this).find('[name="edit_attachment_form-mediatype"]').val([button.data('mediatype')]);
+});
+
+// Ask for confirmation before submitting e.g. a remove button
+$(document).on('click', '[data-confirm]', function(e) {
+  if (!window.confirm($(this).data('confirm'))) {
+    e.preventDefault();
+  }
+});
+
+if ($('#payment_form_edit-created').length > 0) {
+  datepicker('#payment_form_edit-created', datepickerConfig);
+}
+
+// Save an edited payment with a PATCH request and update its row and the
+// (sub)project amounts in place instead of reloading the page
+$(document).on('submit', '.payment-form', function(e) {
+  e.preventDefault();
+  var form = $(this);
+  var data = {};
+  form.serializeArray().forEach(function(field) {
+    // Strip the 'payment_form_edit-' prefix of the field names
+    var name = field.name.replace(/^payment_form_edit-/, '');
+    if (name !== 'id' && name !== 'csrf_token') {
+      data[name] = field.value;
+    }
+  });
+  // Unchecked checkboxes are not serialized
+  var hidden = form.find('[name$="-hidden"]');
+  if (hidden.length) {
+    data.hidden = hidden.is(':checked');
+  }
+
+  $.ajax({
+    url: form.data('url'),
+    method: 'PATCH',
+    contentType: 'application/json',
+    data: JSON.stringify(data),
+    headers: {'X-CSRFToken': form.find('[name$="csrf_token"]').val()}
+  }).done(function(response) {
+    form.closest('.modal').modal('hide');
+    var table = $('.payment-table');
+    var tr = $('#payment_row_' + form.find('[name$="-id"]').val());
+    var index = parseInt(tr.attr('data-index'));
+    var columns = table.bootstrapTable('getOptions').columns[0];
+    var row = {};
+    $('<table>').html(response.row).find('tr').first().children('td').each(function(i) {
+      if (columns[i]) {
+        row[columns[i].field] = $(this).html();
+      }
+    });
+    table.bootstrapTable('updateRow', {index: index, row: row});
+    table.bootstrapTable('expandRow', index);
+
+    $('[data-amount]').each(function() {
+      $(this).text(response.amounts[$(this).data('amount')]);
+    });
+    $('.donut').attr('data-percentage', response.amounts.percentage_spent_str);
+    $('.donut').each(function() {window.donut(this)});
+  }).fail(function(xhr) {
+    var errors = ['Transactie bijwerken mislukt'];
+    if (xhr.responseJSON && xhr.responseJSON.errors) {
+      errors = xhr.responseJSON.errors;
+    } else if (xhr.responseJSON && xhr.responseJSON.error) {
+      errors = [xhr.responseJSON.error];
+    }
+    form.find('.payment-form-errors').remove();
+    var list = $('<ul class="payment-form-errors text-danger"></ul>');
+    errors.forEach(function(error) {
+      list.append($('<li></li>').text(error));
+    });
+    form.prepend(list);
+  });
+});
+
+// Upload a transaction attachment directly to storage or in chunks (see
+// routes.attachment_upload), so an interrupted upload of a large file resumes
+// where it stopped instead of starting over
+var UPLOAD_CHUNK_SIZE = 1024 * 1024;
+var UPLOAD_RETRIES = 5;
+
+$(document).on('submit', '.attachment-upload-form', function(e) {
+  var form = $(this);
+  var file = form.find('input[type="file"]')[0].files[0];
+  // Let the browser submit the form if it can't slice files
+  if (!file || !file.slice || !window.FormData) {
+    return;
+  }
+  e.preventDefault();
+
+  var csrfToken = form.find('[name$="csrf_token"]').val();
+  var submit = form.find('[type="submit"]');
+  var retries = 0;
+
+  var showErrors = function(xhr) {
+    var errors = ['Uploaden mislukt'];
+    if (xhr.responseJSON && xhr.responseJSON.errors) {
+      errors = xhr.responseJSON.errors;
+    } else if (xhr.responseJSON && xhr.responseJSON.error) {
+      errors = [xhr.responseJSON.error];
+    }
+    form.find('.payment-form-errors').remove();
+    var list = $('<ul class="payment-form-errors text-danger"></ul>');
+    errors.forEach(function(error) {
+      list.append($('<li></li>').text(error));
+    });
+    form.prepend(list);
+    submit.prop('disabled', false).val('Uploaden');
+  };
+
+  var sendChunk = function(url, offset) {
+    submit.val('Uploaden ' + Math.floor(100 * offset / file.size) + '%');
+    $.ajax({
+      url: url,
+      method: 'PATCH',
+      contentType: 'application/octet-stream',
+      processData: false,
+      data: file.slice(offset, offset + UPLOAD_CHUNK_SIZE),
+      headers: {'X-CSRFToken': csrfToken, 'Upload-Offset': offset}
+    }).done(function(response) {
+      retries = 0;
+      if (response.file_id) {
+        window.location.reload();
+      } else {
+        sendChunk(url, response.offset);
+      }
+    }).fail(function(xhr) {
+      if (retries++ >= UPLOAD_RETRIES || (xhr.status > 0 && xhr.status < 500 && xhr.status !== 409)) {
+        showErrors(xhr);
+      } else if (xhr.status === 409) {
+        // The server received a different number of bytes, continue there
+        sendChunk(url, xhr.responseJSON.offset);
+      } else {
+        // Ask the server where to resume after the connection is back
+        setTimeout(function() {
+          $.getJSON(url).done(function(response) {
+            sendChunk(url, response.offset);
+          }).fail(showErrors);
+        }, 1000 * retries);
+      }
+    });
+  };
+
+  // Upload the file to the storage bucket with a presigned POST and let the
+  // app save it afterwards
+  var uploadDirectly = function(url, directUpload) {
+    var data = new FormData();
+    Object.keys(directUpload.fields).forEach(function(name) {
+      data.append(name, directUpload.fields[name]);
+    });
+    // The file has to be the last field
+    data.append('file', file);
+    submit.val('Uploaden...');
+    $.ajax({
+      url: directUpload.url,
+      method: 'POST',
+      data: data,
+      processData: false,
+      contentType: false
+    }).done(function() {
+      $.ajax({
+        url: url,
+        method: 'POST',
+        headers: {'X-CSRFToken': csrfToken}
+      }).done(function() {
+        window.location.reload();
+      }).fail(showErrors);
+    }).fail(showErrors);
+  };
+
+  submit.prop('disabled', true);
+  form.find('.payment-form-errors').remove();
+  var data = new FormData();
+  data.append('csrf_token', csrfToken);
+  data.append('filename', file.name);
+  data.append('size', file.size);
+  data.append('mediatype', form.find('[name$="-mediatype"]:checked').val());
+  data.append('payment_id', form.find('[name$="-payment_id"]').val());
+  $.ajax({
+    url: form.data('upload-url'),
+    method: 'POST',
+    data: data,
+    processData: false,
+    contentType: false
+  }).done(function(response) {
+    if (response.direct_upload) {
+      uploadDirectly(response.url, response.direct_upload);
+    } else {
+      sendChunk(response.url, response.offset);
+    }
+  }).fail(showErrors);
+});
@@ -0,0 +1,191 @@
+from collections import Counter, deque, namedtuple
+
+
+# Snapshot of a CategorizationRule, so a compiled matcher doesn't depend on
+# the database session it was created in
+_Rule = namedtuple(
+    '_Rule',
+    ['id', 'scope', 'amount_min', 'amount_max', 'category_id', 'route']
+)
+
+
+def normalize_iban(iban):
+    if not iban:
+        return ''
+    return iban.replace(' ', '').upper()
+
+
+def _to_float(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.replace(',', '.')
+    return float(value)
+
+
+# Aho-Corasick automaton: finds all keywords occurring in a text in a
+# single pass over the text, regardless of the number of keywords
+class KeywordTrie(object):
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]
+
+    def add(self, keyword, value):
+        node = 0
+        for char in keyword:
+            if char not in self._goto[node]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(set())
+                self._goto[node][char] = len(self._goto) - 1
+            node = self._goto[node][char]
+        self._output[node].add(value)
+
+    # Compute the failure links; call this after adding all keywords
+    def build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] |= self._output[self._fail[child]]
+
+    # Return the values of all keywords that occur in text
+    def search(self, text):
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            if self._output[node]:
+                found |= self._output[node]
+        return found
+
+
+# Compiles a list of CategorizationRules into one index. A payment is
+# matched against all rules at once: the counterparty IBAN is looked up in a
+# dict and the counterparty name and description are each scanned once by a
+# keyword trie. A rule matches if all of its conditions hold; if several
+# rules match, the oldest rule (lowest id) wins. The rules of a project also
+# apply to the payments of its subprojects; subproject_projects maps the
+# subproject ids to their project ids.
+class RuleMatcher(object):
+    def __init__(self, rules, subproject_projects=None):
+        self._subproject_projects = subproject_projects or {}
+        self._rules = []
+        self._required = []
+        self._ibans = {}
+        self._names = KeywordTrie()
+        self._descriptions = KeywordTrie()
+        # Rules without IBAN, name or description conditions per scope
+        self._unconditional = {}
+
+        for rule in sorted(rules, key=lambda x: x.id):
+            if rule.subproject_id:
+                scope = ('subproject', rule.subproject_id)
+            else:
+                scope = ('project', rule.project_id)
+
+            index = len(self._rules)
+            self._rules.append(
+                _Rule(
+                    rule.id,
+                    scope,
+                    _to_float(rule.amount_min),
+                    _to_float(rule.amount_max),
+                    rule.category_id,
+                    rule.route
+                )
+            )
+
+            required = 0
+            iban = normalize_iban(rule.counterparty_iban)
+            if iban:
+                self._ibans.setdefault(iban, []).append(index)
+                required += 1
+            if rule.counterparty_name:
+                self._names.add(rule.counterparty_name.lower(), index)
+                required += 1
+            if rule.description:
+                self._descriptions.add(rule.description.lower(), index)
+                required += 1
+            self._required.append(required)
+
+            if not required:
+                self._unconditional.setdefault(scope, []).append(index)
+
+        self._names.build()
+        self._descriptions.build()
+
+    def __len__(self):
+        return len(self._rules)
+
+    # Return the first rule matching the payment, or None. The payment can
+    # be a Payment or any object with the same attributes (e.g., a row of a
+    # query selecting only the needed columns).
+    def match(self, payment):
+        if not self._rules:
+            return None
+
+        scopes = set()
+        if payment.subproject_id:
+            scopes.add(('subproject', payment.subproject_id))
+            project_id = self._subproject_projects.get(payment.subproject_id)
+            if project_id:
+                scopes.add(('project', project_id))
+        if payment.project_id:
+            scopes.add(('project', payment.project_id))
+        if not scopes:
+            return None
+
+        hits = Counter()
+        iban = normalize_iban(payment.counterparty_alias_value)
+        for index in self._ibans.get(iban, []):
+            hits[index] += 1
+        if payment.counterparty_alias_name:
+            for index in self._names.search(
+                    payment.counterparty_alias_name.lower()):
+                hits[index] += 1
+        if payment.description:
+            for index in self._descriptions.search(
+                    payment.description.lower()):
+                hits[index] += 1
+
+        candidates = [
+            index for index, count in hits.items()
+            if count == self._required[index]
+        ]
+        for scope in scopes:
+            candidates += self._unconditional.get(scope, [])
+
+        amount = _to_float(payment.amount_value)
+        for index in sorted(candidates):
+            rule = self._rules[index]
+            if rule.scope not in scopes:
+                continue
+            if rule.amount_min is not None and (
+                    amount is None or amount < rule.amount_min):
+                continue
+            if rule.amount_max is not None and (
+                    amount is None or amount > rule.amount_max):
+                continue
+            return rule
+
+        return None
+
+    # Set the category and/or route of the payment if a rule matches;
+    # returns the matching rule
+    def categorize(self, payment):
+        rule = self.match(payment)
+        if rule:
+            if rule.category_id:
+                payment.category_id = rule.category_id
+            if rule.route:
+                payment.route = rule.route
+        return rule
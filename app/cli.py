@@ -1,11 +1,15 @@
 from app import app, db
 from app.email import send_invite
-from app.models import User, Payment, Project, Subproject
+from app.models import File, User, Payment, Project, Subproject
+from app.permissions import ANONYMOUS, load_permissions
+from datetime import datetime, timedelta
 from flask import url_for
 from os import urandom
 from os.path import abspath, join, dirname
 from pprint import pprint
+from time import perf_counter
 import click
+import csv
 import json
 import sys
 
@@ -15,7 +19,10 @@ from bunq.sdk.context.api_environment_type import ApiEnvironmentType
 from libs.bunq_lib import BunqLib
 from libs.share_lib import ShareLib
 
-from app import util
+from app import (
+    garbage_collection, images, outbox, payment_import, routes, statements,
+    storage, util
+)
 
 
 # Bunq commands
@@ -38,8 +45,42 @@ def get_new_payments_project(project_id):
 @bunq.command()
 def get_new_payments_all():
     """Get all payments from all IBANs belonging to all projects"""
+    # Compile the categorization rules once for all projects
+    matcher = util.get_rule_matcher()
     for project in Project.query.all():
-        util.get_new_payments(project.id)
+        util.get_new_payments(project.id, matcher)
+
+
+@bunq.command()
+@click.argument('project_id')
+@click.option(
+    '--no-refetch', is_flag=True,
+    help='Only report balance gaps, don\'t retrieve the missing payments'
+)
+def verify_balances_project(project_id, no_refetch=False):
+    """Check the ledgers of one Bunq account for missing payments using the
+    balance after each payment and retrieve the missing payments
+    """
+    gaps = util.verify_balances(project_id, refetch=not no_refetch)
+    print('Found %s balance gap(s) for project %s' % (len(gaps), project_id))
+
+
+@bunq.command()
+@click.option(
+    '--no-refetch', is_flag=True,
+    help='Only report balance gaps, don\'t retrieve the missing payments'
+)
+def verify_balances_all(no_refetch=False):
+    """Check the ledgers of all projects for missing payments and retrieve
+    the missing payments
+    """
+    for project in Project.query.all():
+        gaps = util.verify_balances(project.id, refetch=not no_refetch)
+        print(
+            'Found %s balance gap(s) for project "%s"' % (
+                len(gaps), project.name
+            )
+        )
 
 
 @bunq.command()
@@ -101,6 +142,53 @@ def create_sandbox_user():
         ShareLib.print_all_user_alias(all_alias)
 
 
+# Outbox commands
+@app.cli.group('outbox')
+def outbox_commands():
+    """Transactional email outbox related commands"""
+    pass
+
+
+@outbox_commands.command()
+@click.option('-w', '--watch', is_flag=True)
+@click.option('-b', '--batch_size', type=int, default=outbox.BATCH_SIZE)
+def deliver(watch=False, batch_size=outbox.BATCH_SIZE):
+    """
+    Deliver the queued emails over a single SMTP connection. With --watch
+    keep delivering new emails as they are queued (this is how the outbox
+    worker runs, see docker-compose.yml).
+    """
+    if watch:
+        outbox.deliver_forever(batch_size)
+    sent_count = failed_count = 0
+    while True:
+        sent, failed = outbox.deliver(batch_size)
+        sent_count += sent
+        failed_count += failed
+        if sent + failed < batch_size:
+            break
+    print('Sent %s emails, %s failed' % (sent_count, failed_count))
+
+
+@outbox_commands.command()
+def status():
+    """
+    Show the number of queued and failed emails and the delivery latency
+    """
+    outbox_status = outbox.get_status()
+    print('Queued: %s' % (outbox_status['queued']))
+    if outbox_status['oldest_queued'] is not None:
+        print('Oldest queued: %s ago' % (outbox_status['oldest_queued']))
+    print('Failed (given up): %s' % (outbox_status['failed']))
+    print('Sent in the last hour: %s' % (outbox_status['sent_last_hour']))
+    if outbox_status['sent_last_hour']:
+        print(
+            'Latency: %s on average, %s at most' % (
+                outbox_status['average_latency'], outbox_status['max_latency']
+            )
+        )
+
+
 # Database commands
 @app.cli.group()
 def database():
@@ -142,6 +230,278 @@ def add_user(email, admin=False,
     print("Added user")
 
 
+@database.command()
+@click.argument('invites', type=click.File('r'))
+@click.option('-a', '--admin', is_flag=True)
+@click.option('-pid', '--project_id', type=int)
+@click.option('-sid', '--subproject_id', type=int)
+def add_users(invites, admin=False, project_id=0, subproject_id=0):
+    """
+    Add many users at once from a CSV file with an email address and
+    optionally a project id and subproject id per row. Rows without ids use
+    the given project_id/subproject_id. New users are sent an invitation.
+    """
+    rows = []
+    for row in csv.reader(invites):
+        # Skip empty rows and a header row
+        if not row or '@' not in row[0]:
+            continue
+        row = row + ['', '']
+        rows.append((
+            row[0],
+            int(row[1]) if row[1].strip() else project_id,
+            int(row[2]) if row[2].strip() else subproject_id
+        ))
+    invited, membership_count, existing = util.add_users(rows, admin=admin)
+    print(
+        'Invited %s new users, added %s memberships, skipped %s existing '
+        'memberships' % (len(invited), membership_count, len(existing))
+    )
+
+
+@database.command()
+@click.option('-pid', '--project_id', type=int)
+@click.option('-sid', '--subproject_id', type=int)
+def apply_categorization_rules(project_id=0, subproject_id=0):
+    """
+    Apply the categorization rules of a project (including the rules of
+    its subprojects) or a subproject to all of its payments that don't have
+    a category yet.
+    """
+    if not project_id and not subproject_id:
+        print('Provide a project_id or subproject_id')
+        return
+    categorized_count = util.apply_categorization_rules(
+        project_id=project_id, subproject_id=subproject_id
+    )
+    print('Categorized %s payments' % (categorized_count))
+
+
+@database.command()
+def dedupe_uploads():
+    """
+    Move the files uploaded before uploads were stored by their content into
+    the blob store, so files with the same content are only stored once.
+    """
+    count = 0
+    for file in File.query.filter(File.blob_id.is_(None)).all():
+        if storage.migrate_file(file):
+            db.session.commit()
+            count += 1
+        else:
+            print('File %s (id %s) not found' % (file.filename, file.id))
+    print('Moved %s files into the blob store' % (count))
+
+
+@database.command()
+@click.option('-g', '--grace_hours', type=int, default=24)
+@click.option('-l', '--limit', type=int)
+@click.option('--dry_run', is_flag=True)
+def collect_garbage(grace_hours=24, limit=None, dry_run=False):
+    """
+    Delete the uploads that nothing refers to anymore (e.g., attachments of
+    deleted payments) and are older than the grace period. Storage is checked
+    from where the previous run stopped, at most limit files per run.
+    """
+    result = garbage_collection.collect_garbage(
+        grace_period=timedelta(hours=grace_hours),
+        limit=limit,
+        dry_run=dry_run
+    )
+    print(
+        '%s %s files, %s blobs and %s stored files, reclaiming %.1f MB' % (
+            'Would delete' if dry_run else 'Deleted',
+            result.files,
+            result.blobs,
+            result.objects,
+            result.reclaimed / 1024 / 1024
+        )
+    )
+    if not result.complete:
+        print('Not all stored files were checked, run again to continue')
+
+
+@database.command()
+@click.option('-fid', '--file_id', type=int)
+def regenerate_image_variants(file_id=0):
+    """
+    (Re)create the resized variants of all uploaded images (or of a single
+    file), e.g., after the variant widths have been changed.
+    """
+    files = File.query.filter(File.mimetype.in_(images.IMAGE_MIMETYPES))
+    if file_id:
+        files = files.filter_by(id=file_id)
+    count = images.regenerate_variants(files.all())
+    print('Created the variants of %s images' % (count))
+
+
+@database.command()
+@click.argument('statement', type=click.File('rb'))
+@click.option(
+    '-f', '--format', 'statement_format', type=click.Choice(statements.FORMATS)
+)
+@click.option('-pid', '--project_id', type=int)
+@click.option('-sid', '--subproject_id', type=int)
+def import_statement(statement, statement_format=None, project_id=0,
+                     subproject_id=0):
+    """
+    Import the payments of a bank statement of a non-Bunq account (CAMT.053,
+    MT940 or CSV). The format is detected if it is not given. Payments are
+    linked to the given project or subproject or otherwise to the
+    (sub)project with the IBAN of the statement account. Payments which
+    were already imported are skipped.
+    """
+    new_count, skipped_count = statements.import_statement(
+        statement,
+        statement_format=statement_format,
+        project_id=project_id,
+        subproject_id=subproject_id
+    )
+    print(
+        'Imported %s payments, skipped %s already imported payments' % (
+            new_count, skipped_count
+        )
+    )
+
+
+@database.command()
+@click.argument('payments', type=click.File('rb'))
+@click.option('-pid', '--project_id', type=int, required=True)
+@click.option('-sid', '--subproject_id', type=int)
+@click.option('-a', '--archive', type=click.File('rb'))
+def import_payments(payments, project_id, subproject_id=0, archive=None):
+    """
+    Import manual payments from a spreadsheet (CSV or XLSX) into a project
+    or subproject. Attachments can be provided in a zip archive. Nothing is
+    imported if any row contains an error.
+    """
+    project = Project.query.get(project_id)
+    subproject = None
+    if subproject_id:
+        subproject = Subproject.query.filter_by(
+            id=subproject_id, project_id=project_id
+        ).first()
+    if not project or (subproject_id and not subproject):
+        print('Unknown project or subproject')
+        return
+
+    try:
+        imported_count = payment_import.import_manual_payments(
+            payments,
+            payments.name,
+            project,
+            subproject=subproject,
+            archive_file=archive
+        )
+    except payment_import.PaymentImportError as e:
+        db.session.rollback()
+        print('Nothing imported:')
+        for error in e.errors:
+            print(error)
+        return
+    print('Imported %s payments' % (imported_count))
+
+
+@database.command()
+@click.option('-pid', '--project_id', type=int)
+@click.option('-sid', '--subproject_id', type=int)
+@click.option('-n', '--number', type=int, default=20)
+@click.option('-uid', '--user_id', type=int)
+@click.option('-p', '--payments', type=int)
+def benchmark_project(project_id=0, subproject_id=0, number=20, user_id=0,
+                      payments=0):
+    """
+    Measure how long it takes to render a project (or subproject) page for
+    an anonymous visitor, or for the given user. The page is requested the
+    given number of times and the minimum, median and maximum time to first
+    byte and total latency are shown, as well as the size of the page. Use
+    --payments instead of --project_id to benchmark a temporary project with
+    that many payments, which is removed afterwards.
+    """
+    if payments:
+        project = Project(
+            name='Benchmark %s' % (urandom(4).hex()),
+            contains_subprojects=False
+        )
+        db.session.add(project)
+        db.session.commit()
+        project_id = project.id
+        db.session.bulk_insert_mappings(Payment, [
+            {
+                'project_id': project_id, 'amount_value': -x - 1000.5,
+                'route': 'uitgaven', 'type': 'MANUAL',
+                'created': datetime(2021, 1, 1)
+            }
+            for x in range(payments)
+        ])
+        db.session.commit()
+        try:
+            _benchmark_project(project_id, 0, number, user_id)
+        finally:
+            Payment.query.filter_by(project_id=project_id).delete()
+            Project.query.filter_by(id=project_id).delete()
+            db.session.commit()
+    elif project_id:
+        _benchmark_project(project_id, subproject_id, number, user_id)
+    else:
+        print('Use either --project_id or --payments')
+
+
+def _benchmark_project(project_id, subproject_id, number, user_id):
+    url = '/project/%s' % (project_id)
+    if subproject_id:
+        url += '/subproject/%s' % (subproject_id)
+
+    first_byte_timings = []
+    timings = []
+    page_size = 0
+    with app.test_client() as client:
+        if user_id:
+            with client.session_transaction() as session:
+                session['user_id'] = str(user_id)
+                session['_fresh'] = True
+        for _ in range(number):
+            start = perf_counter()
+            response = client.get(url, buffered=False)
+            if response.status_code != 200:
+                print('Requesting %s failed: %s' % (url, response.status))
+                return
+            chunks = iter(response.response)
+            page_size = len(next(chunks, b''))
+            first_byte_timings.append(perf_counter() - start)
+            for chunk in chunks:
+                page_size += len(chunk)
+            response.close()
+            timings.append(perf_counter() - start)
+
+    # Count the payments the visitor gets to see
+    permissions = ANONYMOUS
+    if user_id:
+        permissions = load_permissions(User.query.get(user_id))
+    if subproject_id:
+        payment_count = routes.get_subproject_payments(
+            Subproject.query.get(subproject_id), permissions
+        ).count()
+    else:
+        payment_count = routes.get_project_payments(
+            Project.query.get(project_id), permissions
+        ).count()
+
+    print('%s requests of %s (%s payments)' % (number, url, payment_count))
+    print('page size: %.1f KB' % (page_size / 1024))
+    for name, values in [
+            ('time to first byte', first_byte_timings), ('total', timings)]:
+        values.sort()
+        print(
+            '%s: min %.1f ms, median %.1f ms, max %.1f ms' % (
+                name,
+                values[0] * 1000,
+                values[len(values) // 2] * 1000,
+                values[-1] * 1000
+            )
+        )
+
+
 @database.command()
 @click.argument('email')
 def create_user_invite_link(email):
@@ -1,13 +1,20 @@
 from flask import render_template
-from flask_mail import Message
-from app import app, mail
+from app import app, db
+from app.models import OutboxMessage
 
 
+# Queue an email in the outbox, it is delivered by the outbox worker (see
+# app/outbox.py) once the current transaction is committed
 def send_email(subject, sender, recipients, text_body, html_body):
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    mail.send(msg)
+    db.session.add(
+        OutboxMessage(
+            subject=subject,
+            sender=sender,
+            recipients=recipients,
+            text_body=text_body,
+            html_body=html_body
+        )
+    )
 
 
 def send_password_reset_email(user):
@@ -0,0 +1,223 @@
+from xml.sax.saxutils import escape
+import csv
+import io
+import json
+import re
+import zipfile
+
+
+# Export the payments of a (sub)project as CSV, JSON lines or XLSX. The
+# exports are generators, so the payments can be streamed from a yield_per
+# query to the client.
+
+def _get_sender_name(payment):
+    if payment.amount_value >= 0 and payment.type != 'MANUAL':
+        return payment.counterparty_alias_name
+    return payment.alias_name
+
+
+def _get_sender_iban(payment):
+    if payment.amount_value >= 0 and payment.type != 'MANUAL':
+        return payment.counterparty_alias_value
+    return payment.alias_value
+
+
+def _get_receiver_name(payment):
+    if payment.amount_value <= 0 or payment.type == 'MANUAL':
+        return payment.counterparty_alias_name
+    return payment.alias_name
+
+
+def _get_receiver_iban(payment):
+    if payment.amount_value <= 0 or payment.type == 'MANUAL':
+        return payment.counterparty_alias_value
+    return payment.alias_value
+
+
+def _get_type(payment):
+    if payment.type == 'MANUAL':
+        return 'handmatig'
+    if payment.type == 'IMPORT':
+        return 'import'
+    return 'bunq'
+
+
+# The exported columns, the same as the columns of the payment table
+COLUMNS = [
+    ('verzender', _get_sender_name),
+    ('ontvanger', _get_receiver_name),
+    ('omschrijving', lambda x: x.short_user_description),
+    ('datum', lambda x: x.created.strftime('%d-%m-%Y') if x.created else ''),
+    ('betaalomschrijving', lambda x: x.description),
+    ('lange omschrijving', lambda x: x.long_user_description),
+    ('bedrag €', lambda x: x.get_export_currency()),
+    ('saldo na boeking €', lambda x: x.get_export_balance()),
+    ('categorie', lambda x: x.category.name if x.category else ''),
+    ('bankrekening verzender', _get_sender_iban),
+    ('bankrekening ontvanger', _get_receiver_iban),
+    ('route', lambda x: x.route),
+    ('type', _get_type),
+    ('verborgen', lambda x: 'verborgen' if x.hidden else 'zichtbaar')
+]
+
+SUBPROJECT_COLUMN = (
+    'activiteit',
+    lambda x: x.subproject.name if x.subproject else 'Hoofdactiviteit'
+)
+
+
+def get_header(include_subproject=False):
+    columns = COLUMNS
+    if include_subproject:
+        columns = [SUBPROJECT_COLUMN] + COLUMNS
+    return [x[0] for x in columns]
+
+
+def get_rows(payments, include_subproject=False):
+    columns = COLUMNS
+    if include_subproject:
+        columns = [SUBPROJECT_COLUMN] + COLUMNS
+    for payment in payments:
+        yield [get_value(payment) or '' for name, get_value in columns]
+
+
+def export_csv(header, rows):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    # Let Excel know the file is UTF-8
+    output.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue()
+
+
+def export_jsonl(header, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(header, row)), ensure_ascii=False) + '\n'
+
+
+# Collects the data written by zipfile, so it can be yielded in chunks.
+# zipfile writes data descriptors instead of seeking back, as this object
+# can't seek.
+class _ChunkWriter:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+XLSX_PARTS = [
+    (
+        '[Content_Types].xml',
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'
+    ),
+    (
+        '_rels/.rels',
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    (
+        'xl/workbook.xml',
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Transacties" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    (
+        'xl/_rels/workbook.xml.rels',
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    (
+        'xl/styles.xml',
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+        '<borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf/></cellStyleXfs>'
+        '<cellXfs count="1"><xf xfId="0"/></cellXfs>'
+        '</styleSheet>'
+    )
+]
+
+# Characters which are not allowed in XML
+INVALID_XML_CHARACTERS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# Size of the chunks yielded while writing the worksheet
+XLSX_CHUNK_SIZE = 64 * 1024
+
+
+def _xlsx_row(row):
+    return '<row>%s</row>' % ''.join(
+        '<c t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+            escape(INVALID_XML_CHARACTERS.sub('', str(value)))
+        )
+        for value in row
+    )
+
+
+# Write an XLSX file with a single worksheet. The worksheet is written row by
+# row (like a 'write-only' workbook), so memory use doesn't depend on the
+# number of rows.
+def export_xlsx(header, rows):
+    output = _ChunkWriter()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as xlsx:
+        for name, content in XLSX_PARTS:
+            xlsx.writestr(name, content)
+        yield output.pop()
+
+        with xlsx.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                '<sheetData>%s' % (_xlsx_row(header))
+            ).encode('utf-8'))
+            buffered = 0
+            for row in rows:
+                data = _xlsx_row(row).encode('utf-8')
+                sheet.write(data)
+                buffered += len(data)
+                if buffered >= XLSX_CHUNK_SIZE:
+                    buffered = 0
+                    yield output.pop()
+            sheet.write(b'</sheetData></worksheet>')
+    yield output.pop()
+
+
+# Export format: (mimetype, export function)
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', export_csv),
+    'jsonl': ('application/x-ndjson; charset=utf-8', export_jsonl),
+    'xlsx': (
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        export_xlsx
+    )
+}
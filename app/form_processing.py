@@ -1,13 +1,23 @@
 from datetime import datetime
-from flask import flash, redirect, url_for
+from flask import escape, flash, redirect, url_for
+from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
-from werkzeug.utils import secure_filename
-import os
-
-from app import app, db
-from app.forms import CategoryForm, PaymentForm, EditAttachmentForm
-from app.models import Category, Payment, File, User
-from app.util import flash_form_errors, form_in_request
+from werkzeug.datastructures import MultiDict
+
+from app import app, db, images, storage
+from app.forms import (
+    CategorizationRuleForm, CategoryForm, PaymentForm, EditAttachmentForm,
+    ImportPaymentsForm, ImportStatementForm
+)
+from app.models import (
+    CategorizationRule, Category, Payment, File, Subproject, User
+)
+from app.payment_import import PaymentImportError, import_manual_payments
+from app.profiling import timed
+from app.statements import import_statement
+from app.util import (
+    apply_categorization_rules, flash_form_errors, form_in_request
+)
 
 
 def return_redirect(project_id, subproject_id):
@@ -30,6 +40,7 @@ def return_redirect(project_id, subproject_id):
 
 
 # Process filled in category form
+@timed
 def process_category_form(request):
     category_form = CategoryForm(prefix="category_form")
 
@@ -92,7 +103,183 @@ def process_category_form(request):
         flash_form_errors(category_form, request)
 
 
+# Process filled in categorization rule form; category_choices should
+# contain the categories of the (sub)project the rule belongs to
+@timed
+def process_categorization_rule_form(request, category_choices, project_id, subproject_id=0):
+    rule_form = CategorizationRuleForm(prefix="categorization_rule_form")
+    if not form_in_request(rule_form, request):
+        return
+    rule_form.category_id.choices = category_choices
+
+    if rule_form.validate_on_submit():
+        # Only allow editing the rules of this (sub)project
+        if subproject_id:
+            rules = CategorizationRule.query.filter_by(
+                id=rule_form.id.data, subproject_id=subproject_id
+            )
+        else:
+            rules = CategorizationRule.query.filter_by(
+                id=rule_form.id.data, project_id=project_id
+            )
+
+        # Apply all rules to the payments without a category
+        if rule_form.apply.data:
+            categorized_count = apply_categorization_rules(
+                project_id=project_id, subproject_id=subproject_id
+            )
+            flash(
+                '<span class="text-default-green">%s transacties zijn '
+                'gecategoriseerd</span>' % (categorized_count)
+            )
+        # Remove rule
+        elif rule_form.remove.data:
+            rules.delete()
+            db.session.commit()
+            flash(
+                '<span class="text-default-green">Regel is verwijderd</span>'
+            )
+        # Update or save rule
+        else:
+            new_rule_data = {}
+            for f in rule_form:
+                if f.type in ['SubmitField', 'CSRFTokenField']:
+                    continue
+                if f.short_name in ['id', 'project_id', 'subproject_id']:
+                    continue
+                # Save empty fields as None instead of ''
+                if f.data == '':
+                    new_rule_data[f.short_name] = None
+                elif f.short_name in ['amount_min', 'amount_max'] and f.data is not None:
+                    new_rule_data[f.short_name] = float(f.data)
+                else:
+                    new_rule_data[f.short_name] = f.data
+
+            if len(rules.all()):
+                rules.update(new_rule_data)
+                flash(
+                    '<span class="text-default-green">Regel is bijgewerkt</span>'
+                )
+            else:
+                rule = CategorizationRule(**new_rule_data)
+                if subproject_id:
+                    rule.subproject_id = subproject_id
+                else:
+                    rule.project_id = project_id
+                db.session.add(rule)
+                flash(
+                    '<span class="text-default-green">Regel is toegevoegd</span>'
+                )
+            db.session.commit()
+
+        return return_redirect(project_id, subproject_id)
+    else:
+        flash_form_errors(rule_form, request)
+
+
+@timed
+def process_import_statement_form(request, project_id, subproject_id=0):
+    import_form = ImportStatementForm(prefix="import_statement_form")
+    if not form_in_request(import_form, request):
+        return
+
+    if import_form.validate_on_submit():
+        # The uploaded file is parsed as a stream, so large statements are
+        # never read into memory completely
+        try:
+            new_count, skipped_count = import_statement(
+                import_form.data_file.data.stream,
+                statement_format=import_form.statement_format.data or None,
+                project_id=project_id,
+                subproject_id=subproject_id
+            )
+        except (ValueError, SyntaxError) as e:
+            db.session.rollback()
+            app.logger.warning(
+                'Importing bank statement failed: %s' % (repr(e))
+            )
+            flash(
+                '<span class="text-default-red">Het bankafschrift kon niet '
+                'worden ingelezen. Controleer of het formaat juist is.</span>'
+            )
+        else:
+            flash(
+                '<span class="text-default-green">%s transacties zijn '
+                'geïmporteerd, %s transacties waren al eerder '
+                'geïmporteerd</span>' % (new_count, skipped_count)
+            )
+
+        return return_redirect(project_id, subproject_id)
+    else:
+        flash_form_errors(import_form, request)
+
+
+@timed
+def process_import_payments_form(request, project, subproject=None):
+    import_form = ImportPaymentsForm(prefix="import_payments_form")
+    if not form_in_request(import_form, request):
+        return
+
+    subproject_id = 0
+    if subproject:
+        subproject_id = subproject.id
+
+    if import_form.validate_on_submit():
+        data_file = import_form.data_file.data
+        try:
+            imported_count = import_manual_payments(
+                data_file.stream,
+                data_file.filename,
+                project,
+                subproject=subproject,
+                archive_file=(
+                    import_form.archive_file.data.stream
+                    if import_form.archive_file.data else None
+                )
+            )
+        except PaymentImportError as e:
+            db.session.rollback()
+            flash(
+                '<span class="text-default-red">Er zijn geen transacties '
+                'geïmporteerd:<br>%s</span>' % (
+                    '<br>'.join(escape(x) for x in e.errors)
+                )
+            )
+        else:
+            flash(
+                '<span class="text-default-green">%s transacties zijn '
+                'toegevoegd</span>' % (imported_count)
+            )
+
+        return return_redirect(project.id, subproject_id)
+    else:
+        flash_form_errors(import_form, request)
+
+
+# Populate the categorization rule forms which allow the user to edit them
+def create_categorization_rule_forms(rules, category_choices, project_id, subproject_id=0):
+    rule_forms = []
+    for rule in rules:
+        rule_form = CategorizationRuleForm(prefix="categorization_rule_form", **{
+            'id': rule.id,
+            'counterparty_iban': rule.counterparty_iban,
+            'counterparty_name': rule.counterparty_name,
+            'description': rule.description,
+            'amount_min': rule.amount_min,
+            'amount_max': rule.amount_max,
+            'category_id': str(rule.category_id or ''),
+            'route': rule.route or '',
+            'project_id': project_id,
+            'subproject_id': subproject_id
+        })
+        rule_form.category_id.choices = category_choices
+        rule_forms.append((rule, rule_form))
+
+    return rule_forms
+
+
 # Process filled in payment form
+@timed
 def process_payment_form(request, project_or_subproject, project_owner, user_subproject_ids, is_subproject):
     form_keys = list(request.form.keys())
     if len(form_keys) > 0 and form_keys[0].startswith("payment_form_"):
@@ -140,13 +327,14 @@ def process_payment_form(request, project_or_subproject, project_owner, user_sub
         payment_form.route.data = 'inkomsten'
 
     if payment_form.validate_on_submit():
-        # Remove payment
+        # Remove payment, only manually added payments can be removed
         if payment_form.remove.data:
-            Payment.query.filter_by(id=payment_form.id.data).delete()
-            db.session.commit()
-            flash(
-                '<span class="text-default-green">Transactie is verwijderd</span>'
-            )
+            if temppayment.type == 'MANUAL':
+                Payment.query.filter_by(id=payment_form.id.data).delete()
+                db.session.commit()
+                flash(
+                    '<span class="text-default-green">Transactie is verwijderd</span>'
+                )
         # Get data from the form
         else:
             new_payment_data = {}
@@ -213,77 +401,222 @@ def process_payment_form(request, project_or_subproject, project_owner, user_sub
         return payment_form
 
 
-# Populate the payment forms which allows the user to edit it
-def create_payment_forms(payments, project_owner):
-    payment_forms = {}
-    for payment in payments:
-        # If a payment already contains a category, retrieve it to set
-        # this category as the selected category in the drop-down menu
-        selected_category = ''
-        if payment.category:
-            selected_category = payment.category.id
-        payment_form = PaymentForm(prefix=f'payment_form_{payment.id}', **{
-            'short_user_description': payment.short_user_description,
-            'long_user_description': payment.long_user_description,
-            'created': payment.created,
-            'amount_value': payment.amount_value,
-            'id': payment.id,
-            'hidden': payment.hidden,
-            'category_id': selected_category,
-            'route': payment.route
-        })
-
-        # The created field may only be edited on manually added transactions
-        if payment.type != 'MANUAL':
-            del payment_form['created']
+# Edit a single payment with the (JSON) data of a PATCH request. Only the
+# fields in the data are changed; they are validated with the same
+# PaymentForm as used by process_payment_form. Returns a list of errors,
+# which is empty if the payment is updated.
+@timed
+def process_payment_patch(data, payment, project_owner):
+    payment_form = PaymentForm(meta={'csrf': False}, formdata=None, obj=payment)
+    if payment.subproject:
+        payment_form.category_id.choices = payment.subproject.make_category_select_options()
+    else:
+        payment_form.category_id.choices = payment.project.make_category_select_options()
+    payment_form.category_id.data = str(payment.category_id or '')
+    payment_form.route.choices = [
+        ('inkomsten', 'inkomsten'),
+        ('inbesteding', 'inbesteding'),
+        ('uitgaven', 'uitgaven')
+    ]
 
-        # A project with subprojects can contain multiple editable
-        # payments on the project page, so we need to retrieve the
-        # categories for each payment (could be made more efficient,
-        # but this is readable)
-        if payment.subproject:
-            payment_form.category_id.choices = payment.subproject.make_category_select_options()
+    errors = []
+    for name, value in data.items():
+        if name not in [
+                'short_user_description', 'long_user_description',
+                'amount_value', 'created', 'hidden', 'category_id',
+                'route']:
+            errors.append('Onbekend veld: %s' % (name))
+            continue
+        # Only the amount and date of manually added payments can be edited
+        if name in ['amount_value', 'created'] and payment.type != 'MANUAL':
+            errors.append('%s kan niet worden gewijzigd' % (name))
+            continue
+        # Only project owners are allowed to hide a transaction
+        if name == 'hidden' and not project_owner:
+            errors.append('%s kan niet worden gewijzigd' % (name))
+            continue
+
+        if name == 'hidden':
+            value = 'y' if value else ''
+        elif value is None:
+            value = ''
+        payment_form[name].process(MultiDict({name: str(value)}))
+
+    if errors:
+        return errors
+
+    # Only validate the edited fields
+    for name in data:
+        if not payment_form[name].validate(payment_form):
+            errors.append('%s: %s' % (
+                payment_form[name].label.text,
+                ', '.join(payment_form[name].errors)
+            ))
+    if errors:
+        return errors
+
+    new_payment_data = {}
+    for name in data:
+        new_payment_data[name] = payment_form[name].data
+    # If the category is edited to be empty again, make sure to set it to
+    # None instead of ''
+    if 'category_id' in new_payment_data:
+        if new_payment_data['category_id']:
+            new_payment_data['category_id'] = int(new_payment_data['category_id'])
         else:
-            payment_form.category_id.choices = payment.project.make_category_select_options()
+            new_payment_data['category_id'] = None
+    if 'amount_value' in new_payment_data:
+        new_payment_data['amount_value'] = float(new_payment_data['amount_value'])
 
-        payment_form.route.choices = [
-            ('inkomsten', 'inkomsten'),
-            ('inbesteding', 'inbesteding'),
-            ('uitgaven', 'uitgaven')
+    # In case of a manual payment we update the updated field with the
+    # current timestamp
+    if payment.type == 'MANUAL':
+        new_payment_data['updated'] = datetime.now()
+
+    try:
+        Payment.query.filter_by(id=payment.id).update(new_payment_data)
+        db.session.commit()
+    except IntegrityError as e:
+        db.session().rollback()
+        app.logger.error(repr(e))
+        return ['Transactie bijwerken mislukt']
+
+    return []
+
+
+# Edit multiple payments at once. The data contains the ids of the payments
+# and the fields to change ('category_id', 'route', 'hidden' and/or
+# 'short_user_description'). Permissions of all payments are checked with a
+# single query and all payments are changed with a single UPDATE. Returns
+# a dict with the result and the HTTP status code.
+@timed
+def process_payment_batch(data, project, project_owner, user_subproject_ids):
+    try:
+        payment_ids = sorted(set(int(x) for x in data.get('payment_ids', [])))
+    except (TypeError, ValueError):
+        payment_ids = []
+    if not payment_ids:
+        return {'error': 'Er zijn geen transacties geselecteerd'}, 400
+
+    new_payment_data = {}
+    if 'route' in data:
+        if data['route'] not in ['inkomsten', 'inbesteding', 'uitgaven']:
+            return {'error': 'Onbekende route'}, 400
+        new_payment_data['route'] = data['route']
+    if 'hidden' in data:
+        # Only project owners are allowed to hide a transaction
+        if not project_owner:
+            return {
+                'error': 'Alleen initiatiefnemers mogen transacties verbergen'
+            }, 403
+        if not isinstance(data['hidden'], bool):
+            return {'error': 'Ongeldige waarde voor verbergen'}, 400
+        new_payment_data['hidden'] = data['hidden']
+    if 'short_user_description' in data:
+        description = data['short_user_description']
+        if not isinstance(description, str) or len(description) > 50:
+            return {
+                'error': 'De korte beschrijving mag maximaal 50 tekens zijn'
+            }, 400
+        new_payment_data['short_user_description'] = description
+    if 'category_id' in data:
+        # An empty category removes the category
+        category_id = data['category_id'] or None
+        if category_id is not None:
+            try:
+                category_id = int(category_id)
+            except (TypeError, ValueError):
+                return {'error': 'Onbekende categorie'}, 400
+        new_payment_data['category_id'] = category_id
+    if not new_payment_data:
+        return {'error': 'Er is niets om te wijzigen'}, 400
+
+    # A project owner can edit all payments of the project and its
+    # subprojects, other users only the payments of their subprojects
+    if project_owner:
+        conditions = [
+            or_(
+                Payment.project_id == project.id,
+                Payment.subproject_id.in_(
+                    db.session.query(Subproject.id).filter_by(
+                        project_id=project.id
+                    )
+                )
+            )
         ]
+    else:
+        conditions = [Payment.subproject_id.in_(user_subproject_ids)]
+
+    # A category can only be set on payments of its own (sub)project
+    if new_payment_data.get('category_id'):
+        category = Category.query.get(new_payment_data['category_id'])
+        if not category:
+            return {'error': 'Onbekende categorie'}, 400
+        if category.subproject_id:
+            conditions.append(Payment.subproject_id == category.subproject_id)
+        else:
+            conditions.append(Payment.project_id == category.project_id)
+
+    allowed_count = Payment.query.filter(
+        Payment.id.in_(payment_ids), *conditions
+    ).count()
+    if allowed_count != len(payment_ids):
+        return {
+            'error': 'Niet alle geselecteerde transacties mogen (met deze '
+                     'categorie) worden bewerkt'
+        }, 403
+
+    try:
+        updated_count = Payment.query.filter(
+            Payment.id.in_(payment_ids)
+        ).update(new_payment_data, synchronize_session=False)
+        db.session.commit()
+    except IntegrityError as e:
+        db.session().rollback()
+        app.logger.error(repr(e))
+        return {'error': 'Transacties bijwerken mislukt'}, 500
+
+    return {
+        'updated': updated_count,
+        'payment_ids': payment_ids,
+        'changes': new_payment_data
+    }, 200
+
+
+# Create the form of the edit payment modal. A page contains a single modal
+# (instead of a form per payment) which main.js fills in with the data of the
+# payment that is edited, see Payment.get_edit_data. The form is saved with a
+# PATCH request, see process_payment_patch; only removing a payment is posted
+# to process_payment_form.
+def create_payment_edit_form():
+    payment_form = PaymentForm(prefix='payment_form_edit', formdata=None)
+    payment_form.route.choices = [
+        ('inkomsten', 'inkomsten'),
+        ('inbesteding', 'inbesteding'),
+        ('uitgaven', 'uitgaven')
+    ]
+    return payment_form
 
-        # Only allow manually added payments to be removed
-        if payment.type != 'MANUAL':
-            del payment_form.remove
 
-        # Only allow project owners to hide a transaction
-        if project_owner:
-            payment_form.hidden = payment.hidden
+# The category choices of the edit payment modal, for the payments of the
+# project itself (key '') and of each of the given subprojects (key
+# subproject id)
+def get_payment_category_choices(project, subprojects):
+    category_choices = {'': project.make_category_select_options()}
+    for subproject in subprojects:
+        category_choices[str(subproject.id)] = (
+            subproject.make_category_select_options()
+        )
+    return category_choices
 
-        payment_forms[payment.id] = payment_form
 
-    return payment_forms
+# Save attachment to disk, files with the same content are stored once
+def save_attachment(f, mediatype, db_object):
+    link_attachment(storage.create_file(f.stream, f.filename, mediatype), db_object)
 
 
-# Save attachment to disk
-def save_attachment(f, mediatype, db_object, folder):
-    filename = secure_filename(f.filename)
-    filename = '%s_%s' % (
-        datetime.now(app.config['TZ']).isoformat()[:19], filename
-    )
-    filepath = os.path.join(
-        os.path.abspath(
-            os.path.join(
-                app.instance_path, '../%s/%s' % (
-                    app.config['UPLOAD_FOLDER'],
-                    folder
-                )
-            )
-        ),
-        filename
-    )
-    f.save(filepath)
-    new_file = File(filename=filename, mimetype=f.headers[1][1], mediatype=mediatype)
+# Save a new File and link it to a User or Payment
+def link_attachment(new_file, db_object):
     db.session.add(new_file)
     db.session.commit()
 
@@ -297,8 +630,11 @@ def save_attachment(f, mediatype, db_object, folder):
         db_object.attachments.append(new_file)
         db.session.commit()
 
+    images.queue_variants(new_file)
+
 
 # Process filled in transaction attachment form
+@timed
 def process_transaction_attachment_form(request, transaction_attachment_form, project_owner, user_subproject_ids, project_id=0, subproject_id=0):
     if form_in_request(transaction_attachment_form, request):
         if transaction_attachment_form.validate_on_submit():
@@ -311,7 +647,7 @@ def process_transaction_attachment_form(request, transaction_attachment_form, pr
             if not project_owner and not payment.subproject.id in user_subproject_ids:
                 return
 
-            save_attachment(transaction_attachment_form.data_file.data, transaction_attachment_form.mediatype.data, payment, 'transaction-attachment')
+            save_attachment(transaction_attachment_form.data_file.data, transaction_attachment_form.mediatype.data, payment)
 
             # Redirect back to clear form data
             if subproject_id:
@@ -346,14 +682,14 @@ def create_edit_attachment_forms(attachments):
 
     return edit_attachment_forms
 
+@timed
 def process_edit_attachment_form(request, edit_attachment_form, project_id=0, subproject_id=0):
     edit_attachment_form = EditAttachmentForm(prefix="edit_attachment_form")
 
     if edit_attachment_form.validate_on_submit():
         # Remove attachment
         if edit_attachment_form.remove.data:
-            File.query.filter_by(id=edit_attachment_form.id.data).delete()
-            db.session.commit()
+            storage.delete_file(edit_attachment_form.id.data)
             flash('<span class="text-default-green">Media is verwijderd</span>')
         else:
             new_data = {}
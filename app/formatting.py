@@ -0,0 +1,46 @@
+from babel import Locale
+
+
+# Format amounts and numbers for the nl-NL locale. The separators are
+# retrieved from Babel once, so formatting doesn't depend on the process
+# wide locale (which isn't thread-safe and needs to be installed) and a
+# value only needs Python's format() and a str.translate().
+
+LOCALE = Locale.parse('nl_NL')
+
+_symbols = LOCALE.number_symbols
+# Newer Babel versions store the symbols per numbering system
+_symbols = _symbols.get('latn', _symbols)
+
+_TRANSLATION = str.maketrans({
+    ',': _symbols['group'],
+    '.': _symbols['decimal'],
+    '-': _symbols['minusSign']
+})
+
+_PERCENT_PATTERN = LOCALE.percent_formats[None]
+
+
+def _create_formatter(format_spec):
+    def formatter(value):
+        return format(value, format_spec).translate(_TRANSLATION)
+    return formatter
+
+
+# E.g., 1.234,56
+format_amount = _create_formatter(',.2f')
+# Without thousands separator for exports, e.g., 1234,56
+format_export_amount = _create_formatter('.2f')
+# Rounded, e.g., 1.235
+format_whole_amount = _create_formatter(',.0f')
+# E.g., 1,2 (used with K and M suffixes)
+format_one_decimal = _create_formatter('.1f')
+
+
+# Format a whole column of amounts at once
+def format_amounts(values, formatter=format_amount):
+    return [formatter(x) for x in values]
+
+
+def format_percent(value):
+    return _PERCENT_PATTERN.apply(value, LOCALE)
@@ -2,7 +2,7 @@ from app import app
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms.validators import (
-    DataRequired, Email, EqualTo, Length, Optional, URL
+    DataRequired, Email, EqualTo, Length, NumberRange, Optional, Regexp, URL
 )
 from wtforms.widgets import HiddenInput
 from wtforms import (
@@ -16,6 +16,10 @@ allowed_extensions = [
     'docx'
 ]
 
+statement_extensions = ['xml', 'sta', 'mt940', 'txt', 'csv']
+
+payment_import_extensions = ['csv', 'xlsx']
+
 class ResetPasswordRequestForm(FlaskForm):
     email = StringField(
         'E-mailadres', validators=[DataRequired(), Email(), Length(max=120)]
@@ -290,6 +294,50 @@ class TransactionAttachmentForm(FlaskForm):
     )
 
 
+
+# Starts a resumable upload of a transaction attachment; main.js then sends
+# the file itself in chunks, see routes.attachment_upload
+class AttachmentUploadForm(FlaskForm):
+    filename = StringField(
+        'Bestand',
+        validators=[
+            DataRequired(),
+            Length(max=255),
+            Regexp(
+                r'(?i)^.*\.(%s)$' % '|'.join(allowed_extensions),
+                message=(
+                    'bestandstype niet toegstaan. Enkel de volgende '
+                    'bestandstypen worden geaccepteerd: %s' % ', '.join(
+                        allowed_extensions
+                    )
+                )
+            )
+        ]
+    )
+    size = IntegerField(
+        'Grootte',
+        validators=[
+            DataRequired(),
+            NumberRange(
+                min=1,
+                max=app.config.get(
+                    'MAX_UPLOAD_SIZE', app.config['MAX_CONTENT_LENGTH']
+                ),
+                message='het bestand is te groot'
+            )
+        ]
+    )
+    mediatype = RadioField(
+        'Media type',
+        choices=[
+            ('media', 'media'),
+            ('bon', 'bon')
+        ],
+        validators=[DataRequired()]
+    )
+    payment_id = IntegerField(validators=[DataRequired()])
+
+
 class EditAttachmentForm(FlaskForm):
     id = IntegerField(widget=HiddenInput())
     mediatype = RadioField(
@@ -355,6 +403,30 @@ class AddUserForm(FlaskForm):
     )
 
 
+# Invite many users at once on the project page, see util.parse_invites
+class BulkAddUserForm(FlaskForm):
+    emails = TextAreaField(
+        'E-mailadressen',
+        validators=[DataRequired()],
+        description=(
+            'Eén e-mailadres per regel, eventueel gevolgd door een komma en de '
+            'naam van de activiteit waar de gebruiker activiteitnemer van '
+            'wordt (bijvoorbeeld geplakt uit een spreadsheet of CSV-bestand).'
+        ),
+        render_kw={'rows': 10}
+    )
+    subproject_id = SelectField(
+        'Overige e-mailadressen toevoegen als', coerce=int, default=0
+    )
+
+    submit = SubmitField(
+        'Uitnodigen',
+        render_kw={
+            'class': 'btn btn-info'
+        }
+    )
+
+
 class EditAdminForm(FlaskForm):
     admin = BooleanField('Admin')
     active = BooleanField('Gebruikersaccount is actief')
@@ -460,3 +532,162 @@ class CategoryForm(FlaskForm):
             'class': 'btn btn-danger'
         }
     )
+
+
+class CategorizationRuleForm(FlaskForm):
+    counterparty_iban = StringField(
+        'IBAN tegenpartij', validators=[Optional(), Length(max=34)]
+    )
+    counterparty_name = StringField(
+        'Naam tegenpartij bevat', validators=[Optional(), Length(max=120)]
+    )
+    description = StringField(
+        'Betaalomschrijving bevat', validators=[Optional(), Length(max=120)]
+    )
+    amount_min = FlexibleDecimalField(
+        'Bedrag vanaf (begin met een "-" voor uitgaven)',
+        validators=[Optional()]
+    )
+    amount_max = FlexibleDecimalField(
+        'Bedrag tot en met (begin met een "-" voor uitgaven)',
+        validators=[Optional()]
+    )
+    category_id = SelectField('Categorie', validators=[Optional()], choices=[])
+    route = SelectField(
+        'Route',
+        validators=[Optional()],
+        choices=[
+            ('', ''),
+            ('inkomsten', 'inkomsten'),
+            ('inbesteding', 'inbesteding'),
+            ('uitgaven', 'uitgaven')
+        ]
+    )
+    id = IntegerField(widget=HiddenInput())
+    project_id = IntegerField(widget=HiddenInput())
+    subproject_id = IntegerField(widget=HiddenInput())
+
+    submit = SubmitField(
+        'Opslaan',
+        render_kw={
+            'class': 'btn btn-info'
+        }
+    )
+
+    remove = SubmitField(
+        'Verwijderen',
+        render_kw={
+            'class': 'btn btn-danger'
+        }
+    )
+
+    # Apply all rules of this (sub)project to its uncategorized payments
+    apply = SubmitField(
+        'Regels toepassen op transacties zonder categorie',
+        render_kw={
+            'class': 'btn btn-info'
+        }
+    )
+
+    def validate(self):
+        if not super(CategorizationRuleForm, self).validate():
+            return False
+
+        # Applying or removing rules doesn't need any conditions
+        if self.apply.data or self.remove.data:
+            return True
+
+        if not (self.counterparty_iban.data or self.counterparty_name.data
+                or self.description.data or self.amount_min.data is not None
+                or self.amount_max.data is not None):
+            self.counterparty_iban.errors.append(
+                'Vul ten minste één voorwaarde in'
+            )
+            return False
+
+        if not (self.category_id.data or self.route.data):
+            self.category_id.errors.append(
+                'Kies een categorie en/of route'
+            )
+            return False
+
+        return True
+
+
+class ImportStatementForm(FlaskForm):
+    data_file = FileField(
+        'Bankafschrift',
+        validators=[
+            FileRequired(),
+            FileAllowed(
+                statement_extensions,
+                (
+                    'bestandstype niet toegstaan. Enkel de volgende '
+                    'bestandstypen worden geaccepteerd: %s' % ', '.join(
+                        statement_extensions
+                    )
+                )
+            )
+        ]
+    )
+    statement_format = SelectField(
+        'Formaat',
+        validators=[Optional()],
+        choices=[
+            ('', 'automatisch herkennen'),
+            ('camt053', 'CAMT.053 (XML)'),
+            ('mt940', 'MT940'),
+            ('csv', 'CSV')
+        ],
+        default=''
+    )
+    project_id = IntegerField(widget=HiddenInput())
+    subproject_id = IntegerField(widget=HiddenInput())
+
+    submit = SubmitField(
+        'Importeren',
+        render_kw={
+            'class': 'btn btn-info'
+        }
+    )
+
+
+# Import multiple manual payments at once
+class ImportPaymentsForm(FlaskForm):
+    data_file = FileField(
+        'Spreadsheet met transacties',
+        validators=[
+            FileRequired(),
+            FileAllowed(
+                payment_import_extensions,
+                (
+                    'bestandstype niet toegstaan. Enkel de volgende '
+                    'bestandstypen worden geaccepteerd: %s' % ', '.join(
+                        payment_import_extensions
+                    )
+                )
+            )
+        ]
+    )
+    archive_file = FileField(
+        'Zip-bestand met bijlagen',
+        validators=[
+            FileAllowed(
+                ['zip'],
+                (
+                    'bestandstype niet toegstaan. Enkel de volgende '
+                    'bestandstypen worden geaccepteerd: zip'
+                )
+            ),
+            Optional()
+        ]
+    )
+    project_id = IntegerField(widget=HiddenInput())
+    subproject_id = IntegerField(widget=HiddenInput())
+
+    submit = SubmitField(
+        'Importeren',
+        render_kw={
+            'class': 'btn btn-info'
+        }
+    )
@@ -0,0 +1,246 @@
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import re
+
+from sqlalchemy import exists, or_
+
+from app import app, db, storage
+from app.models import Blob, File
+
+
+# Uploads are kept as long as something refers to them. Deleting a payment,
+# project or user only removes the links to its Files, so the collector marks
+# and sweeps in three steps:
+# 1. delete the Files no table refers to anymore (which releases their blob)
+# 2. delete the Blobs no File refers to anymore and their content
+# 3. walk through storage and delete what no Blob or File refers to, e.g.,
+#    content of which saving the Blob failed and abandoned partial uploads
+# Everything younger than the grace period is left alone, as it can belong to
+# an upload in progress. The walk through storage is done in batches and
+# resumes from a checkpoint, so it can be spread over several runs.
+
+BATCH_SIZE = 1000
+
+GRACE_PERIOD = timedelta(days=1)
+
+# Resized variant of a File uploaded before blobs were used, see
+# models.get_variant_filename
+VARIANT_FILENAME = re.compile(r'^(.*)_\d+w\.(webp|jpg)$')
+
+
+class GarbageCollectionResult:
+    def __init__(self):
+        self.files = 0
+        self.blobs = 0
+        self.objects = 0
+        self.reclaimed = 0
+        self.complete = False
+
+
+def get_checkpoint_path():
+    return os.path.join(app.instance_path, 'garbage-collection.json')
+
+
+# Returns the key after which the walk through storage resumes
+def _load_checkpoint(backend):
+    try:
+        with open(get_checkpoint_path()) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Keys are ordered differently by each backend
+    if checkpoint.get('backend') != backend.name:
+        return None
+    return checkpoint.get('key')
+
+
+def _save_checkpoint(backend, key):
+    path = get_checkpoint_path()
+    if key is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'backend': backend.name, 'key': key}, f)
+
+
+# Columns of all tables referring to a File, e.g., payment_attachment.file_id
+# and user.image
+def get_file_references():
+    return [
+        column
+        for table in db.metadata.sorted_tables
+        for column in table.columns
+        if any(fk.references(File.__table__) for fk in column.foreign_keys)
+    ]
+
+
+# Delete the Files created before the cutoff that no table refers to. Their
+# blobs are released by models._release_blobs.
+def collect_files(cutoff, result, dry_run=False):
+    unreferenced = [
+        ~exists().where(column == File.id) for column in get_file_references()
+    ]
+    last_id = 0
+    while True:
+        file_ids = [
+            x[0] for x in db.session.query(File.id).filter(
+                File.id > last_id, File.created < cutoff, *unreferenced
+            ).order_by(File.id).limit(BATCH_SIZE)
+        ]
+        if not file_ids:
+            break
+        last_id = file_ids[-1]
+        result.files += len(file_ids)
+        if not dry_run:
+            File.query.filter(File.id.in_(file_ids)).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+
+
+# Delete the Blobs no File refers to and their content (including resized
+# variants). Their reference count is ignored, as it only drifts upwards
+# when a File is deleted without releasing its blob.
+def collect_blobs(result, dry_run=False):
+    unreferenced = ~exists().where(File.blob_id == Blob.id)
+    backend = storage.get_backend()
+    last_id = 0
+    while True:
+        blob_ids = [
+            x[0] for x in db.session.query(Blob.id).filter(
+                Blob.id > last_id, unreferenced
+            ).order_by(Blob.id).limit(BATCH_SIZE)
+        ]
+        if not blob_ids:
+            break
+        last_id = blob_ids[-1]
+        if dry_run:
+            result.blobs += len(blob_ids)
+            result.reclaimed += db.session.query(
+                db.func.coalesce(db.func.sum(Blob.size), 0)
+            ).filter(Blob.id.in_(blob_ids)).scalar()
+            continue
+
+        # Skip the blobs an upload in progress is adding a reference to and
+        # check again once they are locked
+        locked_ids = [
+            x[0] for x in db.session.query(Blob.id).filter(
+                Blob.id.in_(blob_ids)
+            ).with_for_update(skip_locked=True)
+        ]
+        blobs = db.session.query(Blob.id, Blob.sha256).filter(
+            Blob.id.in_(locked_ids), unreferenced
+        ).all()
+        Blob.query.filter(Blob.id.in_([x.id for x in blobs])).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+        for blob in blobs:
+            result.reclaimed += backend.delete_prefix(
+                storage.get_blob_key(blob.sha256)
+            )
+        result.blobs += len(blobs)
+
+
+# Returns the keys of the given batch that no Blob or File refers to
+def _get_unreferenced_keys(keys):
+    blob_keys = {}
+    legacy_keys = {}
+    unreferenced = []
+    for key in keys:
+        parts = key.split('/')
+        if parts[0] == 'blobs' and len(parts) == 3 and parts[1] != 'tmp':
+            # The key of a blob or one of its variants starts with its SHA-256
+            blob_keys.setdefault(parts[2][:64], []).append(key)
+        elif parts[0] in storage.UPLOAD_FOLDERS and len(parts) == 2:
+            legacy_keys[key] = parts[1]
+        elif key.startswith(('blobs/tmp/', 'uploads/')):
+            # Temporary files and partial and direct uploads
+            unreferenced.append(key)
+
+    if blob_keys:
+        existing = {
+            x[0] for x in db.session.query(Blob.sha256).filter(
+                Blob.sha256.in_(list(blob_keys))
+            )
+        }
+        for sha256, sha256_keys in blob_keys.items():
+            if sha256 not in existing:
+                unreferenced.extend(sha256_keys)
+
+    if legacy_keys:
+        # Files uploaded before blobs were used are stored under their
+        # filename, their variants under the filename without extension
+        filenames = set(legacy_keys.values())
+        bases = {
+            match.group(1) for match in map(VARIANT_FILENAME.match, filenames)
+            if match
+        }
+        existing = {
+            x[0] for x in db.session.query(File.filename).filter(or_(
+                File.filename.in_(filenames),
+                *[File.filename.startswith(base + '.', autoescape=True)
+                  for base in bases]
+            ))
+        }
+        existing_bases = {os.path.splitext(x)[0] for x in existing}
+        for key, filename in legacy_keys.items():
+            match = VARIANT_FILENAME.match(filename)
+            if filename in existing:
+                continue
+            if match and match.group(1) in existing_bases:
+                continue
+            unreferenced.append(key)
+    return unreferenced
+
+
+# Walk through storage from the checkpoint and delete what no Blob or File
+# refers to and was last modified before the cutoff. At most limit keys are
+# checked; the checkpoint is removed once the walk is complete.
+def sweep_storage(cutoff, result, limit=None, dry_run=False):
+    backend = storage.get_backend()
+    listing = backend.list(start_after=_load_checkpoint(backend))
+
+    def sweep(batch):
+        unreferenced = set(_get_unreferenced_keys(batch))
+        keys = [key for key in batch if key in unreferenced]
+        if not dry_run:
+            backend.delete(keys)
+        result.objects += len(keys)
+        result.reclaimed += sum(batch[key] for key in keys)
+
+    batch = {}
+    checked = 0
+    last_key = None
+    for key, size, modified in listing:
+        last_key = key
+        checked += 1
+        if modified < cutoff:
+            batch[key] = size
+        if len(batch) >= BATCH_SIZE:
+            sweep(batch)
+            batch = {}
+            if not dry_run:
+                _save_checkpoint(backend, last_key)
+        if limit and checked >= limit:
+            break
+    else:
+        last_key = None
+        result.complete = True
+    if batch:
+        sweep(batch)
+    if not dry_run:
+        _save_checkpoint(backend, last_key)
+
+
+# Run all steps, see the top of this file
+def collect_garbage(grace_period=GRACE_PERIOD, limit=None, dry_run=False):
+    cutoff = datetime.now(timezone.utc) - grace_period
+    result = GarbageCollectionResult()
+    collect_files(cutoff, result, dry_run=dry_run)
+    collect_blobs(result, dry_run=dry_run)
+    sweep_storage(cutoff, result, limit=limit, dry_run=dry_run)
+    return result
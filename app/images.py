@@ -0,0 +1,209 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+import os
+
+from PIL import Image, ImageOps
+from sqlalchemy import and_, or_
+
+from app import app, db, storage
+from app.models import File, get_variant_filename
+
+
+# Uploaded images (e.g., photos of receipts) are often several megabytes
+# large, while they are shown as small thumbnails. After an upload, a worker
+# process creates resized variants of the image without EXIF data (which can
+# contain the location where a photo was taken). They are stored next to the
+# image and their widths are recorded on the File, so templates can show them
+# with a srcset, see partials/image.html.
+
+IMAGE_MIMETYPES = ['image/jpeg', 'image/jpg', 'image/png']
+
+# Widths of the resized variants in pixels
+VARIANT_WIDTHS = [320, 640, 1280]
+
+# Extension -> Pillow save options of the variants
+VARIANT_FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpg': {'format': 'JPEG', 'quality': 80, 'optimize': True,
+            'progressive': True}
+}
+
+VARIANT_MIMETYPES = {'webp': 'image/webp', 'jpg': 'image/jpeg'}
+
+# The pools are created on first use so each uWSGI worker gets its own after
+# forking
+_process_pool = None
+_thread_pool = None
+
+
+def _get_pools():
+    global _process_pool, _thread_pool
+    if _process_pool is None:
+        workers = app.config.get('IMAGE_WORKERS', 2)
+        _process_pool = ProcessPoolExecutor(max_workers=workers)
+        # The threads fetch the image from and store the variants in storage
+        # and wait for the worker process resizing it
+        _thread_pool = ThreadPoolExecutor(max_workers=workers)
+    return _process_pool, _thread_pool
+
+
+def is_image(file):
+    return file.mimetype in IMAGE_MIMETYPES
+
+
+# Create the resized variants of the image at the given path in the given
+# folder and return their widths. The variants are named after the given
+# filename. Images narrower than a width are not upscaled, so only the
+# variants up to the width of the image itself are created. Runs in a worker
+# process.
+def create_variants(path, folder, filename):
+    widths = []
+    with Image.open(path) as original:
+        # Rotate the image according to its EXIF orientation, because the
+        # EXIF data is not copied to the variants
+        image = ImageOps.exif_transpose(original)
+        icc_profile = image.info.get('icc_profile')
+        if image.mode not in ('RGB', 'RGBA'):
+            transparent = 'A' in image.mode or 'transparency' in image.info
+            image = image.convert('RGBA' if transparent else 'RGB')
+        image.info = {}
+
+        for width in VARIANT_WIDTHS:
+            # The previous variant has the width of the image itself
+            if widths and widths[-1] >= image.width:
+                break
+            if width < image.width:
+                resized = image.resize(
+                    (width, max(1, round(image.height * width / image.width))),
+                    Image.LANCZOS
+                )
+            else:
+                resized = image
+                width = image.width
+
+            for extension, options in VARIANT_FORMATS.items():
+                variant = resized
+                # JPEG has no alpha channel
+                if extension == 'jpg' and variant.mode != 'RGB':
+                    variant = variant.convert('RGB')
+                if icc_profile:
+                    options = dict(options, icc_profile=icc_profile)
+                variant.save(
+                    os.path.join(
+                        folder,
+                        get_variant_filename(filename, width, extension)
+                    ),
+                    **options
+                )
+            widths.append(width)
+    return widths
+
+
+# Create the variants of the image with the given storage key in a worker
+# process and store them next to it. Returns their widths.
+def _store_variants(key):
+    process_pool, _ = _get_pools()
+    backend = storage.get_backend()
+    filename = os.path.basename(key)
+    with backend.local_copy(key) as path, TemporaryDirectory() as folder:
+        try:
+            widths = process_pool.submit(
+                create_variants, path, folder, filename
+            ).result()
+        except RuntimeError:
+            # The interpreter is shutting down (e.g., at the end of a CLI
+            # command), so no new work can be submitted to the pool
+            widths = create_variants(path, folder, filename)
+        for variant in os.listdir(folder):
+            backend.save(
+                '%s/%s' % (os.path.dirname(key), variant),
+                os.path.join(folder, variant)
+            )
+    return widths
+
+
+def _create_variants_in_background(file_id, key):
+    try:
+        widths = _store_variants(key)
+    except Exception:
+        app.logger.exception('Creating the image variants of %s failed' % (key))
+        return
+    with app.app_context():
+        try:
+            files = File.query.filter_by(id=file_id)
+            blob_id = files.with_entities(File.blob_id).scalar()
+            if blob_id:
+                # Files with the same content share the variants
+                files = File.query.filter(or_(
+                    File.id == file_id,
+                    and_(File.blob_id == blob_id, File.variants.is_(None))
+                ))
+            files.update({'variants': widths}, synchronize_session=False)
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+
+# Let a worker process create the variants of an uploaded image. The File
+# must have been committed, so its id is known. Files with the same content
+# share the variants of their blob.
+def queue_variants(file):
+    if not is_image(file):
+        return
+    sibling = file.blob_id and File.query.filter(
+        File.blob_id == file.blob_id,
+        File.id != file.id,
+        File.variants.isnot(None)
+    ).first()
+    if sibling:
+        file.variants = sibling.variants
+        db.session.commit()
+        return
+
+    _, thread_pool = _get_pools()
+    thread_pool.submit(
+        _create_variants_in_background, file.id, storage.get_key(file)
+    )
+
+
+# (Re)create the variants of the given image Files in the worker processes
+# and wait for them, e.g., after changing VARIANT_WIDTHS. Returns the number
+# of Files of which the variants were created.
+def regenerate_variants(files):
+    backend = storage.get_backend()
+    keys = {}
+    for file in files:
+        if not is_image(file):
+            continue
+        if file.blob:
+            keys[file.id] = storage.get_key(file)
+            continue
+        # Files uploaded before blobs were used
+        for folder in storage.UPLOAD_FOLDERS:
+            key = storage.get_key(file, folder=folder)
+            if backend.exists(key):
+                keys[file.id] = key
+                break
+        else:
+            app.logger.warning('Image %s not found' % (file.filename))
+
+    _, thread_pool = _get_pools()
+    futures = {
+        file_id: thread_pool.submit(_store_variants, key)
+        for file_id, key in keys.items()
+    }
+    count = 0
+    for file_id, future in futures.items():
+        try:
+            widths = future.result()
+        except Exception:
+            app.logger.exception(
+                'Creating the image variants of %s failed' % (keys[file_id])
+            )
+            continue
+        File.query.filter_by(id=file_id).update(
+            {'variants': widths}, synchronize_session=False
+        )
+        count += 1
+    db.session.commit()
+    return count
@@ -0,0 +1,222 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import json
+import logging
+import queue
+import smtplib
+import threading
+import time
+import uuid
+
+from flask import g, has_request_context, request
+
+
+# Log records are put on a queue by the thread that logs them (e.g., a
+# request or a Bunq sync) and written to the log file and mailed by a
+# listener thread, so no thread waits on disk or SMTP I/O. Lines in the log
+# file are JSON objects with the id of the request they belong to; nginx
+# passes its $request_id as the X-Request-ID header, so they can be matched
+# with its access log. Errors are mailed as digests: the first error is sent
+# right away, the errors after it are counted per location in the code and
+# sent together at most once per LOG_MAIL_INTERVAL seconds.
+
+# Attributes every LogRecord has, other attributes are passed with extra={}
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message'}
+
+
+# Returns the id of the current request, taken from the X-Request-ID header
+# or generated
+def get_request_id():
+    if not has_request_context():
+        return None
+    if 'request_id' not in g:
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    return g.request_id
+
+
+# Adds the request id to records in the thread that logs them, as it can't be
+# retrieved in the listener thread. Records logged after the request (e.g.,
+# by profiling.init_profiling) can pass it with extra={}.
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        if getattr(record, 'request_id', None) is None:
+            record.request_id = get_request_id()
+        return True
+
+
+# Keeps the message and the traceback of a record apart when it is put on
+# the queue, instead of combining them into one string
+class StructuredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(
+                record.created, timezone.utc
+            ).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'location': '%s:%s' % (record.pathname, record.lineno),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key not in data:
+                data[key] = value
+        return json.dumps(data, default=str)
+
+
+# Mails error records as digests, see the top of this file. send(subject,
+# body) sends a digest.
+class DigestMailHandler(logging.Handler):
+    def __init__(self, send, interval=600):
+        super().__init__(logging.ERROR)
+        self.send = send
+        self.interval = interval
+        # (logger, location) -> [count, first record]
+        self.pending = OrderedDict()
+        self.last_sent = None
+        self.timer = None
+
+    def emit(self, record):
+        key = (record.name, record.pathname, record.lineno)
+        with self.lock:
+            if key in self.pending:
+                self.pending[key][0] += 1
+            else:
+                self.pending[key] = [1, record]
+            if self.timer is None:
+                delay = 0
+                if self.last_sent is not None:
+                    delay = max(
+                        0, self.last_sent + self.interval - time.monotonic()
+                    )
+                self.timer = threading.Timer(delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            pending = self.pending
+            self.pending = OrderedDict()
+            if not pending:
+                return
+            self.last_sent = time.monotonic()
+
+        count = sum(x[0] for x in pending.values())
+        parts = []
+        for repeated, record in pending.values():
+            part = '%sx %s' % (repeated, self.format(record))
+            if record.exc_text:
+                part += '\n' + record.exc_text
+            parts.append(part)
+        try:
+            self.send(
+                '%s error(s) at %s different location(s)' % (
+                    count, len(pending)
+                ),
+                '\n\n'.join(parts)
+            )
+        except Exception:
+            self.handleError(list(pending.values())[0][1])
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+# Returns a function that sends an email with the mail settings of the app
+def get_mail_sender(app):
+    def send(subject, body):
+        message = EmailMessage()
+        message['Subject'] = '[Open Poen %s] %s' % (
+            app.config['VERSION'], subject
+        )
+        message['From'] = app.config['FROM']
+        message['To'] = ', '.join(app.config['ADMINS'])
+        message.set_content(body)
+        with smtplib.SMTP(
+            app.config['MAIL_SERVER'], app.config['MAIL_PORT'] or 0,
+            timeout=30
+        ) as smtp:
+            if app.config['MAIL_USE_TLS']:
+                smtp.starttls()
+            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+                smtp.login(
+                    app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD']
+                )
+            smtp.send_message(message)
+    return send
+
+
+# Route the records of app.logger through a queue to the log file and (in
+# production) the error mails
+def init_logging(app, path):
+    file_handler = RotatingFileHandler(
+        path,
+        maxBytes=1000000,
+        backupCount=10
+    )
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+
+    if not app.debug and app.config['MAIL_SERVER']:
+        mail_handler = DigestMailHandler(
+            get_mail_sender(app), app.config.get('LOG_MAIL_INTERVAL', 600)
+        )
+        mail_handler.setFormatter(
+            logging.Formatter(
+                '%(asctime)s %(levelname)s: %(message)s '
+                '[in %(pathname)s:%(lineno)d, request %(request_id)s]'
+            )
+        )
+        handlers.append(mail_handler)
+
+    log_queue = queue.Queue(-1)
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    app.logger.addHandler(queue_handler)
+    if app.debug:
+        app.logger.setLevel(logging.DEBUG)
+    else:
+        app.logger.setLevel(logging.INFO)
+
+    # Each handler gets the records of its own level and up
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    # Write and mail the remaining records on exit
+    def stop():
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+    atexit.register(stop)
+
+    @app.after_request
+    def add_request_id(response):
+        response.headers['X-Request-ID'] = get_request_id()
+        return response
+
+    return listener
@@ -1,9 +1,12 @@
-from app import app, db, login_manager
+from app import app, db, formatting, login_manager
+from flask import session, url_for
 from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Query, Session
 from werkzeug.security import generate_password_hash, check_password_hash
 from time import time
 import jwt
-import locale
+import os
 
 
 # Association table between Project and User
@@ -122,6 +125,16 @@ class User(UserMixin, db.Model):
     hidden = db.Column(db.Boolean, default=False)
     active = db.Column(db.Boolean, default=True)
     image = db.Column(db.Integer, db.ForeignKey('file.id', ondelete='SET NULL'))
+    # Bumped when the admin flag or the (sub)projects of the user change, see
+    # mark_permissions_changed
+    permissions_version = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False
+    )
+    # Bumped when the fields stored in the session of the user change, see
+    # SessionUser
+    session_version = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False
+    )
 
     debit_cards = db.relationship('DebitCard', backref='user', lazy='dynamic')
     payments = db.relationship('Payment', backref='user', lazy='dynamic')
@@ -136,6 +149,11 @@ class User(UserMixin, db.Model):
             )
         self.password_hash = generate_password_hash(password)
 
+    # Invited users can't log in until they choose a password via their
+    # invitation; check_password_hash rejects any password for this hash
+    def set_unusable_password(self):
+        self.password_hash = '!'
+
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
@@ -177,6 +195,9 @@ class Project(db.Model):
     hidden = db.Column(db.Boolean, default=False)
     hidden_sponsors = db.Column(db.Boolean, default=False)
     budget = db.Column(db.Integer)
+    # Bumped on every change shown on the project page, see mark_changed
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    modified = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
 
     subprojects = db.relationship(
         'Subproject',
@@ -204,6 +225,12 @@ class Project(db.Model):
         lazy='dynamic'
     )
     categories = db.relationship('Category', backref='project', lazy='dynamic')
+    categorization_rules = db.relationship(
+        'CategorizationRule',
+        backref='project',
+        lazy='dynamic',
+        order_by='CategorizationRule.id.asc()'
+    )
 
     def set_bank_name(self, bank_name):
         self.bank_name = bank_name
@@ -249,6 +276,9 @@ class Subproject(db.Model):
     description = db.Column(db.Text)
     hidden = db.Column(db.Boolean, default=False)
     budget = db.Column(db.Integer)
+    # Bumped on every change shown on the subproject page, see mark_changed
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    modified = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
 
     users = db.relationship(
         'User',
@@ -268,6 +298,12 @@ class Subproject(db.Model):
         lazy='dynamic'
     )
     categories = db.relationship('Category', backref='subproject', lazy='dynamic')
+    categorization_rules = db.relationship(
+        'CategorizationRule',
+        backref='subproject',
+        lazy='dynamic',
+        order_by='CategorizationRule.id.asc()'
+    )
 
     # Subproject names must be unique within a project
     __table_args__ = (
@@ -345,11 +381,15 @@ class Payment(db.Model):
     updated = db.Column(db.DateTime(timezone=True))
     monetary_account_id = db.Column(db.Integer(), index=True)
     sub_type = db.Column(db.String(12))
-    # Currently 'MANUAL' or types coming from BUNQ, e.g., 'BUNQ', 'IDEAL',
-    # 'MASTERCARD', 'EBA_SCT', 'INTEREST', 'BUNQME', 'PAYMENT_ALLOCATE'
+    # Currently 'MANUAL', 'IMPORT' (imported from a bank statement) or types
+    # coming from BUNQ, e.g., 'BUNQ', 'IDEAL', 'MASTERCARD', 'EBA_SCT',
+    # 'INTEREST', 'BUNQME', 'PAYMENT_ALLOCATE'
     type = db.Column(db.String(20))
     # Can be 'inbesteding', 'uitgaven' or 'inkomsten'
     route = db.Column(db.String(12))
+    # Hash identifying payments imported from a bank statement, used to skip
+    # payments that were already imported
+    import_key = db.Column(db.String(64), unique=True)
 
     # Fields coming from the user
     short_user_description = db.Column(db.String(50))
@@ -360,35 +400,63 @@ class Payment(db.Model):
     # not implemented
     flag_suspicious_count = db.Column(db.Integer)
 
+    # Not a dynamic relationship, so the attachments of a payment table can be
+    # loaded with selectinload, see routes.load_payments
     attachments = db.relationship(
         'File',
-        secondary=payment_attachment,
-        lazy='dynamic'
+        secondary=payment_attachment
+    )
+
+    # Used to walk the ledger of a monetary account in order, see
+    # util.get_balance_gaps
+    __table_args__ = (
+        db.Index(
+            'ix_payment_monetary_account_id_bank_payment_id',
+            'monetary_account_id',
+            'bank_payment_id'
+        ),
     )
 
     def get_formatted_currency(self):
-        return locale.format(
-            "%.2f", self.amount_value, grouping=True, monetary=True
-        )
+        return formatting.format_amount(self.amount_value)
 
     def get_formatted_balance(self):
         return_value = ''
         # Manually added payments don't have the balance_after_mutation_value
         # field
         if not self.balance_after_mutation_value == None:
-            return_value = locale.format(
-                "%.2f",
-                self.balance_after_mutation_value,
-                grouping=True,
-                monetary=True
+            return_value = formatting.format_amount(
+                self.balance_after_mutation_value
             )
         return return_value
-    
+
     def get_export_currency(self):
-        return self.get_formatted_currency().replace("\u202f", "")
+        return formatting.format_export_amount(self.amount_value)
 
     def get_export_balance(self):
-        return self.get_formatted_balance().replace("\u202f", "")
+        if self.balance_after_mutation_value == None:
+            return ''
+        return formatting.format_export_amount(
+            self.balance_after_mutation_value
+        )
+
+    # The values shown in the edit payment modal, see
+    # form_processing.create_payment_edit_form
+    def get_edit_data(self):
+        return {
+            'id': self.id,
+            'manual': self.type == 'MANUAL',
+            'created': self.created.strftime('%d-%m-%Y') if self.created else '',
+            'amount_value': formatting.format_export_amount(self.amount_value),
+            'route': self.route,
+            'category_id': str(self.category_id or ''),
+            # Key of the category choices, see
+            # form_processing.get_payment_category_choices
+            'categories': str(self.subproject_id or ''),
+            'short_user_description': self.short_user_description or '',
+            'long_user_description': self.long_user_description or '',
+            'hidden': bool(self.hidden)
+        }
 
 
 class Funder(db.Model):
@@ -427,11 +495,52 @@ class UserStory(db.Model):
     )
 
 
+# Filename of a resized variant of an uploaded image, see app/images.py
+def get_variant_filename(filename, width, extension):
+    return '%s_%sw.%s' % (os.path.splitext(filename)[0], width, extension)
+
+
+# The content of uploaded files, stored once under its SHA-256, see
+# app/storage.py
+class Blob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), index=True, unique=True)
+    size = db.Column(db.BigInteger)
+    # Number of Files referring to this blob
+    reference_count = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False
+    )
+
+
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), index=True)
     mimetype = db.Column(db.String(255))
     mediatype = db.Column(db.String(32))
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'))
+    blob = db.relationship('Blob')
+    # Widths of the resized variants of an image, set once they are created
+    variants = db.Column(db.JSON)
+    # Files that nothing refers to are only deleted some time after they
+    # were created, see app/garbage_collection.py
+    created = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+
+    # Returns the srcset attribute value of the variants with the given
+    # extension, e.g., 'webp' or 'jpg'
+    def get_srcset(self, folder, extension):
+        return ', '.join(
+            '%s %sw' % (
+                url_for(
+                    'upload',
+                    filename='%s/%s' % (
+                        folder,
+                        get_variant_filename(self.filename, width, extension)
+                    )
+                ),
+                width
+            )
+            for width in self.variants or []
+        )
 
 
 class Category(db.Model):
@@ -451,6 +560,356 @@ class Category(db.Model):
     )
 
 
+
+# Rule to automatically categorize payments of a (sub)project, see
+# app/categorization.py. All conditions that are filled in must match:
+# counterparty IBAN (exact), counterparty name and description (case
+# insensitive substring) and the amount range (inclusive).
+class CategorizationRule(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    subproject_id = db.Column(
+        db.Integer, db.ForeignKey('subproject.id', ondelete='CASCADE'),
+        index=True
+    )
+    project_id = db.Column(
+        db.Integer, db.ForeignKey('project.id', ondelete='CASCADE'),
+        index=True
+    )
+    counterparty_iban = db.Column(db.String(34))
+    counterparty_name = db.Column(db.String(120))
+    description = db.Column(db.String(120))
+    amount_min = db.Column(db.Float())
+    amount_max = db.Column(db.Float())
+
+    # What to assign to a matching payment
+    category_id = db.Column(
+        db.Integer, db.ForeignKey('category.id', ondelete='CASCADE')
+    )
+    route = db.Column(db.String(12))
+
+    category = db.relationship('Category')
+
+    # Short human readable summary of the conditions of this rule
+    def describe(self):
+        conditions = []
+        if self.counterparty_iban:
+            conditions.append('IBAN %s' % self.counterparty_iban)
+        if self.counterparty_name:
+            conditions.append('naam bevat "%s"' % self.counterparty_name)
+        if self.description:
+            conditions.append('omschrijving bevat "%s"' % self.description)
+        if self.amount_min is not None:
+            conditions.append('bedrag vanaf %s' % self.amount_min)
+        if self.amount_max is not None:
+            conditions.append('bedrag tot en met %s' % self.amount_max)
+        return ', '.join(conditions)
+
+
+# Transactional email waiting to be delivered by the outbox worker, see
+# app/outbox.py. Messages are added in the same transaction as the change
+# they are about (e.g., an invited user), so either both or neither are
+# saved.
+class OutboxMessage(db.Model):
+    __tablename__ = 'outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    sender = db.Column(db.String(120))
+    recipients = db.Column(db.JSON)
+    text_body = db.Column(db.Text)
+    html_body = db.Column(db.Text)
+    created = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    # Failed deliveries are retried after an increasing delay
+    send_after = db.Column(
+        db.DateTime(timezone=True), server_default=db.func.now(), index=True
+    )
+    attempts = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    last_error = db.Column(db.Text)
+    sent = db.Column(db.DateTime(timezone=True), index=True)
+
+
+# Register (sub)projects of which the shown data is changed in this
+# session. Their version is bumped when the session is committed. The
+# versions are used to validate cached public pages (ETag/Last-Modified).
+def mark_changed(session, project_ids=(), subproject_ids=()):
+    changed = session.info.setdefault('changed_versions', (set(), set()))
+    changed[0].update(x for x in project_ids if x)
+    changed[1].update(x for x in subproject_ids if x)
+
+
+# Returns the current and previous values of the (sub)project columns of a
+# changed object
+def _get_changed_ids(obj):
+    if isinstance(obj, Project):
+        return [obj.id], []
+    if isinstance(obj, Subproject):
+        return [obj.project_id], [obj.id]
+    if not isinstance(obj, (Payment, Category, Funder, IBAN)):
+        return [], []
+
+    state = inspect(obj)
+    ids = {}
+    for name in ['project_id', 'subproject_id']:
+        ids[name] = []
+        if name in state.attrs:
+            history = state.attrs[name].history
+            ids[name] = list(history.added or history.unchanged or [])
+            ids[name] += list(history.deleted or [])
+    return ids['project_id'], ids['subproject_id']
+
+
+# Register users of which the admin flag or (sub)projects are changed in
+# this session. Their permissions_version is bumped when the session is
+# committed, which invalidates the permissions cached in their session (see
+# permissions.get_permissions).
+def mark_permissions_changed(session, user_ids):
+    changed = session.info.setdefault('changed_permissions', set())
+    changed.update(x for x in user_ids if x)
+
+
+# Register users of which the fields stored in their session (see
+# SessionUser) are changed in this session. Their session_version is bumped
+# when the session is committed.
+def mark_user_changed(session, user_ids):
+    changed = session.info.setdefault('changed_users', set())
+    changed.update(x for x in user_ids if x)
+
+
+# Returns the ids of the users of which the permissions are changed by the
+# given (new, dirty or deleted) object
+def _get_changed_user_ids(obj, deleted=False):
+    state = inspect(obj)
+    if isinstance(obj, User):
+        for name in ['admin', 'projects', 'subprojects']:
+            if state.attrs[name].history.has_changes():
+                return [obj.id]
+    elif isinstance(obj, (Project, Subproject)):
+        if deleted:
+            return [x[0] for x in obj.users.with_entities(User.id)]
+        history = state.attrs.users.history
+        return [
+            x.id for x in list(history.added or []) + list(history.deleted or [])
+        ]
+    return []
+
+
+@event.listens_for(Session, 'before_flush')
+def _mark_flushed_changes(session, flush_context, instances):
+    for obj in list(session.new) + list(session.deleted):
+        mark_changed(session, *_get_changed_ids(obj))
+    for obj in session.deleted:
+        mark_permissions_changed(
+            session, _get_changed_user_ids(obj, deleted=True)
+        )
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            mark_changed(session, *_get_changed_ids(obj))
+            mark_permissions_changed(session, _get_changed_user_ids(obj))
+            if isinstance(obj, User) and any(
+                inspect(obj).attrs[name].history.has_changes()
+                for name in SessionUser.FIELDS
+            ):
+                mark_user_changed(session, [obj.id])
+
+
+# Query.update() and Query.delete() bypass the flush, so retrieve the
+# (sub)projects of the matched rows before the query is executed
+def _mark_bulk_changes(query, context):
+    model = context.mapper.class_
+    if model is Project:
+        mark_changed(
+            query.session, project_ids=[x[0] for x in query.with_entities(Project.id)]
+        )
+    elif model is Subproject:
+        rows = query.with_entities(Subproject.project_id, Subproject.id).all()
+        mark_changed(
+            query.session, [x[0] for x in rows], [x[1] for x in rows]
+        )
+    elif model in [Payment, Category, Funder, IBAN]:
+        columns = [model.project_id]
+        if hasattr(model, 'subproject_id'):
+            columns.append(model.subproject_id)
+        rows = query.with_entities(*columns).distinct().all()
+        mark_changed(
+            query.session,
+            [x[0] for x in rows],
+            [x[1] for x in rows if len(x) > 1]
+        )
+        # The query can also move rows to another (sub)project
+        values = {
+            getattr(key, 'key', key): value
+            for key, value in getattr(context, 'values', {}).items()
+        }
+        mark_changed(
+            query.session,
+            [values.get('project_id')],
+            [values.get('subproject_id')]
+        )
+    elif model is File:
+        file_ids = query.with_entities(File.id).subquery()
+        _mark_file_changes(query.session, file_ids)
+    elif model is User:
+        user_ids = [x[0] for x in query.with_entities(User.id)]
+        mark_permissions_changed(query.session, user_ids)
+        mark_user_changed(query.session, user_ids)
+
+
+# Images and attachments are linked to (sub)projects, funders and payments
+def _mark_file_changes(session, file_ids):
+    payments = session.query(Payment.project_id, Payment.subproject_id).join(
+        payment_attachment, payment_attachment.c.payment_id == Payment.id
+    ).filter(payment_attachment.c.file_id.in_(file_ids)).distinct().all()
+    mark_changed(
+        session, [x[0] for x in payments], [x[1] for x in payments]
+    )
+    mark_changed(session, project_ids=[
+        x[0] for x in session.query(project_image.c.project_id).filter(
+            project_image.c.file_id.in_(file_ids)
+        )
+    ] + [
+        x[0] for x in session.query(Funder.project_id).join(
+            funder_image, funder_image.c.funder_id == Funder.id
+        ).filter(funder_image.c.file_id.in_(file_ids))
+    ])
+    mark_changed(session, subproject_ids=[
+        x[0] for x in session.query(subproject_image.c.subproject_id).filter(
+            subproject_image.c.file_id.in_(file_ids)
+        )
+    ])
+
+
+event.listen(Query, 'before_compile_update', _mark_bulk_changes)
+event.listen(Query, 'before_compile_delete', _mark_bulk_changes)
+
+
+# Deleted Files no longer refer to their blob. Files are only deleted with
+# Query.delete(), so the reference counts are updated before it is executed.
+def _release_blobs(query, context):
+    if context.mapper.class_ is not File:
+        return
+    rows = query.with_entities(File.blob_id, db.func.count(File.id)).filter(
+        File.blob_id.isnot(None)
+    ).group_by(File.blob_id).all()
+    for blob_id, count in rows:
+        query.session.execute(
+            Blob.__table__.update().where(Blob.id == blob_id).values(
+                reference_count=Blob.reference_count - count
+            )
+        )
+
+
+event.listen(Query, 'before_compile_delete', _release_blobs)
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_versions(session):
+    # Flush first, as the flush can register more changes
+    session.flush()
+    project_ids, subproject_ids = session.info.pop(
+        'changed_versions', (set(), set())
+    )
+    if subproject_ids:
+        session.execute(
+            Subproject.__table__.update().where(
+                Subproject.__table__.c.id.in_(subproject_ids)
+            ).values(
+                version=Subproject.__table__.c.version + 1,
+                modified=db.func.now()
+            )
+        )
+        # The project page also shows the payments of its subprojects
+        project_ids.update(
+            x[0] for x in session.query(Subproject.project_id).filter(
+                Subproject.id.in_(subproject_ids)
+            )
+        )
+    if project_ids:
+        session.execute(
+            Project.__table__.update().where(
+                Project.__table__.c.id.in_(project_ids)
+            ).values(
+                version=Project.__table__.c.version + 1,
+                modified=db.func.now()
+            )
+        )
+
+    user_ids = session.info.pop('changed_permissions', set())
+    if user_ids:
+        session.execute(
+            User.__table__.update().where(
+                User.__table__.c.id.in_(user_ids)
+            ).values(
+                permissions_version=User.__table__.c.permissions_version + 1
+            )
+        )
+
+    user_ids = session.info.pop('changed_users', set())
+    if user_ids:
+        session.execute(
+            User.__table__.update().where(
+                User.__table__.c.id.in_(user_ids)
+            ).values(session_version=User.__table__.c.session_version + 1)
+        )
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_versions(session):
+    session.info.pop('changed_versions', None)
+    session.info.pop('changed_permissions', None)
+    session.info.pop('changed_users', None)
+
+
+# The logged in user as stored in the (signed) session cookie, so the user
+# doesn't have to be loaded from the database on every request. Only its
+# session_version and permissions_version are retrieved to check that the
+# snapshot is still valid. Other attributes are retrieved from the User,
+# which is loaded when one is first used.
+class SessionUser(UserMixin):
+    # Fields used by every request, see before_request and base.html
+    FIELDS = ['active', 'admin', 'first_name', 'last_name', 'biography']
+
+    def __init__(self, snapshot, permissions_version):
+        self.id = snapshot['id']
+        self.session_version = snapshot['version']
+        self.permissions_version = permissions_version
+        for name in self.FIELDS:
+            setattr(self, name, snapshot[name])
+        self._user = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return getattr(self._user, name)
+
+    def is_active(self):
+        return self.active
+
+    @staticmethod
+    def get_snapshot(user):
+        snapshot = {name: getattr(user, name) for name in SessionUser.FIELDS}
+        snapshot.update(id=user.id, version=user.session_version)
+        return snapshot
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    versions = db.session.query(
+        User.session_version, User.permissions_version
+    ).filter(User.id == user_id).first()
+    if versions is None:
+        return None
+
+    snapshot = session.get('user')
+    if (
+        snapshot
+        and snapshot.get('id') == user_id
+        and snapshot.get('version') == versions.session_version
+    ):
+        return SessionUser(snapshot, versions.permissions_version)
+
+    user = User.query.get(user_id)
+    session['user'] = SessionUser.get_snapshot(user)
+    return user
@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta, timezone
+import time
+
+from flask_mail import Message
+
+from app import app, db, mail
+from app.models import OutboxMessage
+
+
+# Transactional email (invitations and password resets) is not sent from the
+# request that causes it, as a slow mail server would make the page slow.
+# email.send_email adds an OutboxMessage instead and the outbox worker
+# (`flask outbox deliver --watch`, see docker-compose.yml) delivers the due
+# messages in batches over a single SMTP connection. Failed messages are
+# retried with an exponential backoff.
+
+BATCH_SIZE = 50
+
+# Seconds the worker waits before checking the outbox again when it is empty
+POLL_INTERVAL = 5
+
+# Messages are given up after this many failed attempts
+MAX_ATTEMPTS = 8
+
+# Delay before retrying a failed message, doubled after each attempt
+RETRY_DELAY = timedelta(minutes=1)
+
+# Delivered messages are kept this long for `flask outbox status`
+KEEP_SENT = timedelta(days=7)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _get_due_messages(batch_size):
+    # Skip the messages another worker is delivering
+    return OutboxMessage.query.filter(
+        OutboxMessage.sent.is_(None),
+        OutboxMessage.attempts < MAX_ATTEMPTS,
+        OutboxMessage.send_after <= db.func.now()
+    ).order_by(OutboxMessage.send_after).limit(batch_size).with_for_update(
+        skip_locked=True
+    ).all()
+
+
+def _to_mail_message(message):
+    msg = Message(
+        message.subject, sender=message.sender, recipients=message.recipients
+    )
+    msg.body = message.text_body
+    msg.html = message.html_body
+    return msg
+
+
+def _retry_later(message, error):
+    message.attempts += 1
+    message.last_error = repr(error)
+    message.send_after = _now() + RETRY_DELAY * 2 ** (message.attempts - 1)
+    if message.attempts >= MAX_ATTEMPTS:
+        app.logger.error(
+            'Giving up on email %s to %s: %r' % (
+                message.id, ', '.join(message.recipients or []), error
+            )
+        )
+
+
+# Deliver a batch of due messages over one SMTP connection. Returns the
+# number of messages sent and failed.
+def deliver(batch_size=BATCH_SIZE):
+    messages = _get_due_messages(batch_size)
+    sent = failed = 0
+    if messages:
+        attempted = set()
+        try:
+            with mail.connect() as connection:
+                for message in messages:
+                    attempted.add(message.id)
+                    try:
+                        connection.send(_to_mail_message(message))
+                    except Exception as e:
+                        _retry_later(message, e)
+                        failed += 1
+                    else:
+                        message.sent = _now()
+                        sent += 1
+        except Exception as e:
+            # Connecting to (or disconnecting from) the mail server failed
+            app.logger.warning('Delivering email failed: %r' % (e))
+            for message in messages:
+                if message.id not in attempted:
+                    _retry_later(message, e)
+                    failed += 1
+        db.session.commit()
+
+    OutboxMessage.query.filter(
+        OutboxMessage.sent < _now() - KEEP_SENT
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return sent, failed
+
+
+# Keep delivering messages as they are added
+def deliver_forever(batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL):
+    while True:
+        try:
+            sent, failed = deliver(batch_size)
+        except Exception:
+            app.logger.exception('Delivering the outbox failed')
+            db.session.rollback()
+            sent = failed = 0
+        finally:
+            db.session.remove()
+        if sent + failed < batch_size:
+            time.sleep(poll_interval)
+
+
+# Returns the number of queued and failed messages, the age of the oldest
+# queued message and the number and average and maximum delivery latency of
+# the messages sent in the last hour
+def get_status():
+    queued = OutboxMessage.query.filter(
+        OutboxMessage.sent.is_(None), OutboxMessage.attempts < MAX_ATTEMPTS
+    )
+    oldest = queued.with_entities(db.func.min(OutboxMessage.created)).scalar()
+    now = _now()
+    if oldest is not None and oldest.tzinfo is None:
+        # SQLite doesn't store time zones, its timestamps are in UTC
+        now = now.replace(tzinfo=None)
+    latencies = [
+        sent - created
+        for created, sent in db.session.query(
+            OutboxMessage.created, OutboxMessage.sent
+        ).filter(OutboxMessage.sent >= _now() - timedelta(hours=1))
+    ]
+    return {
+        'queued': queued.count(),
+        'failed': OutboxMessage.query.filter(
+            OutboxMessage.sent.is_(None),
+            OutboxMessage.attempts >= MAX_ATTEMPTS
+        ).count(),
+        'oldest_queued': now - oldest if oldest is not None else None,
+        'sent_last_hour': len(latencies),
+        'average_latency': (
+            sum(latencies, timedelta()) / len(latencies) if latencies else None
+        ),
+        'max_latency': max(latencies) if latencies else None,
+    }
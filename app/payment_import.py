@@ -0,0 +1,374 @@
+from datetime import datetime, timedelta
+from xml.etree.ElementTree import iterparse
+import codecs
+import csv
+import os
+import zipfile
+
+from app import app, db, images, storage
+from app.forms import allowed_extensions
+from app.models import Category, Payment, payment_attachment
+from app.statements import parse_amount, parse_date
+
+
+# Bulk import of manual payments from a spreadsheet (CSV or XLSX), with an
+# optional zip archive containing the attachments (e.g., receipts) referred
+# to in the spreadsheet. All rows are validated before anything is saved.
+
+# Number of payments (and their attachments) flushed per batch; they are
+# committed together at the end
+BATCH_SIZE = 500
+
+# Columns of the spreadsheet, mapped to Payment columns. Only 'datum' and
+# 'bedrag' are required.
+COLUMNS = {
+    'datum': 'created',
+    'bedrag': 'amount_value',
+    'route': 'route',
+    'categorie': 'category',
+    'activiteit': 'subproject',
+    'verstuurder naam': 'alias_name',
+    'verstuurder iban': 'alias_value',
+    'ontvanger naam': 'counterparty_alias_name',
+    'ontvanger iban': 'counterparty_alias_value',
+    'korte beschrijving': 'short_user_description',
+    'lange beschrijving': 'long_user_description',
+    'verbergen': 'hidden',
+    'bestand': 'attachment',
+    'media type': 'mediatype'
+}
+
+# Maximum lengths of the text columns, the same as in NewPaymentForm
+MAX_LENGTHS = {
+    'alias_name': 120,
+    'alias_value': 120,
+    'counterparty_alias_name': 120,
+    'counterparty_alias_value': 120,
+    'short_user_description': 50,
+    'long_user_description': 2000
+}
+
+ROUTES = ['inkomsten', 'inbesteding', 'uitgaven']
+
+# Larger numbers aren't spreadsheet serial dates (see
+# _parse_spreadsheet_date) but dates like 20210105; 100000 is in 2173
+MAX_SERIAL_DATE = 100000
+
+# Only show this many errors, the spreadsheet needs to be fixed anyway
+MAX_ERRORS = 10
+
+
+class PaymentImportError(Exception):
+    def __init__(self, errors):
+        super(PaymentImportError, self).__init__('; '.join(errors))
+        self.errors = errors
+
+
+def _read_csv(stream):
+    stream = codecs.getreader('utf-8-sig')(stream, errors='replace')
+    header = stream.readline()
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    yield next(csv.reader([header], dialect))
+    for row in csv.reader(stream, dialect):
+        yield row
+
+
+# Read the rows of the first worksheet of an XLSX file. Both the shared
+# strings and the worksheet are parsed iteratively.
+def _read_xlsx(stream):
+    def tag(element):
+        return element.tag.rsplit('}', 1)[-1]
+
+    with zipfile.ZipFile(stream) as xlsx:
+        shared_strings = []
+        if 'xl/sharedStrings.xml' in xlsx.namelist():
+            with xlsx.open('xl/sharedStrings.xml') as f:
+                for event, element in iterparse(f):
+                    if tag(element) == 'si':
+                        shared_strings.append(
+                            ''.join(
+                                x.text or '' for x in element.iter()
+                                if tag(x) == 't'
+                            )
+                        )
+                        element.clear()
+
+        with xlsx.open('xl/worksheets/sheet1.xml') as f:
+            for event, element in iterparse(f):
+                if tag(element) != 'row':
+                    continue
+
+                row = []
+                for cell in element:
+                    # Cell references look like 'C12'; fill skipped cells
+                    column = 0
+                    for char in cell.get('r', ''):
+                        if not char.isalpha():
+                            break
+                        column = column * 26 + ord(char.upper()) - 64
+                    while column and len(row) < column - 1:
+                        row.append('')
+
+                    value = ''
+                    if cell.get('t') == 'inlineStr':
+                        value = ''.join(
+                            x.text or '' for x in cell.iter() if tag(x) == 't'
+                        )
+                    else:
+                        for child in cell:
+                            if tag(child) == 'v' and child.text is not None:
+                                value = child.text
+                        if cell.get('t') == 's' and value:
+                            value = shared_strings[int(value)]
+                    row.append(value)
+                element.clear()
+                yield row
+
+
+def _read_rows(stream, filename):
+    if filename.lower().endswith('.xlsx'):
+        rows = _read_xlsx(stream)
+    else:
+        rows = _read_csv(stream)
+
+    header = [x.strip().lower() for x in next(rows, [])]
+    # Rows start at 2 as the first row is the header
+    for row_number, row in enumerate(rows, 2):
+        if not any(x.strip() for x in row):
+            continue
+        yield row_number, {
+            COLUMNS[name]: value.strip()
+            for name, value in zip(header, row)
+            if name in COLUMNS
+        }
+
+
+# Dates in XLSX files are often stored as the number of days since
+# 1899-12-30
+def _parse_spreadsheet_date(value):
+    try:
+        days = float(value)
+    except ValueError:
+        days = None
+    if days is not None and 0 <= days < MAX_SERIAL_DATE:
+        return app.config['TZ'].localize(
+            datetime(1899, 12, 30) + timedelta(days=days)
+        )
+    return parse_date(
+        value, formats=('%d-%m-%Y', '%Y-%m-%d', '%d/%m/%Y', '%Y%m%d')
+    )
+
+
+def _find_attachment(archive_members, name):
+    return archive_members.get(name) or archive_members.get(
+        os.path.basename(name)
+    )
+
+
+# Validate all rows and return the payments to save. Raises a
+# PaymentImportError containing the errors found.
+def validate_payments(rows, project, subproject=None, archive_members=None):
+    # Categories and subprojects can be referred to by name
+    if subproject:
+        subprojects = {subproject.name.lower(): subproject.id}
+    elif project.contains_subprojects:
+        subprojects = {x.name.lower(): x.id for x in project.subprojects}
+    else:
+        subprojects = {}
+    categories = {}
+    for category in Category.query.filter(
+            db.or_(
+                Category.project_id == project.id,
+                Category.subproject_id.in_(list(subprojects.values()))
+            )):
+        scope = category.subproject_id or None
+        categories[(scope, category.name.lower())] = category.id
+
+    payments = []
+    errors = []
+    for row_number, row in rows:
+        row_errors = []
+        payment = {
+            'type': 'MANUAL',
+            'amount_currency': 'EUR',
+            'updated': datetime.now(),
+            'hidden': row.get('hidden', '').lower() in ['ja', 'j', '1', 'x'],
+            'project_id': None,
+            'subproject_id': None,
+            'category_id': None
+        }
+
+        try:
+            payment['created'] = _parse_spreadsheet_date(row.get('created', ''))
+        except (ValueError, OverflowError):
+            row_errors.append('ongeldige datum')
+
+        try:
+            payment['amount_value'] = parse_amount(row.get('amount_value', ''))
+        except ValueError:
+            row_errors.append('ongeldig bedrag')
+
+        for field, max_length in MAX_LENGTHS.items():
+            payment[field] = row.get(field) or None
+            if payment[field] and len(payment[field]) > max_length:
+                row_errors.append(
+                    'veld "%s" is langer dan %s tekens' % (
+                        field, max_length
+                    )
+                )
+
+        # A payment can only be linked to a project or a subproject
+        if subproject:
+            payment['subproject_id'] = subproject.id
+        elif project.contains_subprojects:
+            payment['subproject_id'] = subprojects.get(
+                row.get('subproject', '').lower()
+            )
+            if not payment['subproject_id']:
+                row_errors.append(
+                    'onbekende activiteit "%s"' % (row.get('subproject', ''))
+                )
+        else:
+            payment['project_id'] = project.id
+
+        if row.get('category'):
+            payment['category_id'] = categories.get(
+                (payment['subproject_id'], row['category'].lower())
+            )
+            if not payment['category_id']:
+                row_errors.append(
+                    'onbekende categorie "%s"' % (row['category'])
+                )
+
+        route = row.get('route', '').lower()
+        if route:
+            if route not in ROUTES:
+                row_errors.append('onbekende route "%s"' % (route))
+            payment['route'] = route
+        elif 'amount_value' in payment:
+            if payment['amount_value'] > 0:
+                payment['route'] = 'inkomsten'
+            else:
+                payment['route'] = 'uitgaven'
+
+        attachment = row.get('attachment')
+        mediatype = row.get('mediatype', '').lower() or 'bon'
+        if attachment:
+            member = None
+            if archive_members is not None:
+                member = _find_attachment(archive_members, attachment)
+            if not member:
+                row_errors.append(
+                    'bestand "%s" staat niet in het zip-bestand' % (attachment)
+                )
+            elif attachment.rsplit('.', 1)[-1].lower() not in allowed_extensions:
+                row_errors.append(
+                    'bestandstype van "%s" is niet toegestaan' % (attachment)
+                )
+            elif member.file_size > app.config['MAX_CONTENT_LENGTH']:
+                row_errors.append('bestand "%s" is te groot' % (attachment))
+            if mediatype not in ['bon', 'media']:
+                row_errors.append('onbekend media type "%s"' % (mediatype))
+
+        if row_errors:
+            errors.append('Rij %s: %s' % (row_number, ', '.join(row_errors)))
+            if len(errors) >= MAX_ERRORS:
+                break
+        else:
+            payments.append((payment, attachment, mediatype))
+
+    if errors:
+        raise PaymentImportError(errors)
+
+    return payments
+
+
+# Stream an attachment from the archive into the blob store
+def _save_archive_member(archive, member, mediatype):
+    with archive.open(member) as src:
+        return storage.create_file(
+            src, os.path.basename(member.filename), mediatype
+        )
+
+
+# Import manual payments from a spreadsheet and their attachments from a
+# zip archive. Returns the number of imported payments; raises a
+# PaymentImportError if any row is invalid, in which case nothing is saved.
+def import_manual_payments(payments_file, payments_filename, project,
+                           subproject=None, archive_file=None):
+    archive = None
+    archive_members = None
+    if archive_file:
+        archive = zipfile.ZipFile(archive_file)
+        archive_members = {}
+        for member in archive.infolist():
+            if member.filename.endswith('/'):
+                continue
+            archive_members[member.filename] = member
+            archive_members.setdefault(
+                os.path.basename(member.filename), member
+            )
+
+    try:
+        payments = validate_payments(
+            _read_rows(payments_file, payments_filename),
+            project,
+            subproject,
+            archive_members
+        )
+    except (ValueError, KeyError, SyntaxError, zipfile.BadZipFile):
+        raise PaymentImportError(['Het bestand kon niet worden ingelezen'])
+
+    # Attachments referred to by multiple payments are only stored once.
+    # Each payment gets its own File referring to the stored content, so
+    # removing the attachment from one payment doesn't remove it from the
+    # others.
+    saved_files = {}
+    try:
+        for start in range(0, len(payments), BATCH_SIZE):
+            batch = payments[start:start + BATCH_SIZE]
+            new_payments = [Payment(**x[0]) for x in batch]
+            db.session.add_all(new_payments)
+
+            new_files = []
+            for payment, attachment, mediatype in batch:
+                new_file = None
+                if attachment:
+                    member = _find_attachment(archive_members, attachment)
+                    key = (member.filename, mediatype)
+                    if key in saved_files:
+                        new_file = storage.copy_file(saved_files[key])
+                    else:
+                        new_file = _save_archive_member(
+                            archive, member, mediatype
+                        )
+                        saved_files[key] = new_file
+                    db.session.add(new_file)
+                new_files.append(new_file)
+            db.session.flush()
+
+            links = [
+                {'payment_id': new_payment.id, 'file_id': new_file.id}
+                for new_payment, new_file in zip(new_payments, new_files)
+                if new_file
+            ]
+            if links:
+                db.session.execute(payment_attachment.insert(), links)
+        db.session.commit()
+    except Exception:
+        # Stored attachments nothing refers to are removed by the garbage
+        # collector
+        db.session.rollback()
+        raise
+
+    # Files with the same content share the variants of their blob
+    for new_file in saved_files.values():
+        images.queue_variants(new_file)
+
+    if archive:
+        archive.close()
+
+    return len(payments)
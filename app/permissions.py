@@ -0,0 +1,141 @@
+from flask import g, session
+from flask_login import current_user
+from sqlalchemy import false, or_, true
+
+from app import db
+from app.models import (
+    Payment, Project, Subproject, project_user, subproject_user
+)
+
+
+# What the current user is allowed to do: whether the user is an admin, the
+# projects the user owns and the subprojects the user is part of. It is loaded
+# once per request (instead of a has_user COUNT query per (sub)project) and
+# cached in the session until the user's permissions_version is bumped, see
+# models.mark_permissions_changed.
+class Permissions:
+    def __init__(self, admin=False, project_ids=(), subprojects=()):
+        self.admin = admin
+        self.project_ids = frozenset(project_ids)
+        # Subproject id -> project id of the subprojects the user is part of
+        self.subprojects = dict(subprojects)
+
+    # An admin owns every project
+    def is_project_owner(self, project_id):
+        return self.admin or int(project_id) in self.project_ids
+
+    def is_subproject_user(self, subproject_id):
+        return int(subproject_id) in self.subprojects
+
+    # Project owners can edit all subprojects of their project, other users
+    # only the subprojects they are part of
+    def can_edit_subproject(self, subproject):
+        return (
+            self.is_project_owner(subproject.project_id)
+            or self.is_subproject_user(subproject.id)
+        )
+
+    # Returns the ids of the subprojects of the given project the user is part
+    # of
+    def get_subproject_ids(self, project_id):
+        return [
+            subproject_id
+            for subproject_id, subproject_project_id in self.subprojects.items()
+            if subproject_project_id == int(project_id)
+        ]
+
+    # The visible_* methods return SQL predicates which filter out the hidden
+    # rows the user isn't allowed to see, e.g.,
+    # Project.query.filter(permissions.visible_projects())
+    def visible_projects(self):
+        if self.admin:
+            return true()
+        return or_(Project.hidden.isnot(True), _in(Project.id, self.project_ids))
+
+    def visible_subprojects(self):
+        if self.admin:
+            return true()
+        return or_(
+            Subproject.hidden.isnot(True),
+            _in(Subproject.project_id, self.project_ids),
+            _in(Subproject.id, self.subprojects)
+        )
+
+    # Project owners see the hidden payments of their project and its
+    # subprojects, other users only those of the subprojects they are part of
+    def visible_payments(self):
+        if self.admin:
+            return true()
+        conditions = [
+            Payment.hidden.isnot(True),
+            _in(Payment.subproject_id, self.subprojects)
+        ]
+        if self.project_ids:
+            conditions += [
+                Payment.project_id.in_(list(self.project_ids)),
+                Payment.subproject_id.in_(
+                    db.session.query(Subproject.id).filter(
+                        Subproject.project_id.in_(list(self.project_ids))
+                    )
+                )
+            ]
+        return or_(*conditions)
+
+    def to_dict(self):
+        return {
+            'admin': self.admin,
+            'project_ids': sorted(self.project_ids),
+            'subprojects': sorted(self.subprojects.items())
+        }
+
+
+# Avoids comparing with an empty IN, which SQLAlchemy warns about
+def _in(column, ids):
+    if not ids:
+        return false()
+    return column.in_(list(ids))
+
+
+ANONYMOUS = Permissions()
+
+
+# Retrieve the permissions of a user from the database (two queries)
+def load_permissions(user):
+    project_ids = [
+        x[0] for x in db.session.query(project_user.c.project_id).filter(
+            project_user.c.user_id == user.id
+        )
+    ]
+    subprojects = db.session.query(Subproject.id, Subproject.project_id).join(
+        subproject_user, subproject_user.c.subproject_id == Subproject.id
+    ).filter(subproject_user.c.user_id == user.id).all()
+    return Permissions(bool(user.admin), project_ids, subprojects)
+
+
+# Returns the permissions of the current user. They are stored in the session
+# together with the user id and permissions_version they were loaded for.
+def get_permissions():
+    if 'permissions' in g:
+        return g.permissions
+
+    if not current_user.is_authenticated:
+        g.permissions = ANONYMOUS
+        return g.permissions
+
+    cached = session.get('permissions')
+    if (
+        cached
+        and cached.get('user_id') == current_user.id
+        and cached.get('version') == current_user.permissions_version
+    ):
+        g.permissions = Permissions(
+            cached['admin'], cached['project_ids'], cached['subprojects']
+        )
+    else:
+        g.permissions = load_permissions(current_user)
+        session['permissions'] = dict(
+            g.permissions.to_dict(),
+            user_id=current_user.id,
+            version=current_user.permissions_version
+        )
+    return g.permissions
@@ -0,0 +1,214 @@
+from collections import Counter
+from functools import wraps
+from time import perf_counter
+import random
+import re
+
+from flask import g, has_app_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.log import get_request_id
+
+
+# Opt-in profiling of requests (set PROFILING in config.py). A profiled
+# request counts and times its SQL queries and times the rendering of its
+# templates and the process_* form handlers it calls. The results are sent
+# in a Server-Timing header, which browsers show in their developer tools,
+# and logged as one line per request (a JSON object, see app/log.py) once the
+# response is sent. Streamed pages (see util.stream_template) are mostly
+# rendered after the headers are sent, so their header only covers the work
+# done before; the log line covers all of it. Durations overlap, e.g., the
+# queries run while rendering a template are counted in both.
+#
+# A statement repeated more than PROFILING_REPEATED_STATEMENTS times in one
+# request (with different parameters) usually means an N+1 query, e.g., a
+# relationship that is loaded per row of a table. These are logged as
+# warnings. Set PROFILING_SAMPLE_RATE below 1 to profile a fraction of the
+# requests in production.
+
+REPEATED_STATEMENTS = 10
+
+# Lists of bound parameters, e.g., '(?, ?, ?)' or '(%(id_1)s, %(id_2)s)' of
+# an IN clause, which differ in length between otherwise equal statements
+PARAMETER_LIST = re.compile(r'\(\s*(?:\?|%\(\w+\)s)(?:\s*,\s*(?:\?|%\(\w+\)s))*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+class Profile:
+    def __init__(self):
+        self.start = perf_counter()
+        # name -> [count, seconds]
+        self.timings = {}
+        # fingerprint -> count
+        self.statements = Counter()
+
+    def add(self, name, duration):
+        timing = self.timings.setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += duration
+
+    def add_query(self, statement, duration):
+        self.add('sql', duration)
+        self.statements[get_fingerprint(statement)] += 1
+
+    # Returns the statements repeated more than threshold times, most
+    # repeated first
+    def get_repeated_statements(self, threshold=REPEATED_STATEMENTS):
+        return [
+            (fingerprint, count)
+            for fingerprint, count in self.statements.most_common()
+            if count > threshold
+        ]
+
+    # Returns the value of the Server-Timing header
+    def get_server_timing(self):
+        metrics = []
+        for name, (count, seconds) in self.timings.items():
+            metric = '%s;dur=%.1f' % (name, seconds * 1000)
+            if name == 'sql':
+                metric += ';desc="%s queries"' % (count)
+            metrics.append(metric)
+        metrics.append(
+            'total;dur=%.1f' % ((perf_counter() - self.start) * 1000)
+        )
+        return ', '.join(metrics)
+
+    def to_dict(self):
+        return {
+            'total_ms': round((perf_counter() - self.start) * 1000, 1),
+            'queries': self.timings.get('sql', [0])[0],
+            'timings_ms': {
+                name: round(seconds * 1000, 1)
+                for name, (count, seconds) in self.timings.items()
+            },
+        }
+
+
+# Returns a statement without its parameters and with its whitespace
+# normalized, so executions of the same query have the same fingerprint
+def get_fingerprint(statement):
+    statement = PARAMETER_LIST.sub('(?)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+# Returns the profile of the current request, None if it isn't profiled
+def get_profile():
+    if not has_app_context():
+        return None
+    return g.get('profile')
+
+
+# Decorator which adds the duration of the calls to a function (e.g., a
+# form handler) to the profile of the current request
+def timed(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        profile = get_profile()
+        if profile is None:
+            return f(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            profile.add(f.__name__, perf_counter() - start)
+    return wrapper
+
+
+# Times both rendered (render_template) and streamed (util.stream_template)
+# templates
+class ProfiledTemplate(Template):
+    def render(self, *args, **kwargs):
+        profile = get_profile()
+        if profile is None:
+            return super().render(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            profile.add('render', perf_counter() - start)
+
+    def generate(self, *args, **kwargs):
+        profile = get_profile()
+        chunks = super().generate(*args, **kwargs)
+        if profile is None:
+            yield from chunks
+            return
+        while True:
+            start = perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                profile.add('render', perf_counter() - start)
+            yield chunk
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if get_profile() is not None:
+        conn.info.setdefault('profiling_start', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    profile = get_profile()
+    starts = conn.info.get('profiling_start')
+    if profile is not None and starts:
+        profile.add_query(statement, perf_counter() - starts.pop())
+
+
+def init_profiling(app):
+    app.jinja_env.template_class = ProfiledTemplate
+
+    # Registered before the other request handlers, so they are profiled too
+    @app.before_request
+    def start_profile():
+        if not app.config.get('PROFILING'):
+            return
+        if random.random() >= app.config.get('PROFILING_SAMPLE_RATE', 1):
+            return
+        g.profile = Profile()
+
+    @app.after_request
+    def add_server_timing(response):
+        profile = get_profile()
+        if profile is None:
+            return response
+        response.headers['Server-Timing'] = profile.get_server_timing()
+
+        # The request context is gone once a streamed response is sent, so
+        # retrieve what is logged now
+        data = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+        }
+        request_id = get_request_id()
+        threshold = app.config.get(
+            'PROFILING_REPEATED_STATEMENTS', REPEATED_STATEMENTS
+        )
+
+        def log_profile():
+            data.update(profile.to_dict())
+            repeated = profile.get_repeated_statements(threshold)
+            data['repeated_statements'] = dict(repeated)
+            app.logger.info(
+                'Profiled %s %s: %s ms, %s queries' % (
+                    data['method'], data['path'], data['total_ms'],
+                    data['queries']
+                ),
+                extra={'profile': data, 'request_id': request_id}
+            )
+            for fingerprint, count in repeated:
+                app.logger.warning(
+                    'Possible N+1 query, executed %s times by %s %s: %s' % (
+                        count, data['method'], data['path'], fingerprint
+                    ),
+                    extra={'request_id': request_id}
+                )
+
+        response.call_on_close(log_profile)
+        return response
@@ -6,35 +6,56 @@ from time import time
 import jwt
 from bunq.sdk.context.api_environment_type import ApiEnvironmentType
 from flask import (
+    Response,
+    abort,
+    escape,
     flash,
+    jsonify,
     redirect,
     render_template,
     request,
-    send_from_directory,
     session,
+    stream_with_context,
     url_for,
 )
 from flask_login import current_user, login_required, login_user, logout_user
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from sqlalchemy import or_
+from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
+from wtforms.validators import ValidationError
 
-from app import app, db, util
+from app import app, db, export, images, storage, util
 from app.email import send_password_reset_email
 from app.form_processing import (
+    create_categorization_rule_forms,
     create_edit_attachment_forms,
-    create_payment_forms,
+    create_payment_edit_form,
+    get_payment_category_choices,
+    link_attachment,
+    process_categorization_rule_form,
     process_category_form,
     process_edit_attachment_form,
+    process_import_payments_form,
+    process_import_statement_form,
+    process_payment_batch,
     process_payment_form,
+    process_payment_patch,
     process_transaction_attachment_form,
     save_attachment,
 )
 from app.forms import (
     AddUserForm,
+    AttachmentUploadForm,
+    BulkAddUserForm,
+    CategorizationRuleForm,
     CategoryForm,
     EditAdminForm,
     EditAttachmentForm,
     EditProfileForm,
+    ImportPaymentsForm,
+    ImportStatementForm,
     EditProjectOwnerForm,
     EditUserForm,
     FunderForm,
@@ -47,6 +68,7 @@ from app.forms import (
     SubprojectForm,
     TransactionAttachmentForm,
 )
+from app.permissions import ANONYMOUS, get_permissions
 from app.models import (
     IBAN,
     Category,
@@ -57,8 +79,15 @@ from app.models import (
     Subproject,
     User,
     UserStory,
+    get_variant_filename,
+    payment_attachment,
+    project_user,
+    subproject_user,
 )
 
+# Number of payments fetched at once while the payments are exported
+PAYMENTS_BATCH_SIZE = 500
+
 
 # Add 'Cache-Control': 'private' header if users are logged in
 @app.after_request
@@ -81,6 +110,8 @@ def before_request():
             "actief</span>"
         )
         logout_user()
+        session.pop("user", None)
+        session.pop("permissions", None)
         return redirect(url_for("index"))
 
     # If the current user has no first name, last name or biography then
@@ -98,6 +129,64 @@ def before_request():
             return redirect(url_for("profile_edit"))
 
 
+# Render the index page with the (admin) forms, which are only shown to
+# admins
+def render_index(modal_id=None, **forms):
+    # Calculate amounts awarded and spent
+    # total_awarded = all current project balances
+    #               + abs(all spent project amounts)
+    #               - all amounts received from own subprojects (in the
+    #                 case the didn't spend all their money and gave it
+    #                 back)
+    # total_spent = abs(all spend subproject amounts)
+    #             - all amounts paid back by suprojects to their project
+    total_awarded = 0
+    total_spent = 0
+    project_data = []
+    permissions = get_permissions()
+    # Retrieve data for each project the user is allowed to see
+    for project in Project.query.filter(permissions.visible_projects()):
+        project_owner = permissions.is_project_owner(project.id)
+
+        # Retrieve the amounts for this project
+        amounts = util.calculate_project_amounts(project.id)
+        # Use budget for the awarded amount if available
+        if project.budget:
+            total_awarded += project.budget
+        else:
+            total_awarded += amounts["awarded"]
+        total_spent += amounts["spent"]
+        budget = ""
+        if project.budget:
+            budget = util.format_currency(project.budget)
+
+        project_data.append(
+            {
+                "id": project.id,
+                "name": project.name,
+                "hidden": project.hidden,
+                "project_owner": project_owner,
+                "amounts": amounts,
+                "budget": budget,
+            }
+        )
+
+    return render_template(
+        "index.html",
+        background=app.config["BACKGROUND"],
+        use_square_borders=app.config["USE_SQUARE_BORDERS"],
+        tagline=app.config["TAGLINE"],
+        footer=app.config["FOOTER"],
+        project_data=project_data,
+        total_awarded_str=util.human_format(total_awarded),
+        total_spent_str=util.human_format(total_spent),
+        user_stories=UserStory.query.all(),
+        modal_id=json.dumps(modal_id),  # Does nothing if None. Loads the modal
+        # on page load if supplied.
+        **forms,
+    )
+
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     modal_id = None
@@ -106,6 +195,12 @@ def index():
     if request.args.get("state"):
         return util.process_bunq_oauth_callback(request, current_user)
 
+    # Anonymous visitors only get to see the projects, which can be cached
+    if request.method == "GET" and not current_user.is_authenticated:
+        return util.conditional_response(
+            request, *util.get_index_validators(), render_index
+        )
+
     # Process filled in edit admin form
     edit_admin_form = EditAdminForm(prefix="edit_admin_form")
 
@@ -197,66 +292,108 @@ def index():
         if len(project_form.errors) > 0:
             modal_id = ["#modal-project-toevoegen"]
 
-    # Calculate amounts awarded and spent
-    # total_awarded = all current project balances
-    #               + abs(all spent project amounts)
-    #               - all amounts received from own subprojects (in the
-    #                 case the didn't spend all their money and gave it
-    #                 back)
-    # total_spent = abs(all spend subproject amounts)
-    #             - all amounts paid back by suprojects to their project
-    total_awarded = 0
-    total_spent = 0
-    project_data = []
-    # Retrieve data for each project
-    for project in Project.query.all():
-        project_owner = False
-        if current_user.is_authenticated and (
-            current_user.admin or project.has_user(current_user.id)
-        ):
-            project_owner = True
+    return render_index(
+        modal_id,
+        project_form=project_form,
+        add_user_form=AddUserForm(prefix="add_user_form"),
+        edit_admin_forms=edit_admin_forms,
+    )
 
-        if project.hidden and not project_owner:
-            continue
 
-        # Retrieve the amounts for this project
-        amounts = util.calculate_project_amounts(project.id)
-        # Use budget for the awarded amount if available
-        if project.budget:
-            total_awarded += project.budget
-        else:
-            total_awarded += amounts["awarded"]
-        total_spent += amounts["spent"]
-        budget = ""
-        if project.budget:
-            budget = util.format_currency(project.budget)
+# Query the payments shown on a project page, including the payments of its
+# subprojects, newest first. Hidden payments the user isn't allowed to see are
+# left out.
+def get_project_payments(project, permissions):
+    return Payment.query.filter(
+        or_(
+            Payment.project_id == project.id,
+            Payment.subproject_id.in_(
+                db.session.query(Subproject.id).filter_by(project_id=project.id)
+            ),
+        ),
+        permissions.visible_payments(),
+    ).order_by(Payment.created.desc())
 
-        project_data.append(
-            {
-                "id": project.id,
-                "name": project.name,
-                "hidden": project.hidden,
-                "project_owner": project_owner,
-                "amounts": amounts,
-                "budget": budget,
-            }
-        )
 
-    return render_template(
-        "index.html",
-        background=app.config["BACKGROUND"],
+# Query the payments of a subproject page, see get_project_payments
+def get_subproject_payments(subproject, permissions):
+    return Payment.query.filter(
+        Payment.subproject_id == subproject.id,
+        permissions.visible_payments(),
+    ).order_by(Payment.created.desc())
+
+
+# Load the payments of a payment table. Their attachments are loaded in the
+# same go, as the table and the media modals show them for every payment.
+def load_payments(query):
+    return query.options(selectinload(Payment.attachments)).all()
+
+
+# Query the subprojects listed on a project page
+def get_project_subprojects(project, permissions):
+    return project.subprojects.filter(permissions.visible_subprojects())
+
+
+# Render a project page for an anonymous visitor. A visitor can't edit
+# anything, so no forms are created or processed and no CSRF or Bunq tokens
+# are generated.
+def render_project_read_only(project):
+    amounts = util.calculate_project_amounts(project.id)
+
+    budget = ""
+    if project.budget:
+        budget = util.format_currency(project.budget)
+
+    return util.stream_template(
+        "project.html",
         use_square_borders=app.config["USE_SQUARE_BORDERS"],
-        tagline=app.config["TAGLINE"],
         footer=app.config["FOOTER"],
-        project_data=project_data,
-        total_awarded_str=util.human_format(total_awarded),
-        total_spent_str=util.human_format(total_spent),
-        project_form=project_form,
-        add_user_form=AddUserForm(prefix="add_user_form"),
-        edit_admin_forms=edit_admin_forms,
-        user_stories=UserStory.query.all(),
-        modal_id=json.dumps(modal_id)  # Does nothing if None. Loads the modal
-        # on page load if supplied.
+        project=project,
+        project_data={
+            "id": project.id,
+            "name": project.name,
+            "hidden": project.hidden,
+            "hidden_sponsors": project.hidden_sponsors,
+            "amounts": amounts,
+            "contains_subprojects": project.contains_subprojects,
+        },
+        amounts=amounts,
+        budget=budget,
+        payments=load_payments(get_project_payments(project, ANONYMOUS)),
+        subprojects=get_project_subprojects(project, ANONYMOUS),
+        categories_dict={},
+        project_owner=False,
+        user_subproject_ids=[],
+        modal_id=json.dumps(None),
+        payment_id=json.dumps(None),
+    )
+
+
+# Render a subproject page for an anonymous visitor, see
+# render_project_read_only
+def render_subproject_read_only(subproject):
+    amounts = util.calculate_subproject_amounts(subproject.id)
+
+    budget = ""
+    if subproject.budget:
+        budget = util.format_currency(subproject.budget)
+
+    return util.stream_template(
+        "subproject.html",
+        use_square_borders=app.config["USE_SQUARE_BORDERS"],
+        footer=app.config["FOOTER"],
+        subproject=subproject,
+        payments=load_payments(get_subproject_payments(subproject, ANONYMOUS)),
+        amounts=amounts,
+        budget=budget,
+        user_subproject_ids=[],
+        edit_user_forms={},
+        category_forms=[],
+        categorization_rule_forms=[],
+        project_owner=False,
+        user_in_subproject=False,
+        modal_id=json.dumps(None),
+        payment_id=json.dumps(None),
     )
 
 
@@ -265,7 +402,11 @@ def project(project_id):
     modal_id = None
     payment_id = None
 
-    project = Project.query.get(project_id)
+    # Hidden projects are only shown to their project owners
+    permissions = get_permissions()
+    project = Project.query.filter(
+        Project.id == project_id, permissions.visible_projects()
+    ).first()
 
     if not project:
         return render_template(
@@ -276,17 +417,14 @@ def project(project_id):
 
     # A project owner is either an admin or a user that is part of this
     # project
-    project_owner = False
-    if current_user.is_authenticated and (
-        current_user.admin or project.has_user(current_user.id)
-    ):
-        project_owner = True
+    project_owner = permissions.is_project_owner(project.id)
 
-    if project.hidden and not project_owner:
-        return render_template(
-            "404.html",
-            use_square_borders=app.config["USE_SQUARE_BORDERS"],
-            footer=app.config["FOOTER"],
+    # Anonymous visitors only get to see the project, which can be cached
+    if request.method == "GET" and not current_user.is_authenticated:
+        return util.conditional_response(
+            request,
+            *util.get_project_validators(project),
+            lambda: render_project_read_only(project),
         )
 
     # Process filled in funder form.
@@ -430,14 +568,20 @@ def project(project_id):
 
     # Retrieve any subprojects a normal logged in user is part of
     user_subproject_ids = []
-    if (
-        project.contains_subprojects
-        and current_user.is_authenticated
-        and not project_owner
-    ):
-        for subproject in project.subprojects:
-            if subproject.has_user(current_user.id):
-                user_subproject_ids.append(subproject.id)
+    if project.contains_subprojects and not project_owner:
+        user_subproject_ids = permissions.get_subproject_ids(project.id)
+
+    # Process/create import payments form (multiple payments added manually
+    # by a project owner)
+    import_payments_form = ""
+    if project_owner:
+        import_payments_form_return = process_import_payments_form(request, project)
+        if import_payments_form_return:
+            return import_payments_form_return
+
+        import_payments_form = ImportPaymentsForm(
+            prefix="import_payments_form", **{"project_id": project.id}
+        )
 
     new_payment_form = ""
     # Filled with all categories for each subproject; used by some JavaScript
@@ -526,7 +670,6 @@ def project(project_id):
                     new_attachment["data_file"],
                     new_attachment["mediatype"],
                     new_payment,
-                    "transaction-attachment",
                 )
 
             # redirect back to clear form data
@@ -539,54 +682,35 @@ def project(project_id):
             if len(new_payment_form.errors) > 0:
                 modal_id = ["#modal-transactie-toevoegen"]
 
-    # Process/create (filled in) payment form
-    payment_forms = {}
+    # Process/create (filled in) payment form. The page contains a single
+    # edit payment modal and edit attachment modal, which are filled in by
+    # main.js with the data of the payment or attachment that is edited.
+    payment_edit_form = ""
+    payment_category_choices = {}
     transaction_attachment_form = ""
-    edit_attachment_forms = {}
     edit_attachment_form = ""
     if project_owner or user_subproject_ids:
-        # Process filled in payment form
+        # Process filled in payment form (used to remove a payment)
         payment_form_return = process_payment_form(
             request, project, project_owner, user_subproject_ids, is_subproject=False
         )
         if payment_form_return and type(payment_form_return) != PaymentForm:
             return payment_form_return
 
-        # Populate the payment forms which allows the user to edit it
-        editable_payments = []
-        editable_attachments = []
-        if project.contains_subprojects:
-            if project_owner:
-                editable_payments += project.payments
-                for payment in project.payments:
-                    editable_attachments += payment.attachments
-            for subproject in project.subprojects:
-                if project_owner:
-                    editable_payments += subproject.payments
-                    for payment in subproject.payments:
-                        editable_attachments += payment.attachments
-                # If the user is not an admin/project owner then only allow it
-                # to edit payments from its subprojects
-                elif user_subproject_ids:
-                    for payment in subproject.payments:
-                        if payment.subproject_id in user_subproject_ids:
-                            editable_payments.append(payment)
-                            editable_attachments.append(payment.attachment)
-        else:
-            editable_payments = project.payments
-            for payment in project.payments:
-                editable_attachments += payment.attachments
-
         if type(payment_form_return) == PaymentForm:
             payment_id = payment_form_return.id.data
-            editable_payments = [
-                x for x in editable_payments if x.id != payment_form_return.id.data
-            ]
+            util.flash_form_errors(payment_form_return, request)
 
-        payment_forms = create_payment_forms(editable_payments, project_owner)
-
-        if type(payment_form_return) == PaymentForm:
-            payment_forms[payment_form_return.id.data] = payment_form_return
+        payment_edit_form = create_payment_edit_form()
+        if project_owner:
+            payment_category_choices = get_payment_category_choices(
+                project, project.subprojects
+            )
+        else:
+            payment_category_choices = get_payment_category_choices(
+                project,
+                project.subprojects.filter(Subproject.id.in_(user_subproject_ids)),
+            )
 
         # Process new transaction attachment form
         transaction_attachment_form = TransactionAttachmentForm(
@@ -611,17 +735,11 @@ def project(project_id):
         )
         if edit_attachment_form_return:
             return edit_attachment_form_return
+        edit_attachment_form = EditAttachmentForm(
+            prefix="edit_attachment_form", formdata=None
+        )
 
-        # Fill in attachment form data which allow a user to edit it
-        edit_attachment_forms = create_edit_attachment_forms(editable_attachments)
-
-    payments = []
-    if project.contains_subprojects:
-        payments += project.payments
-        for subproject in project.subprojects:
-            payments += subproject.payments
-    else:
-        payments += project.payments
+    payments = load_payments(get_project_payments(project, permissions))
 
     # Process filled in edit project owner form
     edit_project_owner_form = EditProjectOwnerForm(prefix="edit_project_owner_form")
@@ -703,11 +821,43 @@ def project(project_id):
         if len(add_user_form.errors) > 0:
             modal_id = ["#project-bewerken", "#project-owner-toevoegen"]
 
+    # Invite many users at once, e.g., all activity leads of a programme
+    bulk_add_user_form = BulkAddUserForm(prefix="bulk_add_user_form")
+    bulk_add_user_form.subproject_id.choices = [
+        (0, "Initiatiefnemers van dit initiatief")
+    ] + [
+        (x.id, 'Activiteitnemers van "%s"' % (x.name))
+        for x in project.subprojects
+    ]
+    if project_owner and util.validate_on_submit(bulk_add_user_form, request):
+        try:
+            invited, membership_count, existing = util.add_users(
+                util.parse_invites(
+                    bulk_add_user_form.emails.data,
+                    project,
+                    bulk_add_user_form.subproject_id.data,
+                )
+            )
+            flash(
+                '<span class="text-default-green">%s nieuwe gebruiker(s) '
+                "uitgenodigd, %s keer een gebruiker toegevoegd aan het "
+                "initiatief of een activiteit (%s keer was de gebruiker dat al)"
+                "</span>" % (len(invited), membership_count, len(existing))
+            )
+        except ValueError as e:
+            flash('<span class="text-default-red">%s</span>' % (escape(str(e))))
+
+        # redirect back to clear form data
+        return redirect(url_for("project", project_id=project.id))
+    else:
+        if len(bulk_add_user_form.errors) > 0:
+            modal_id = ["#project-beheren", "#gebruikers-uitnodigen"]
+
     # Process filled in project form
     project_form = ProjectForm(prefix="project_form")
 
     # Remove project
-    if project_form.remove.data and current_user.admin:
+    if project_form.remove.data and permissions.admin:
         Project.query.filter_by(id=project.id).delete()
         db.session.commit()
         flash(
@@ -818,11 +968,41 @@ def project(project_id):
 
     # Retrieve data for each project
     project_data = {}
-    project_owner = False
-    if current_user.is_authenticated and (
-        current_user.admin or project.has_user(current_user.id)
-    ):
-        project_owner = True
+    project_owner = permissions.is_project_owner(project.id)
+
+    # Process filled in categorization rule form
+    categorization_rule_forms = []
+    categorization_rule_form = ""
+    if project_owner and not project.contains_subprojects:
+        category_choices = project.make_category_select_options()
+        categorization_rule_form_return = process_categorization_rule_form(
+            request, category_choices, project.id
+        )
+        if categorization_rule_form_return:
+            return categorization_rule_form_return
+
+        # Populate the categorization rule forms which allow the user to
+        # edit them
+        categorization_rule_forms = create_categorization_rule_forms(
+            project.categorization_rules, category_choices, project.id
+        )
+        categorization_rule_form = CategorizationRuleForm(
+            prefix="categorization_rule_form", **{"project_id": project.id}
+        )
+        categorization_rule_form.category_id.choices = category_choices
+
+    # Process filled in import statement form
+    import_statement_form = ""
+    if project_owner and not project.contains_subprojects:
+        import_statement_form_return = process_import_statement_form(
+            request, project.id
+        )
+        if import_statement_form_return:
+            return import_statement_form_return
+
+        import_statement_form = ImportStatementForm(
+            prefix="import_statement_form", **{"project_id": project.id}
+        )
 
     already_authorized = False
     bunq_token = ""
@@ -913,6 +1093,9 @@ def project(project_id):
         "category_form": CategoryForm(
             prefix="category_form", **{"project_id": project.id}
         ),
+        "categorization_rule_forms": categorization_rule_forms,
+        "categorization_rule_form": categorization_rule_form,
+        "import_statement_form": import_statement_form,
     }
 
     base_url_auth = "https://oauth.bunq.com"
@@ -923,29 +1106,42 @@ def project(project_id):
     if project.budget:
         budget = util.format_currency(project.budget)
 
-    return render_template(
+    # Used to edit multiple payments at once
+    payment_batch_csrf_token = ""
+    payment_batch_category_choices = []
+    if project_owner or user_subproject_ids:
+        payment_batch_csrf_token = generate_csrf()
+        if not project.contains_subprojects:
+            payment_batch_category_choices = project.make_category_select_options()
+
+    return util.stream_template(
         "project.html",
         use_square_borders=app.config["USE_SQUARE_BORDERS"],
         footer=app.config["FOOTER"],
         project=project,
         project_data=project_data,
+        subprojects=get_project_subprojects(project, permissions),
         amounts=amounts,
         budget=budget,
         payments=payments,
         project_form=project_form,
         edit_project_owner_forms=edit_project_owner_forms,
         add_user_form=add_user_form,
+        bulk_add_user_form=bulk_add_user_form,
         subproject_form=subproject_form,
         new_payment_form=new_payment_form,
+        import_payments_form=import_payments_form,
+        payment_batch_csrf_token=payment_batch_csrf_token,
+        payment_batch_category_choices=payment_batch_category_choices,
         categories_dict=categories_dict,
-        payment_forms=payment_forms,
+        payment_edit_form=payment_edit_form,
+        payment_category_choices=payment_category_choices,
         transaction_attachment_form=transaction_attachment_form,
-        edit_attachment_forms=edit_attachment_forms,
+        edit_attachment_form=edit_attachment_form,
         funder_forms=funder_forms,
         new_funder_form=funder_form,
         project_owner=project_owner,
         user_subproject_ids=user_subproject_ids,
-        timestamp=util.get_export_timestamp(),
         server_name=app.config["SERVER_NAME"],
         bunq_client_id=app.config["BUNQ_CLIENT_ID"],
         base_url_auth=base_url_auth,
@@ -958,7 +1154,19 @@ def project(project_id):
 def subproject(project_id, subproject_id):
     modal_id = None
     payment_id = None
-    subproject = Subproject.query.get(subproject_id)
+    # Hidden subprojects are only shown to their project owners and the
+    # users that are part of them, and only if their project is visible too
+    permissions = get_permissions()
+    subproject = (
+        Subproject.query.join(Subproject.project)
+        .filter(
+            Subproject.id == subproject_id,
+            Subproject.project_id == project_id,
+            permissions.visible_projects(),
+            permissions.visible_subprojects(),
+        )
+        .first()
+    )
 
     if not subproject:
         return render_template(
@@ -968,23 +1176,18 @@ def subproject(project_id, subproject_id):
         )
 
     # Check if the user is logged in and is part of this subproject
-    user_in_subproject = False
-    if current_user.is_authenticated and subproject.has_user(current_user.id):
-        user_in_subproject = True
+    user_in_subproject = permissions.is_subproject_user(subproject.id)
 
     # A project owner is either an admin or a user that is part of the
     # project where this subproject belongs to
-    project_owner = False
-    if current_user.is_authenticated and (
-        current_user.admin or subproject.project.has_user(current_user.id)
-    ):
-        project_owner = True
+    project_owner = permissions.is_project_owner(subproject.project_id)
 
-    if subproject.hidden and not project_owner and not user_in_subproject:
-        return render_template(
-            "404.html",
-            use_square_borders=app.config["USE_SQUARE_BORDERS"],
-            footer=app.config["FOOTER"],
+    # Anonymous visitors only get to see the subproject, which can be cached
+    if request.method == "GET" and not current_user.is_authenticated:
+        return util.conditional_response(
+            request,
+            *util.get_subproject_validators(subproject),
+            lambda: render_subproject_read_only(subproject),
         )
 
     # Process filled in subproject form
@@ -1114,9 +1317,23 @@ def subproject(project_id, subproject_id):
 
     # Retrieve the subproject id a normal logged in user is part of
     user_subproject_ids = []
-    if current_user.is_authenticated and not project_owner:
-        if subproject.has_user(current_user.id):
-            user_subproject_ids.append(subproject.id)
+    if not project_owner and user_in_subproject:
+        user_subproject_ids.append(subproject.id)
+
+    # Process/create import payments form (multiple payments added manually
+    # by a project owner)
+    import_payments_form = ""
+    if project_owner:
+        import_payments_form_return = process_import_payments_form(
+            request, subproject.project, subproject
+        )
+        if import_payments_form_return:
+            return import_payments_form_return
+
+        import_payments_form = ImportPaymentsForm(
+            prefix="import_payments_form",
+            **{"subproject_id": subproject.id, "project_id": subproject.project.id},
+        )
 
     new_payment_form = ""
     # Process/create new payment form (added manually by a user)
@@ -1168,7 +1385,6 @@ def subproject(project_id, subproject_id):
                     new_attachment["data_file"],
                     new_attachment["mediatype"],
                     new_payment,
-                    "transaction-attachment",
                 )
 
             # redirect back to clear form data
@@ -1190,27 +1406,63 @@ def subproject(project_id, subproject_id):
     if payment_form_return and type(payment_form_return) != PaymentForm:
         return payment_form_return
 
-    editable_payments = subproject.payments
-
     if type(payment_form_return) == PaymentForm:
         payment_id = payment_form_return.id.data
-        editable_payments = [
-            x for x in editable_payments if x.id != payment_form_return.id.data
-        ]
+        util.flash_form_errors(payment_form_return, request)
 
-    # Populate the payment forms which allows the user to edit it
-    payment_forms = {}
+    # Create the edit payment modal, see project()
+    payment_edit_form = ""
+    payment_category_choices = {}
     if project_owner or user_in_subproject:
-        payment_forms = create_payment_forms(subproject.payments, project_owner)
-
-    if type(payment_form_return) == PaymentForm:
-        payment_forms[payment_form_return.id.data] = payment_form_return
+        payment_edit_form = create_payment_edit_form()
+        payment_category_choices = get_payment_category_choices(
+            subproject.project, [subproject]
+        )
 
     # Process filled in category form
     category_form_return = process_category_form(request)
     if category_form_return:
         return category_form_return
 
+    # Process filled in categorization rule form
+    categorization_rule_forms = []
+    categorization_rule_form = ""
+    if project_owner:
+        category_choices = subproject.make_category_select_options()
+        categorization_rule_form_return = process_categorization_rule_form(
+            request, category_choices, subproject.project.id, subproject.id
+        )
+        if categorization_rule_form_return:
+            return categorization_rule_form_return
+
+        # Populate the categorization rule forms which allow the user to
+        # edit them
+        categorization_rule_forms = create_categorization_rule_forms(
+            subproject.categorization_rules,
+            category_choices,
+            subproject.project.id,
+            subproject.id,
+        )
+        categorization_rule_form = CategorizationRuleForm(
+            prefix="categorization_rule_form",
+            **{"subproject_id": subproject.id, "project_id": subproject.project.id},
+        )
+        categorization_rule_form.category_id.choices = category_choices
+
+    # Process filled in import statement form
+    import_statement_form = ""
+    if project_owner:
+        import_statement_form_return = process_import_statement_form(
+            request, subproject.project.id, subproject.id
+        )
+        if import_statement_form_return:
+            return import_statement_form_return
+
+        import_statement_form = ImportStatementForm(
+            prefix="import_statement_form",
+            **{"subproject_id": subproject.id, "project_id": subproject.project.id},
+        )
+
     # Populate the category forms which allows the user to
     # edit it
     category_forms = []
@@ -1317,7 +1569,6 @@ def subproject(project_id, subproject_id):
         util.flash_form_errors(add_user_form, request)
 
     transaction_attachment_form = ""
-    edit_attachment_forms = {}
     edit_attachment_form = ""
     if project_owner or user_in_subproject:
         # Process new transaction attachment form
@@ -1342,12 +1593,9 @@ def subproject(project_id, subproject_id):
         )
         if edit_attachment_form_return:
             return edit_attachment_form_return
-
-        # Fill in attachment form data which allow a user to edit it
-        attachments = []
-        for payment in subproject.payments:
-            attachments += payment.attachments
-        edit_attachment_forms = create_edit_attachment_forms(attachments)
+        edit_attachment_form = EditAttachmentForm(
+            prefix="edit_attachment_form", formdata=None
+        )
 
     # Retrieve the amounts for this subproject
     amounts = util.calculate_subproject_amounts(subproject_id)
@@ -1355,33 +1603,327 @@ def subproject(project_id, subproject_id):
     budget = ""
     if subproject.budget:
         budget = util.format_currency(subproject.budget)
-    return render_template(
+
+    # Used to edit multiple payments at once
+    payment_batch_csrf_token = ""
+    payment_batch_category_choices = []
+    if project_owner or user_in_subproject:
+        payment_batch_csrf_token = generate_csrf()
+        payment_batch_category_choices = subproject.make_category_select_options()
+
+    return util.stream_template(
         "subproject.html",
         use_square_borders=app.config["USE_SQUARE_BORDERS"],
         footer=app.config["FOOTER"],
         subproject=subproject,
+        payments=load_payments(get_subproject_payments(subproject, permissions)),
         amounts=amounts,
         budget=budget,
         subproject_form=subproject_form,
         new_payment_form=new_payment_form,
-        payment_forms=payment_forms,
+        import_payments_form=import_payments_form,
+        payment_batch_csrf_token=payment_batch_csrf_token,
+        payment_batch_category_choices=payment_batch_category_choices,
+        user_subproject_ids=user_subproject_ids,
+        payment_edit_form=payment_edit_form,
+        payment_category_choices=payment_category_choices,
         transaction_attachment_form=transaction_attachment_form,
-        edit_attachment_forms=edit_attachment_forms,
+        edit_attachment_form=edit_attachment_form,
         edit_user_forms=edit_user_forms,
         add_user_form=AddUserForm(prefix="add_user_form"),
         project_owner=project_owner,
         user_in_subproject=user_in_subproject,
-        timestamp=util.get_export_timestamp(),
         category_forms=category_forms,
         category_form=CategoryForm(
             prefix="category_form",
             **{"subproject_id": subproject.id, "project_id": subproject.project.id},
         ),
+        categorization_rule_forms=categorization_rule_forms,
+        categorization_rule_form=categorization_rule_form,
+        import_statement_form=import_statement_form,
         modal_id=json.dumps(modal_id),
         payment_id=json.dumps(payment_id),
     )
 
 
+# Edit multiple payments of a project (or its subprojects) at once
+@app.route("/project/<project_id>/transacties-bewerken", methods=["POST"])
+@login_required
+def payments_batch_edit(project_id):
+    project = Project.query.get(project_id)
+    if not project:
+        return jsonify(error="Onbekend initiatief"), 404
+
+    try:
+        validate_csrf(request.headers.get("X-CSRFToken"))
+    except ValidationError:
+        return jsonify(error="Ongeldig CSRF token"), 400
+
+    permissions = get_permissions()
+    project_owner = permissions.is_project_owner(project.id)
+    user_subproject_ids = []
+    if not project_owner:
+        user_subproject_ids = permissions.get_subproject_ids(project.id)
+        if not user_subproject_ids:
+            return jsonify(error="Geen toegang"), 403
+
+    result, status = process_payment_batch(
+        request.get_json(silent=True) or {},
+        project,
+        project_owner,
+        user_subproject_ids,
+    )
+    return jsonify(result), status
+
+
+# Edit a single payment; returns the re-rendered table row and the updated
+# amounts of the (sub)project so the page can be updated in place
+@app.route("/project/<project_id>/transactie/<payment_id>", methods=["PATCH"])
+@login_required
+def payment_edit(project_id, payment_id):
+    project = Project.query.get(project_id)
+    payment = Payment.query.get(payment_id)
+    if not project or not payment:
+        return jsonify(error="Onbekende transactie"), 404
+    if payment.project_id != project.id and (
+        not payment.subproject or payment.subproject.project_id != project.id
+    ):
+        return jsonify(error="Onbekende transactie"), 404
+
+    # The row is rendered differently on a subproject page
+    subproject = None
+    if request.args.get("subproject_id"):
+        subproject = Subproject.query.get(request.args.get("subproject_id"))
+        if not subproject or subproject.project_id != project.id:
+            return jsonify(error="Onbekende activiteit"), 404
+
+    try:
+        validate_csrf(request.headers.get("X-CSRFToken"))
+    except ValidationError:
+        return jsonify(error="Ongeldig CSRF token"), 400
+
+    # Use the same permissions as when editing a payment with the PaymentForm
+    permissions = get_permissions()
+    project_owner = permissions.is_project_owner(project.id)
+    user_subproject_ids = permissions.get_subproject_ids(project.id)
+    if not project_owner and (
+        not payment.subproject or payment.subproject.id not in user_subproject_ids
+    ):
+        return jsonify(error="Geen toegang"), 403
+
+    errors = process_payment_patch(
+        request.get_json(silent=True) or {}, payment, project_owner
+    )
+    if errors:
+        return jsonify(errors=errors), 400
+
+    db.session.refresh(payment)
+
+    if subproject:
+        amounts = util.calculate_subproject_amounts(subproject.id)
+    else:
+        amounts = util.calculate_project_amounts(project.id)
+
+    row = render_template(
+        "partials/payment_row.html",
+        payment=payment,
+        project_owner=project_owner,
+        user_subproject_ids=user_subproject_ids,
+        show_subproject_column=not subproject and project.contains_subprojects,
+        subproject_page=bool(subproject),
+        payment_edit_form=create_payment_edit_form(),
+        payment_batch_csrf_token=generate_csrf(),
+    )
+
+    return jsonify(row=row, amounts=amounts)
+
+
+# Same permissions as when editing a payment with the PaymentForm
+def can_edit_payment(payment, permissions):
+    if payment.subproject:
+        return permissions.can_edit_subproject(payment.subproject)
+    return bool(payment.project_id) and permissions.is_project_owner(
+        payment.project_id
+    )
+
+
+# Start an upload of a transaction attachment. main.js either uploads the file
+# directly to storage (if the storage backend supports it) or sends it in
+# chunks to attachment_upload, so a bad connection only needs to resend the
+# last chunk. Either way no worker is busy for the whole upload.
+@app.route("/bijlage-upload", methods=["POST"])
+@login_required
+def attachment_upload_start():
+    form = AttachmentUploadForm()
+    if not form.validate_on_submit():
+        return jsonify(
+            errors=[error for errors in form.errors.values() for error in errors]
+        ), 400
+
+    payment = Payment.query.get(form.payment_id.data)
+    if not payment:
+        return jsonify(error="Onbekende transactie"), 404
+    if not can_edit_payment(payment, get_permissions()):
+        return jsonify(error="Geen toegang"), 403
+
+    token, direct_upload = storage.start_upload(form.size.data)
+    # Keep the most recent uploads, so abandoned uploads don't fill the session
+    uploads = dict(list(session.get("uploads", {}).items())[-9:])
+    uploads[token] = {
+        "payment_id": payment.id,
+        "filename": secure_filename(form.filename.data),
+        "size": form.size.data,
+        "mediatype": form.mediatype.data,
+        "direct": bool(direct_upload),
+    }
+    session["uploads"] = uploads
+    return jsonify(
+        url=url_for("attachment_upload", token=token),
+        offset=0,
+        direct_upload=direct_upload,
+    ), 201
+
+
+# GET returns the number of bytes received so far, which is where an
+# interrupted upload resumes. PATCH appends a chunk at the offset in the
+# Upload-Offset header. POST completes a direct upload to storage. The
+# attachment is saved once all bytes are received.
+@app.route("/bijlage-upload/<token>", methods=["GET", "PATCH", "POST"])
+@login_required
+def attachment_upload(token):
+    upload = session.get("uploads", {}).get(token)
+    if not upload:
+        return jsonify(error="Onbekende upload"), 404
+    if not upload["direct"]:
+        offset = storage.get_partial_upload_size(token)
+        if offset is None or request.method == "POST":
+            return jsonify(error="Onbekende upload"), 404
+        if request.method == "GET":
+            return jsonify(offset=offset)
+    elif request.method != "POST":
+        return jsonify(error="Onbekende upload"), 404
+
+    try:
+        validate_csrf(request.headers.get("X-CSRFToken"))
+    except ValidationError:
+        return jsonify(error="Ongeldig CSRF token"), 400
+
+    if not upload["direct"]:
+        try:
+            offset = storage.append_partial_upload(
+                token,
+                request.stream,
+                int(request.headers.get("Upload-Offset", -1)),
+                upload["size"],
+            )
+        except ValueError:
+            return jsonify(
+                error="Ongeldige offset", offset=storage.get_partial_upload_size(token)
+            ), 409
+        if offset < upload["size"]:
+            return jsonify(offset=offset)
+
+    payment = Payment.query.get(upload["payment_id"])
+    if not payment or not can_edit_payment(payment, get_permissions()):
+        return jsonify(error="Geen toegang"), 403
+
+    if upload["direct"]:
+        try:
+            new_file = storage.complete_direct_upload(
+                token, upload["filename"], upload["mediatype"], upload["size"]
+            )
+        except ValueError:
+            return jsonify(error="Uploaden mislukt"), 400
+    else:
+        new_file = storage.complete_partial_upload(
+            token, upload["filename"], upload["mediatype"]
+        )
+    link_attachment(new_file, payment)
+    uploads = session["uploads"]
+    uploads.pop(token)
+    session["uploads"] = uploads
+    flash('<span class="text-default-green">Media is toegevoegd</span>')
+    return jsonify(offset=upload["size"], file_id=new_file.id)
+
+
+# Stream the payments of a (sub)project as an export file
+def export_payments(payments, export_format, name, include_subproject):
+    mimetype, export_function = export.FORMATS[export_format]
+    response = Response(
+        stream_with_context(
+            export_function(
+                export.get_header(include_subproject),
+                export.get_rows(payments, include_subproject),
+            )
+        ),
+        mimetype=mimetype,
+    )
+    response.headers["Content-Disposition"] = "attachment; filename=%s-%s.%s" % (
+        util.get_export_timestamp(),
+        secure_filename(name),
+        export_format,
+    )
+    # Don't let Nginx buffer the whole export
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/project/<project_id>/export.<export_format>", methods=["GET"])
+def project_export(project_id, export_format):
+    permissions = get_permissions()
+    project = Project.query.filter(
+        Project.id == project_id, permissions.visible_projects()
+    ).first()
+
+    if not project or export_format not in export.FORMATS:
+        return render_template(
+            "404.html",
+            use_square_borders=app.config["USE_SQUARE_BORDERS"],
+            footer=app.config["FOOTER"],
+        )
+
+    return export_payments(
+        get_project_payments(project, permissions).yield_per(PAYMENTS_BATCH_SIZE),
+        export_format,
+        project.name,
+        project.contains_subprojects,
+    )
+
+
+@app.route(
+    "/project/<project_id>/subproject/<subproject_id>/export.<export_format>",
+    methods=["GET"],
+)
+def subproject_export(project_id, subproject_id, export_format):
+    permissions = get_permissions()
+    subproject = (
+        Subproject.query.join(Subproject.project)
+        .filter(
+            Subproject.id == subproject_id,
+            Subproject.project_id == project_id,
+            permissions.visible_projects(),
+            permissions.visible_subprojects(),
+        )
+        .first()
+    )
+
+    if not subproject or export_format not in export.FORMATS:
+        return render_template(
+            "404.html",
+            use_square_borders=app.config["USE_SQUARE_BORDERS"],
+            footer=app.config["FOOTER"],
+        )
+
+    return export_payments(
+        get_subproject_payments(subproject, permissions).yield_per(
+            PAYMENTS_BATCH_SIZE
+        ),
+        export_format,
+        subproject.name,
+        False,
+    )
+
+
 @app.route("/over", methods=["GET"])
 def over():
     return render_template(
@@ -1400,9 +1942,82 @@ def meest_gestelde_vragen():
     )
 
 
-@app.route("/upload/<filename>")
+# Returns the Files of an uploaded file or of one of its resized variants (see
+# app/images.py) and the mimetype to serve it with. Files with the same
+# content share their filename, see app/storage.py.
+def get_upload_files(filename):
+    files = File.query.filter_by(filename=filename).all()
+    if files:
+        return files, files[0].mimetype
+
+    stem, _, variant = filename.rpartition("_")
+    width, _, extension = variant.partition("w.")
+    if not stem or not width.isdigit() or extension not in images.VARIANT_MIMETYPES:
+        return [], None
+    files = [
+        file
+        for file in File.query.filter(File.filename.startswith(stem + ".", autoescape=True))
+        if get_variant_filename(file.filename, width, extension) == filename
+    ]
+    return files, images.VARIANT_MIMETYPES[extension]
+
+
+# A transaction attachment can be seen if one of its payments and the
+# (sub)project of that payment can be seen
+def is_attachment_visible(files, permissions):
+    if permissions.admin:
+        return True
+    payments = Payment.query.join(
+        payment_attachment, payment_attachment.c.payment_id == Payment.id
+    ).filter(
+        payment_attachment.c.file_id.in_([file.id for file in files]),
+        permissions.visible_payments(),
+    )
+    for payment in payments:
+        if payment.project_id:
+            query = Project.query.filter(
+                Project.id == payment.project_id,
+                permissions.visible_projects(),
+            )
+        else:
+            query = Subproject.query.join(Subproject.project).filter(
+                Subproject.id == payment.subproject_id,
+                permissions.visible_subprojects(),
+                permissions.visible_projects(),
+            )
+        if db.session.query(query.exists()).scalar():
+            return True
+    return False
+
+
+# Decide whether an upload can be seen from what its Files are linked to, not
+# from the folder in the URL: a File stored as a blob (see app/storage.py) is
+# found by its filename in any folder. User images are public.
+def is_upload_visible(files, permissions):
+    user_image = User.query.filter(User.image.in_([file.id for file in files]))
+    if db.session.query(user_image.exists()).scalar():
+        return True
+    return is_attachment_visible(files, permissions)
+
+
+# Uploads are only served after checking whether the current user may see
+# them. The file itself is sent by nginx from its internal /protected-upload/
+# location (see docker/nginx/conf.d) or by the S3 compatible storage with a
+# presigned URL, so no worker is busy during the transfer.
+@app.route("/upload/<path:filename>")
 def upload(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    folder, _, filename = filename.partition("/")
+    if folder not in storage.UPLOAD_FOLDERS:
+        abort(404)
+    files, mimetype = get_upload_files(filename)
+    if not files:
+        abort(404)
+    if not is_upload_visible(files, get_permissions()):
+        abort(404)
+
+    return storage.get_backend().get_download_response(
+        storage.get_key(files[0], filename, folder), mimetype
+    )
 
 
 @app.route("/reset-wachtwoord-verzoek", methods=["GET", "POST"])
@@ -1412,6 +2027,7 @@ def reset_wachtwoord_verzoek():
         user = User.query.filter_by(email=form.email.data).first()
         if user:
             send_password_reset_email(user)
+            db.session.commit()
         flash(
             '<span class="text-default-green">Er is een e-mail verzonden met '
             "instructies om het wachtwoord te veranderen</span>"
@@ -1471,6 +2087,10 @@ def login():
 @login_required
 def logout():
     logout_user()
+    # Remove the snapshots of the user and its permissions, see
+    # models.SessionUser and permissions.get_permissions
+    session.pop("user", None)
+    session.pop("permissions", None)
     return redirect(url_for("index"))
 
 
@@ -1478,9 +2098,26 @@ def logout():
 def profile(user_id):
     user = User.query.filter_by(id=user_id).first()
 
+    # Only list the (sub)projects the current user is allowed to see
+    permissions = get_permissions()
+    projects = Project.query.join(
+        project_user, project_user.c.project_id == Project.id
+    ).filter(
+        project_user.c.user_id == user.id, permissions.visible_projects()
+    ).all()
+    subprojects = Subproject.query.join(
+        subproject_user, subproject_user.c.subproject_id == Subproject.id
+    ).join(Subproject.project).filter(
+        subproject_user.c.user_id == user.id,
+        permissions.visible_subprojects(),
+        permissions.visible_projects(),
+    ).all()
+
     return render_template(
         "profiel.html",
         user=user,
+        projects=projects,
+        subprojects=subprojects,
         image=File.query.filter_by(id=user.image).first(),
         use_square_borders=app.config["USE_SQUARE_BORDERS"],
         footer=app.config["FOOTER"],
@@ -1496,9 +2133,18 @@ def profile_edit():
     # Process image edit form (only used to remove an image)
     edit_attachment_form = EditAttachmentForm(prefix="edit_attachment_form")
     if edit_attachment_form.remove.data:
-        File.query.filter_by(id=edit_attachment_form.id.data).delete()
-        db.session.commit()
-        flash('<span class="text-default-green">Media is verwijderd</span>')
+        # Users can only remove their own image
+        if (
+            current_user.image
+            and edit_attachment_form.id.data == current_user.image
+        ):
+            storage.delete_file(current_user.image)
+            flash('<span class="text-default-green">Media is verwijderd</span>')
+        else:
+            flash(
+                '<span class="text-default-red">Media verwijderen mislukt: '
+                "dit is niet uw afbeelding</span>"
+            )
 
         # redirect back to clear form data
         return redirect(url_for("profile", user_id=current_user.id))
@@ -1528,7 +2174,7 @@ def profile_edit():
 
             if edit_profile_form.data_file.data:
                 save_attachment(
-                    edit_profile_form.data_file.data, "", users[0], "user-image"
+                    edit_profile_form.data_file.data, "", users[0]
                 )
 
             flash('<span class="text-default-green">gebruiker is bijgewerkt</span>')
@@ -0,0 +1,502 @@
+from datetime import datetime
+from hashlib import sha256
+from types import SimpleNamespace
+from xml.etree.ElementTree import iterparse
+import codecs
+import csv
+import io
+import re
+
+from app import app, db
+from app.categorization import RuleMatcher, normalize_iban
+from app.models import (
+    CategorizationRule, Payment, Project, Subproject, mark_changed
+)
+
+
+# Import bank statements of non-Bunq accounts. Each parser is a generator
+# reading the statement as a stream and yielding one dict per entry with
+# Payment columns, so memory use doesn't depend on the size of the
+# statement. Supported formats are CAMT.053 (XML), MT940 and CSV.
+
+# Number of payments inserted per batch
+BATCH_SIZE = 1000
+
+FORMATS = ['camt053', 'mt940', 'csv']
+
+
+def parse_date(value, formats=('%Y-%m-%d', '%d-%m-%Y', '%Y%m%d', '%d/%m/%Y')):
+    value = value.strip()[:10]
+    for date_format in formats:
+        try:
+            return app.config['TZ'].localize(
+                datetime.strptime(value, date_format)
+            )
+        except ValueError:
+            continue
+    raise ValueError('Unknown date format: "%s"' % value)
+
+
+def parse_amount(value):
+    value = value.strip().replace(' ', '')
+    # Both '1.234,56' and '1,234.56' and '1234,56' are used
+    if ',' in value and '.' in value:
+        if value.rindex(',') > value.rindex('.'):
+            value = value.replace('.', '').replace(',', '.')
+        else:
+            value = value.replace(',', '')
+    else:
+        value = value.replace(',', '.')
+    return float(value)
+
+
+# Strip the namespace of an XML tag
+def _tag(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _find(element, path):
+    for part in path.split('/'):
+        if element is None:
+            return None
+        element = next((x for x in element if _tag(x) == part), None)
+    return element
+
+
+def _find_text(element, path):
+    found = _find(element, path)
+    if found is None or found.text is None:
+        return None
+    return found.text.strip()
+
+
+# Parse a CAMT.053 statement iteratively; every entry element is discarded
+# after it is parsed so the full document is never kept in memory
+def parse_camt053(stream):
+    account_iban = None
+    account_name = None
+    balance = None
+    # The open elements, so parsed elements can be removed from their parent
+    parents = []
+    for event, element in iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+
+        tag = _tag(element)
+        if tag == 'Acct':
+            account_iban = _find_text(element, 'Id/IBAN')
+            account_name = _find_text(element, 'Ownr/Nm')
+        elif tag == 'Bal':
+            # Use the opening balance to calculate the balance after each
+            # entry
+            balance_type = _find_text(element, 'Tp/CdOrPrtry/Cd')
+            if balance_type in ['OPBD', 'PRCD'] and balance is None:
+                balance = float(_find_text(element, 'Amt'))
+                if _find_text(element, 'CdtDbtInd') == 'DBIT':
+                    balance = -balance
+        elif tag == 'Ntry':
+            amount = float(_find_text(element, 'Amt'))
+            if _find_text(element, 'CdtDbtInd') == 'DBIT':
+                amount = -amount
+            if balance is not None:
+                balance = round(balance + amount, 2)
+
+            # Entries we receive have the debtor as counterparty, entries
+            # we pay have the creditor as counterparty
+            party = 'Dbtr' if amount > 0 else 'Cdtr'
+            details = _find(element, 'NtryDtls/TxDtls')
+            counterparty_name = _find_text(details, 'RltdPties/%s/Nm' % party)
+            counterparty_iban = _find_text(
+                details, 'RltdPties/%sAcct/Id/IBAN' % party
+            )
+            description = (
+                _find_text(details, 'RmtInf/Ustrd')
+                or _find_text(element, 'AddtlNtryInf')
+            )
+            booking_date = (
+                _find_text(element, 'BookgDt/Dt')
+                or _find_text(element, 'BookgDt/DtTm')
+                or _find_text(element, 'ValDt/Dt')
+            )
+            amount_element = _find(element, 'Amt')
+
+            yield {
+                'alias_value': account_iban,
+                'alias_name': account_name,
+                'alias_type': 'IBAN',
+                'amount_value': amount,
+                'amount_currency': amount_element.get('Ccy', 'EUR'),
+                'balance_after_mutation_value': balance,
+                'counterparty_alias_name': counterparty_name,
+                'counterparty_alias_value': counterparty_iban,
+                'counterparty_alias_type': 'IBAN' if counterparty_iban else None,
+                'description': description,
+                'created': parse_date(booking_date),
+                'reference': (
+                    _find_text(element, 'AcctSvcrRef')
+                    or _find_text(details, 'Refs/EndToEndId')
+                )
+            }
+
+            # Discard the parsed entry, so memory use doesn't depend on the
+            # number of entries
+            parents[-1].remove(element)
+        elif tag == 'Stmt':
+            account_iban = None
+            account_name = None
+            balance = None
+            parents[-1].remove(element)
+
+
+_MT940_TAG = re.compile(r'^:(\d{2}[A-Z]?):(.*)$')
+_MT940_STATEMENT_LINE = re.compile(
+    r'^(?P<date>\d{6})(?P<entry_date>\d{4})?(?P<mark>R?[CD])[A-Z]?'
+    r'(?P<amount>\d+,\d*)(?P<rest>.*)$'
+)
+_MT940_BALANCE = re.compile(
+    r'^(?P<mark>[CD])(?P<date>\d{6})(?P<currency>[A-Z]{3})(?P<amount>\d+,\d*)$'
+)
+
+
+# Retrieve a field from structured :86: information, e.g.
+# '/CNTP/NL12INGB0001234567/INGBNL2A/J. Jansen//REMI/USTD//Factuur 12/'
+def _mt940_field(info, names):
+    for name in names:
+        match = re.search(r'/%s/(.*?)(?:/[A-Z]{4}/|$)' % name, info)
+        if match:
+            return match.group(1).strip('/ ')
+    return None
+
+
+def _mt940_entry(account_iban, currency, balance, line, info):
+    match = _MT940_STATEMENT_LINE.match(line)
+    if not match:
+        raise ValueError('Invalid MT940 statement line: "%s"' % line)
+
+    amount = parse_amount(match.group('amount'))
+    # 'D' and 'RC' (reversal of credit) are debit entries
+    if match.group('mark') in ['D', 'RC']:
+        amount = -amount
+
+    counterparty_iban = None
+    counterparty_name = None
+    description = info
+    if info.startswith('/'):
+        cntp = _mt940_field(info, ['CNTP'])
+        if cntp:
+            # /CNTP/<IBAN>/<BIC>/<name>/<city>
+            parts = (cntp + '///').split('/')
+            counterparty_iban = parts[0] or None
+            counterparty_name = parts[2] or None
+        counterparty_iban = counterparty_iban or _mt940_field(info, ['IBAN'])
+        counterparty_name = counterparty_name or _mt940_field(info, ['NAME'])
+        description = _mt940_field(info, ['REMI/USTD/', 'REMI', 'DESC']) or info
+
+    return {
+        'alias_value': account_iban,
+        'alias_type': 'IBAN',
+        'amount_value': amount,
+        'amount_currency': currency,
+        'balance_after_mutation_value': balance,
+        'counterparty_alias_name': counterparty_name,
+        'counterparty_alias_value': counterparty_iban,
+        'counterparty_alias_type': 'IBAN' if counterparty_iban else None,
+        'description': description,
+        'created': parse_date(match.group('date'), formats=('%y%m%d',)),
+        'reference': match.group('rest').strip() or None
+    }
+
+
+# Parse an MT940 statement line by line
+def parse_mt940(stream):
+    account_iban = None
+    currency = 'EUR'
+    balance = None
+    line = None
+    info = ''
+    # The tag of the field that is currently read; fields can span
+    # multiple lines
+    current_tag = None
+
+    def flush():
+        nonlocal balance
+        entry = _mt940_entry(account_iban, currency, None, line, info)
+        if balance is not None:
+            balance = round(balance + entry['amount_value'], 2)
+            entry['balance_after_mutation_value'] = balance
+        return entry
+
+    for raw_line in stream:
+        if isinstance(raw_line, bytes):
+            raw_line = raw_line.decode('latin-1')
+        raw_line = raw_line.rstrip('\r\n')
+        if not raw_line or raw_line in ['-', '-}'] or raw_line.startswith('{'):
+            continue
+
+        match = _MT940_TAG.match(raw_line)
+        if not match:
+            # Continuation of the previous field
+            if current_tag == '86':
+                info += raw_line
+            continue
+
+        current_tag, value = match.groups()
+        # A new statement line or the end of a statement completes the
+        # previous entry
+        if line and current_tag in ['61', '62F', '62M', '20']:
+            yield flush()
+            line = None
+            info = ''
+
+        if current_tag == '25':
+            # Account can be '<IBAN>' or '<IBAN> <currency>'
+            account_iban = value.split(' ')[0].split('/')[0]
+        elif current_tag in ['60F', '60M']:
+            balance_match = _MT940_BALANCE.match(value)
+            if balance_match:
+                currency = balance_match.group('currency')
+                balance = parse_amount(balance_match.group('amount'))
+                if balance_match.group('mark') == 'D':
+                    balance = -balance
+        elif current_tag == '61':
+            line = value
+        elif current_tag == '86' and line:
+            info = value
+
+    if line:
+        yield flush()
+
+
+# Column names used by banks and our own generic CSV format, mapped to
+# Payment columns; the first column name found in the header is used
+CSV_COLUMNS = {
+    'created': ['datum', 'date', 'boekdatum', 'transactiedatum'],
+    'amount_value': ['bedrag', 'amount', 'bedrag (eur)'],
+    'debit_credit': ['af bij', 'af/bij', 'debit/credit', 'credit/debit'],
+    'alias_value': ['rekening', 'iban/bban', 'iban', 'account'],
+    'counterparty_alias_value': [
+        'tegenrekening', 'tegenrekening iban/bban', 'counterparty iban'
+    ],
+    'counterparty_alias_name': [
+        'naam tegenpartij', 'naam / omschrijving', 'counterparty name',
+        'naam'
+    ],
+    'description': [
+        'omschrijving', 'omschrijving-1', 'mededelingen', 'description'
+    ],
+    'balance_after_mutation_value': ['saldo na trn', 'saldo na mutatie', 'balance'],
+    'amount_currency': ['munt', 'valuta', 'currency'],
+    'reference': ['volgnr', 'referentie', 'reference', 'transactiereferentie']
+}
+
+
+# Parse a CSV statement row by row; the delimiter is detected from the
+# first line
+def parse_csv(stream, encoding='utf-8-sig'):
+    # Uploaded files are SpooledTemporaryFiles which can't be wrapped by
+    # io.TextIOWrapper, so decode using a codecs reader
+    if not isinstance(stream, io.TextIOBase):
+        stream = codecs.getreader(encoding)(stream, errors='replace')
+    header = stream.readline()
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+
+    header = [x.strip().lower() for x in next(csv.reader([header], dialect))]
+    columns = {}
+    for field, names in CSV_COLUMNS.items():
+        for name in names:
+            if name in header:
+                columns[field] = header.index(name)
+                break
+    if 'created' not in columns or 'amount_value' not in columns:
+        raise ValueError(
+            'CSV statement needs at least a date and amount column'
+        )
+
+    def get(row, field):
+        if field not in columns or columns[field] >= len(row):
+            return None
+        return row[columns[field]].strip() or None
+
+    # The header is line 1
+    for line_number, row in enumerate(csv.reader(stream, dialect), 2):
+        if not any(row):
+            continue
+        for field in ['created', 'amount_value']:
+            if not get(row, field):
+                raise ValueError(
+                    'Missing %s on line %s of CSV statement' % (
+                        field, line_number
+                    )
+                )
+
+        amount = parse_amount(get(row, 'amount_value'))
+        debit_credit = (get(row, 'debit_credit') or '').lower()
+        if debit_credit in ['af', 'debit', 'd'] and amount > 0:
+            amount = -amount
+
+        balance = get(row, 'balance_after_mutation_value')
+        counterparty_iban = get(row, 'counterparty_alias_value')
+        yield {
+            'alias_value': get(row, 'alias_value'),
+            'alias_type': 'IBAN',
+            'amount_value': amount,
+            'amount_currency': get(row, 'amount_currency') or 'EUR',
+            'balance_after_mutation_value': (
+                parse_amount(balance) if balance else None
+            ),
+            'counterparty_alias_name': get(row, 'counterparty_alias_name'),
+            'counterparty_alias_value': counterparty_iban,
+            'counterparty_alias_type': 'IBAN' if counterparty_iban else None,
+            'description': get(row, 'description'),
+            'created': parse_date(get(row, 'created')),
+            'reference': get(row, 'reference')
+        }
+
+
+# Detect the format of a statement from its first bytes; the stream needs
+# to be seekable
+def detect_format(stream):
+    start = stream.read(512)
+    stream.seek(0)
+    if isinstance(start, bytes):
+        start = start.decode('latin-1')
+    start = start.lstrip('﻿\r\n\t ')
+    if start.startswith('<'):
+        return 'camt053'
+    if start.startswith(':20:') or start.startswith('{1:'):
+        return 'mt940'
+    return 'csv'
+
+
+def parse_statement(stream, statement_format=None):
+    if not statement_format:
+        statement_format = detect_format(stream)
+
+    if statement_format == 'camt053':
+        return parse_camt053(stream)
+    if statement_format == 'mt940':
+        return parse_mt940(stream)
+    if statement_format == 'csv':
+        return parse_csv(stream)
+    raise ValueError('Unknown statement format: "%s"' % statement_format)
+
+
+# Deterministic key of an entry, used to skip entries that were already
+# imported (e.g., when importing overlapping statements). Identical entries
+# on the same day are distinguished by their occurrence, which is counted
+# per day as statements list the entries of a day together.
+def _import_key(entry, occurrence):
+    key = '|'.join(str(x) for x in [
+        normalize_iban(entry['alias_value']),
+        entry['created'].date().isoformat(),
+        '%.2f' % entry['amount_value'],
+        normalize_iban(entry['counterparty_alias_value']),
+        entry['description'] or '',
+        entry['reference'] or '',
+        occurrence
+    ])
+    return sha256(key.encode('utf-8')).hexdigest()
+
+
+# Import a statement and save its entries as payments in batches. Entries
+# are linked to the given project or subproject, or otherwise to the
+# (sub)project with the IBAN of the statement account. Returns the number
+# of new and skipped (already imported) entries.
+def import_statement(stream, statement_format=None, project_id=None,
+                     subproject_id=None):
+    # Retrieve everything needed to link entries once instead of per entry
+    project_ibans = dict(
+        db.session.query(Project.iban, Project.id).filter(
+            Project.iban.isnot(None)
+        )
+    )
+    subproject_ibans = dict(
+        db.session.query(Subproject.iban, Subproject.id).filter(
+            Subproject.iban.isnot(None)
+        )
+    )
+    matcher = RuleMatcher(
+        CategorizationRule.query.all(),
+        dict(db.session.query(Subproject.id, Subproject.project_id))
+    )
+
+    new_count = 0
+    skipped_count = 0
+    # Occurrences of the entries of the current day, see _import_key
+    occurrences = {}
+    occurrences_day = None
+    batch = {}
+
+    def save(batch):
+        existing_keys = set(
+            x.import_key for x in db.session.query(Payment.import_key).filter(
+                Payment.import_key.in_(list(batch.keys()))
+            )
+        )
+        new_payments = [
+            x for key, x in batch.items() if key not in existing_keys
+        ]
+        db.session.bulk_insert_mappings(Payment, new_payments)
+        # Bulk inserts bypass the flush, so register the changes ourselves
+        mark_changed(
+            db.session,
+            [x['project_id'] for x in new_payments],
+            [x['subproject_id'] for x in new_payments]
+        )
+        db.session.commit()
+        return len(new_payments), len(existing_keys)
+
+    for entry in parse_statement(stream, statement_format):
+        day = (entry['alias_value'], entry['created'].date())
+        if day != occurrences_day:
+            occurrences = {}
+            occurrences_day = day
+        base_key = _import_key(entry, 0)
+        occurrences[base_key] = occurrences.get(base_key, -1) + 1
+        key = _import_key(entry, occurrences[base_key])
+        del entry['reference']
+
+        payment = dict(
+            entry,
+            import_key=key,
+            type='IMPORT',
+            project_id=None,
+            subproject_id=None
+        )
+        if subproject_id:
+            payment['subproject_id'] = subproject_id
+        elif project_id:
+            payment['project_id'] = project_id
+        else:
+            payment['project_id'] = project_ibans.get(entry['alias_value'])
+            payment['subproject_id'] = subproject_ibans.get(
+                entry['alias_value']
+            )
+
+        if payment['amount_value'] > 0:
+            payment['route'] = 'inkomsten'
+        else:
+            payment['route'] = 'uitgaven'
+        categorized = SimpleNamespace(**payment)
+        if matcher.categorize(categorized):
+            payment['category_id'] = getattr(categorized, 'category_id', None)
+            payment['route'] = categorized.route
+
+        batch[key] = payment
+        if len(batch) >= BATCH_SIZE:
+            new, skipped = save(batch)
+            new_count += new
+            skipped_count += skipped
+            batch = {}
+
+    if batch:
+        new, skipped = save(batch)
+        new_count += new
+        skipped_count += skipped
+
+    return new_count, skipped_count
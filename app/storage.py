@@ -0,0 +1,476 @@
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+from glob import escape, glob
+from hashlib import sha256 as _sha256
+from tempfile import NamedTemporaryFile
+import os
+import secrets
+import shutil
+
+from flask import Response, send_from_directory
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+
+from app import app, db
+from app.models import Blob, File, get_variant_filename
+from app.storage_s3 import S3Storage
+from app.util import get_upload_path
+
+
+# Content-addressed storage of uploads. The content of an upload is hashed
+# while it is received and stored once as a blob under its SHA-256 with key
+# blobs/<first two characters>/<sha256>, no matter how many Files (e.g., the
+# same receipt attached to several payments) refer to it. Each Blob keeps a
+# count of the Files referring to it. Blobs are stored by a backend: the local
+# upload folder or an S3 compatible bucket, see STORAGE_BACKEND in config.py.
+
+# Upload folders used before uploads were stored as blobs; they are also the
+# first part of upload URLs, e.g., /upload/transaction-attachment/<filename>
+UPLOAD_FOLDERS = ['transaction-attachment', 'user-image']
+
+CHUNK_SIZE = 64 * 1024
+
+# The mimetype of an upload is determined from its first bytes instead of
+# trusting the browser
+SNIFF_SIZE = 512
+
+MAGIC_NUMBERS = [
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+]
+
+# Office documents are zip (OOXML and ODF) or OLE (doc and xls) containers,
+# their type follows from their extension
+CONTAINER_MAGIC_NUMBERS = [b'PK\x03\x04', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1']
+CONTAINER_MIMETYPES = {
+    '.doc': 'application/msword',
+    '.docx': (
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.'
+        'document'
+    ),
+    '.odt': 'application/vnd.oasis.opendocument.text',
+    '.ods': 'application/vnd.oasis.opendocument.spreadsheet',
+    '.xls': 'application/vnd.ms-excel',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+# Stores uploads in the local UPLOAD_FOLDER, which nginx can send from its
+# internal /protected-upload/ location (see docker/nginx/conf.d)
+class LocalStorage:
+    name = 'local'
+
+    def get_path(self, key):
+        return get_upload_path(*os.path.split(key))
+
+    def exists(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def open(self, key):
+        return open(self.get_path(key), 'rb')
+
+    # Move a local file into storage
+    def save(self, key, path):
+        os.makedirs(os.path.dirname(self.get_path(key)), exist_ok=True)
+        shutil.move(path, self.get_path(key))
+
+    def move(self, key, new_key):
+        self.save(new_key, self.get_path(key))
+
+    # Delete the file of a key and all files whose key starts with it (e.g.,
+    # a blob and its resized variants). Returns the number of bytes deleted.
+    def delete_prefix(self, key):
+        size = 0
+        for path in glob(escape(self.get_path(key)) + '*'):
+            size += os.path.getsize(path)
+            os.remove(path)
+        return size
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.get_path(key))
+            except FileNotFoundError:
+                pass
+
+    # Yield the key, size and modification time of all files whose key starts
+    # with the given prefix, ordered by key and starting after start_after
+    def list(self, prefix='', start_after=None):
+        after = start_after.split('/') if start_after else []
+
+        def walk(parts):
+            folder = get_upload_path('/'.join(parts), '')
+            try:
+                entries = sorted(os.scandir(folder), key=lambda x: x.name)
+            except FileNotFoundError:
+                return
+            for entry in entries:
+                entry_parts = parts + [entry.name]
+                key = '/'.join(entry_parts)
+                if entry.is_dir(follow_symlinks=False):
+                    # Skip folders before start_after or outside the prefix
+                    if entry_parts < after[:len(entry_parts)]:
+                        continue
+                    if key.startswith(prefix) or prefix.startswith(key + '/'):
+                        yield from walk(entry_parts)
+                elif entry_parts > after and key.startswith(prefix):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield (
+                        key,
+                        stat.st_size,
+                        datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+                    )
+
+        return walk([])
+
+    # A local path of the file, for tools that need one (e.g., Pillow)
+    @contextmanager
+    def local_copy(self, key):
+        yield self.get_path(key)
+
+    def get_download_response(self, key, mimetype):
+        if app.config.get('X_ACCEL_REDIRECT'):
+            response = Response(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = '/protected-upload/%s' % (key)
+        else:
+            response = send_from_directory(
+                os.path.dirname(self.get_path(key)),
+                os.path.basename(key),
+                mimetype=mimetype
+            )
+        # Only the browser of this user may cache the file, as it can be hidden
+        response.headers['Cache-Control'] = 'private, max-age=3600'
+        return response
+
+    # Browsers upload to the app in chunks instead, see append_partial_upload
+    def get_direct_upload(self, key, max_size):
+        return None
+
+
+BACKENDS = {
+    'local': LocalStorage,
+    's3': S3Storage
+}
+
+
+# The backend is created once per process, see STORAGE_BACKEND in config.py
+def get_backend():
+    name = app.config.get('STORAGE_BACKEND', 'local')
+    backend = app.extensions.get('storage')
+    if backend is None or backend.name != name:
+        backend = app.extensions['storage'] = BACKENDS[name]()
+    return backend
+
+
+def get_blob_key(sha256, filename=None):
+    return 'blobs/%s/%s' % (sha256[:2], filename or sha256)
+
+
+# Returns the key under which the content of a File, or one of its resized
+# variants (see app/images.py), is stored. Files uploaded before blobs were
+# used are stored in the folder of their URL.
+def get_key(file, filename=None, folder=None):
+    filename = filename or file.filename
+    if file.blob:
+        if filename == file.filename:
+            filename = file.blob.sha256
+        return get_blob_key(file.blob.sha256, filename)
+    return '%s/%s' % (folder, filename)
+
+
+# Filename of a File stored as the given blob: its SHA-256 with the extension
+# of the uploaded file, e.g., <sha256>.pdf
+def get_blob_filename(blob, filename):
+    extension = os.path.splitext(secure_filename(filename))[1].lower()
+    return blob.sha256 + extension
+
+
+# Return the Blob of the given content with one more reference. store(key)
+# puts the content in storage if the blob doesn't exist yet, otherwise
+# discard() removes it.
+def _add_blob(sha256, size, store, discard):
+    key = get_blob_key(sha256)
+    blob = Blob.query.filter_by(sha256=sha256).first()
+    if not blob:
+        store(key)
+        try:
+            # A savepoint, so a concurrent upload of the same content doesn't
+            # roll back the caller's changes
+            with db.session.begin_nested():
+                blob = Blob(sha256=sha256, size=size, reference_count=1)
+                db.session.add(blob)
+            return blob
+        except IntegrityError:
+            blob = Blob.query.filter_by(sha256=sha256).one()
+    elif get_backend().exists(key):
+        discard()
+    else:
+        # The blob's content went missing, restore it
+        store(key)
+
+    Blob.query.filter_by(id=blob.id).update(
+        {'reference_count': Blob.reference_count + 1},
+        synchronize_session=False
+    )
+    db.session.expire(blob, ['reference_count'])
+    return blob
+
+
+# Add a local file to the blob store, it is moved into storage or removed
+def _add_local_file(path, sha256, size):
+    return _add_blob(
+        sha256,
+        size,
+        lambda key: get_backend().save(key, path),
+        lambda: os.remove(path)
+    )
+
+
+# Determine the mimetype of a file from its first bytes and its filename
+def sniff_mimetype(head, filename):
+    for magic_number, mimetype in MAGIC_NUMBERS:
+        if head.startswith(magic_number):
+            return mimetype
+    extension = os.path.splitext(filename)[1].lower()
+    if any(head.startswith(x) for x in CONTAINER_MAGIC_NUMBERS):
+        return CONTAINER_MIMETYPES.get(extension, 'application/octet-stream')
+    if extension == '.txt' and b'\0' not in head:
+        return 'text/plain'
+    return 'application/octet-stream'
+
+
+# Copy a stream to a file in chunks, so it is never completely held in
+# memory, while (optionally) hashing it. Returns the size and the first bytes.
+def _copy_stream(stream, f, content_hash=None, max_size=None):
+    size = 0
+    head = b''
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise ValueError('The stream is larger than %s bytes' % (max_size))
+        if len(head) < SNIFF_SIZE:
+            head += chunk[:SNIFF_SIZE - len(head)]
+        if content_hash:
+            content_hash.update(chunk)
+        f.write(chunk)
+    return size, head
+
+
+def _get_tmp_folder():
+    folder = get_upload_path('blobs', 'tmp')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+# Store the content of a stream (e.g., an uploaded file) while hashing it and
+# sniffing its mimetype. Returns its Blob and mimetype.
+def store_stream(stream, filename):
+    with NamedTemporaryFile(dir=_get_tmp_folder(), delete=False) as tmp:
+        content_hash = _sha256()
+        try:
+            size, head = _copy_stream(stream, tmp, content_hash)
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+    blob = _add_local_file(tmp.name, content_hash.hexdigest(), size)
+    return blob, sniff_mimetype(head, filename)
+
+
+# Move a file that is already in the upload folder into the blob store
+def store_path(path):
+    content_hash = _sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return _add_local_file(
+        path, content_hash.hexdigest(), os.path.getsize(path)
+    )
+
+
+# Create a File for the content of a stream, deduplicated via its blob
+def create_file(stream, filename, mediatype):
+    blob, mimetype = store_stream(stream, filename)
+    return File(
+        filename=get_blob_filename(blob, filename),
+        mimetype=mimetype,
+        mediatype=mediatype,
+        blob=blob
+    )
+
+
+# Returns a new File with the content of the given File, which only adds a
+# reference to its blob
+def copy_file(file):
+    Blob.query.filter_by(id=file.blob.id).update(
+        {'reference_count': Blob.reference_count + 1},
+        synchronize_session=False
+    )
+    db.session.expire(file.blob, ['reference_count'])
+    return File(
+        filename=file.filename,
+        mimetype=file.mimetype,
+        mediatype=file.mediatype,
+        blob=file.blob
+    )
+
+
+# Resumable uploads are appended to a temporary file in chunks (each in its
+# own request) until they are complete, see routes.attachment_upload. If the
+# backend supports it, browsers upload directly to storage instead.
+
+def get_partial_upload_path(token):
+    return os.path.join(_get_tmp_folder(), 'upload-%s' % (token))
+
+
+def get_direct_upload_key(token):
+    return 'uploads/%s' % (token)
+
+
+# Returns the token of a new upload and, if the backend supports it, the URL
+# and form fields to upload the file directly to storage
+def start_upload(size):
+    token = secrets.token_hex(16)
+    direct_upload = get_backend().get_direct_upload(
+        get_direct_upload_key(token), size
+    )
+    if not direct_upload:
+        open(get_partial_upload_path(token), 'wb').close()
+    return token, direct_upload
+
+
+# Returns the number of bytes received of a resumable upload, or None if it
+# doesn't exist
+def get_partial_upload_size(token):
+    try:
+        return os.path.getsize(get_partial_upload_path(token))
+    except OSError:
+        return None
+
+
+# Append a chunk to a resumable upload. The offset must equal the number of
+# bytes received so far, otherwise a ValueError is raised and the client has
+# to resume from get_partial_upload_size. Returns the new number of bytes
+# received.
+def append_partial_upload(token, stream, offset, size):
+    path = get_partial_upload_path(token)
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() != offset:
+            raise ValueError('Expected offset %s, got %s' % (f.tell(), offset))
+        try:
+            received, _ = _copy_stream(stream, f, max_size=size - offset)
+        except BaseException:
+            # Discard the incomplete chunk, the client resends it
+            f.truncate(offset)
+            raise
+    return offset + received
+
+
+# Create a File for a completed resumable upload, deduplicated via its blob
+def complete_partial_upload(token, filename, mediatype):
+    path = get_partial_upload_path(token)
+    with open(path, 'rb') as f:
+        head = f.read(SNIFF_SIZE)
+    blob = store_path(path)
+    return File(
+        filename=get_blob_filename(blob, filename),
+        mimetype=sniff_mimetype(head, filename),
+        mediatype=mediatype,
+        blob=blob
+    )
+
+
+# Create a File for a completed direct upload. Its content is read once from
+# storage to hash it and is then moved within storage. Raises a ValueError if
+# the upload doesn't exist or doesn't have the expected size.
+def complete_direct_upload(token, filename, mediatype, size):
+    backend = get_backend()
+    key = get_direct_upload_key(token)
+    if not backend.exists(key):
+        raise ValueError('Upload %s does not exist' % (token))
+    content_hash = _sha256()
+    with closing(backend.open(key)) as f:
+        received, head = _copy_stream(f, _NullFile(), content_hash)
+    if received != size:
+        backend.delete_prefix(key)
+        raise ValueError('Expected %s bytes, got %s' % (size, received))
+    blob = _add_blob(
+        content_hash.hexdigest(),
+        size,
+        lambda blob_key: backend.move(key, blob_key),
+        lambda: backend.delete_prefix(key)
+    )
+    return File(
+        filename=get_blob_filename(blob, filename),
+        mimetype=sniff_mimetype(head, filename),
+        mediatype=mediatype,
+        blob=blob
+    )
+
+
+class _NullFile:
+    def write(self, data):
+        pass
+
+
+# Delete an unreferenced blob and its content (including its resized
+# variants). Returns whether it was deleted.
+def purge_blob(blob_id):
+    blob = Blob.query.get(blob_id)
+    if not blob:
+        return False
+    key = get_blob_key(blob.sha256)
+    deleted = Blob.query.filter(
+        Blob.id == blob_id,
+        Blob.reference_count <= 0,
+        ~Blob.id.in_(
+            db.session.query(File.blob_id).filter(File.blob_id == blob_id)
+        )
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    if deleted:
+        get_backend().delete_prefix(key)
+    return bool(deleted)
+
+
+# Delete a File and, if no other File refers to its content, its blob
+def delete_file(file_id):
+    blob_id = db.session.query(File.blob_id).filter_by(id=file_id).scalar()
+    File.query.filter_by(id=file_id).delete()
+    db.session.commit()
+    if blob_id:
+        purge_blob(blob_id)
+
+
+# Move a File uploaded before blobs were used (and its resized variants) into
+# the blob store. Returns False if its content can't be found.
+def migrate_file(file):
+    for folder in UPLOAD_FOLDERS:
+        path = get_upload_path(folder, file.filename)
+        if os.path.exists(path):
+            break
+    else:
+        return False
+
+    old_filename = file.filename
+    blob = store_path(path)
+    file.blob = blob
+    file.filename = get_blob_filename(blob, old_filename)
+
+    backend = get_backend()
+    old_stem = os.path.splitext(path)[0]
+    for width in file.variants or []:
+        for variant_path in glob(escape(old_stem) + '_%sw.*' % (width)):
+            extension = os.path.splitext(variant_path)[1][1:]
+            variant_key = get_key(
+                file, get_variant_filename(file.filename, width, extension)
+            )
+            if backend.exists(variant_key):
+                os.remove(variant_path)
+            else:
+                backend.save(variant_key, variant_path)
+    return True
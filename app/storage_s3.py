@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+import os
+
+from flask import redirect
+
+from app import app
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+
+# Stores uploads in a bucket of S3 or an S3 compatible service (e.g., MinIO),
+# so the app can run on multiple nodes. Browsers download files from and
+# upload files to the bucket directly with presigned URLs, see
+# app/storage.py for the interface.
+class S3Storage:
+    name = 's3'
+
+    def __init__(self):
+        if boto3 is None:
+            raise RuntimeError('Install boto3 to use the s3 storage backend')
+        self.bucket = app.config['S3_BUCKET']
+        self.client = boto3.client(
+            's3',
+            endpoint_url=app.config.get('S3_ENDPOINT_URL'),
+            region_name=app.config.get('S3_REGION'),
+            aws_access_key_id=app.config.get('S3_ACCESS_KEY_ID'),
+            aws_secret_access_key=app.config.get('S3_SECRET_ACCESS_KEY')
+        )
+        # Seconds presigned URLs are valid
+        self.expires = app.config.get('S3_URL_EXPIRES', 600)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return False
+            raise
+        return True
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    # Move a local file into storage
+    def save(self, key, path):
+        self.client.upload_file(path, self.bucket, key)
+        os.remove(path)
+
+    def move(self, key, new_key):
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=new_key,
+            CopySource={'Bucket': self.bucket, 'Key': key}
+        )
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    # Delete the object of a key and all objects whose key starts with it.
+    # Returns the number of bytes deleted.
+    def delete_prefix(self, key):
+        size = 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=key):
+            objects = page.get('Contents', [])
+            size += sum(x['Size'] for x in objects)
+            self.delete([x['Key'] for x in objects])
+        return size
+
+    def delete(self, keys):
+        keys = list(keys)
+        # At most 1000 objects can be deleted per request
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]]}
+            )
+
+    # Yield the key, size and modification time of all objects whose key
+    # starts with the given prefix, ordered by key and starting after
+    # start_after
+    def list(self, prefix='', start_after=None):
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=self.bucket, Prefix=prefix, StartAfter=start_after or ''
+        )
+        for page in pages:
+            for x in page.get('Contents', []):
+                yield x['Key'], x['Size'], x['LastModified']
+
+    # A local path of the file, for tools that need one (e.g., Pillow)
+    @contextmanager
+    def local_copy(self, key):
+        with NamedTemporaryFile(delete=False) as tmp:
+            self.client.download_fileobj(self.bucket, key, tmp)
+        try:
+            yield tmp.name
+        finally:
+            os.remove(tmp.name)
+
+    # Redirect to a presigned URL, so the file isn't sent through the app
+    def get_download_response(self, key, mimetype):
+        response = redirect(
+            self.client.generate_presigned_url(
+                'get_object',
+                Params={
+                    'Bucket': self.bucket,
+                    'Key': key,
+                    'ResponseContentType': mimetype
+                },
+                ExpiresIn=self.expires
+            )
+        )
+        # The redirect may only be cached while the URL is valid
+        response.headers['Cache-Control'] = 'private, max-age=%s' % (
+            self.expires // 2
+        )
+        return response
+
+    # Returns the URL and form fields to upload a file of at most max_size
+    # bytes directly to the bucket
+    def get_direct_upload(self, key, max_size):
+        return self.client.generate_presigned_post(
+            self.bucket,
+            key,
+            Conditions=[['content-length-range', 1, max_size]],
+            ExpiresIn=self.expires
+        )
@@ -1,22 +1,28 @@
-from babel.numbers import format_percent
-from flask import flash, redirect, url_for
-from os import urandom
+from flask import (
+    Response, flash, get_flashed_messages, make_response, redirect, session,
+    stream_with_context, url_for
+)
 from os.path import abspath, dirname, exists, join
-from datetime import datetime
-from time import sleep
+from datetime import datetime, timezone
+from time import sleep, time
 import json
 import jwt
-import locale
 import os
+import re
 import requests
 import socket
 import sys
 
-from app import app, db
+from app import app, db, formatting
 from app.email import send_invite
-from app.models import Payment, Project, Subproject, IBAN, User
-
-from sqlalchemy import or_
+from app.categorization import RuleMatcher
+from app.models import (
+    CategorizationRule, Payment, Project, Subproject, IBAN, User, UserStory,
+    mark_changed, mark_permissions_changed, project_user, subproject_user
+)
+from app.permissions import get_permissions
+
+from sqlalchemy import func, or_
 from sqlalchemy.exc import IntegrityError
 from bunq.sdk.context.bunq_context import ApiContext
 from bunq.sdk.context.api_environment_type import ApiEnvironmentType
@@ -26,6 +32,100 @@ sys.path.insert(0, abspath(join(dirname(__file__), '../tinker/tinker')))
 from libs.bunq_lib import BunqLib
 
 
+# Number of template output chunks combined before they are sent when
+# streaming a template
+STREAM_BUFFER_SIZE = 100
+
+
+# Render a template as a stream, so the start of the page (e.g., the header
+# and totals) is sent while large payment tables are still rendered
+def stream_template(template_name, **context):
+    # The flashed messages are removed from the session, which can't be
+    # saved anymore once the response is streaming, so retrieve them now
+    get_flashed_messages()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    response = Response(stream_with_context(stream))
+    # Don't let Nginx buffer the whole response
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Part of the ETags of the public pages, so cached pages are invalidated
+# when the app (and possibly its templates) is restarted
+STARTED = int(time())
+
+
+# Convert a timestamp to a naive UTC datetime without microseconds, as used
+# in the Last-Modified and If-Modified-Since headers
+def _get_http_datetime(*timestamps):
+    timestamps = [
+        x.astimezone(timezone.utc).replace(tzinfo=None) if x.tzinfo else x
+        for x in timestamps if x
+    ]
+    if not timestamps:
+        return None
+    return max(timestamps).replace(microsecond=0)
+
+
+# Returns the ETag and Last-Modified of the index page, which change
+# whenever a project is added, removed or changed
+def get_index_validators():
+    count, version, modified = db.session.query(
+        func.count(Project.id),
+        func.sum(Project.version),
+        func.max(Project.modified)
+    ).one()
+    etag = 'index-%s-%s-%s-%s' % (
+        STARTED, count, version or 0, UserStory.query.count()
+    )
+    return etag, _get_http_datetime(modified)
+
+
+def get_project_validators(project):
+    etag = 'project-%s-%s-%s' % (STARTED, project.id, project.version)
+    return etag, _get_http_datetime(project.modified)
+
+
+def get_subproject_validators(subproject):
+    etag = 'subproject-%s-%s-%s-%s' % (
+        STARTED, subproject.id, subproject.version, subproject.project.version
+    )
+    return etag, _get_http_datetime(
+        subproject.modified, subproject.project.modified
+    )
+
+
+# Return a 304 Not Modified response if the page cached by the client is
+# still valid, otherwise call render to create the page. Both responses
+# contain the ETag and Last-Modified, so the client can validate its cache
+# on the next request.
+def conditional_response(request, etag, last_modified, render):
+    # Flashed messages are only shown once, so don't cache those pages
+    if '_flashes' in session:
+        return make_response(render())
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = bool(
+            last_modified and request.if_modified_since
+            and last_modified <= request.if_modified_since.replace(tzinfo=None)
+        )
+
+    if not_modified:
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    # Always let the client validate its cached page
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 # Process Bunq OAuth callback (this will redirect to the project page)
 def process_bunq_oauth_callback(request, current_user):
     base_url_token = 'https://api.oauth.bunq.com'
@@ -61,12 +161,8 @@ def process_bunq_oauth_callback(request, current_user):
 
         # A project owner is either an admin or a user that is part
         # of the project where this subproject belongs to
-        project_owner = False
         project = Project.query.filter_by(id=project_id).first()
-        if current_user.is_authenticated and (
-            current_user.admin or project.has_user(current_user.id)
-        ):
-            project_owner = True
+        project_owner = get_permissions().is_project_owner(project.id)
 
         if project_owner:
             # If authorization code, retrieve access token from Bunq
@@ -202,7 +298,53 @@ def _transform_payment(payment):
     return result
 
 
-def get_new_payments(project_id):
+# Save a transformed Bunq payment to the database; returns False if the
+# payment already exists. If a RuleMatcher is given the payment is
+# categorized using the categorization rules of its (sub)project.
+def _save_payment(payment, matcher=None):
+    existing_payment = Payment.query.filter_by(
+        bank_payment_id=payment['bank_payment_id']
+    ).first()
+    if existing_payment:
+        return False
+
+    project = Project.query.filter_by(
+        iban=payment['alias_value']
+    ).first()
+    if project:
+        payment['project_id'] = project.id
+
+    subproject = Subproject.query.filter_by(
+        iban=payment['alias_value']
+    ).first()
+    if subproject:
+        payment['subproject_id'] = subproject.id
+
+    # Remove these values that sometimes occur in Bunq payments as we
+    # don't use them
+    if 'scheduled_id' in payment:
+        del payment['scheduled_id']
+
+    if 'batch_id' in payment:
+        del payment['batch_id']
+
+    p = Payment(**payment)
+    if float(p.amount_value.replace(",", ".")) > 0:
+        p.route = 'inkomsten'
+    else:
+        p.route = 'uitgaven'
+    if matcher:
+        matcher.categorize(p)
+    db.session.add(p)
+    db.session.commit()
+    return True
+
+
+def get_new_payments(project_id, matcher=None):
+    # Compile the categorization rules once for all retrieved pages
+    if matcher is None:
+        matcher = get_rule_matcher()
+
     # Loop over all monetary accounts (i.e., all IBANs belonging to one
     # Bunq account)
     for monetary_account in get_all_monetary_account_active(project_id):
@@ -248,41 +390,10 @@ def get_new_payments(project_id):
                     new_payments = False
                     continue
                 try:
-                    existing_payment = Payment.query.filter_by(
-                        bank_payment_id=payment['bank_payment_id']
-                    ).first()
-
-                    if existing_payment:
-                        new_payments = False
-                    else:
-                        project = Project.query.filter_by(
-                            iban=payment['alias_value']
-                        ).first()
-                        if project:
-                            payment['project_id'] = project.id
-
-                        subproject = Subproject.query.filter_by(
-                            iban=payment['alias_value']
-                        ).first()
-                        if subproject:
-                            payment['subproject_id'] = subproject.id
-
-                        # Remove these values that sometimes occur in Bunq
-                        # payments as we don't use them
-                        if 'scheduled_id' in payment:
-                            del payment['scheduled_id']
-
-                        if 'batch_id' in payment:
-                            del payment['batch_id']
-
-                        p = Payment(**payment)
-                        if float(p.amount_value.replace(",", ".")) > 0:
-                            p.route = 'inkomsten'
-                        else:
-                            p.route = 'uitgaven'
-                        db.session.add(p)
-                        db.session.commit()
+                    if _save_payment(payment, matcher):
                         new_payments_count += 1
+                    else:
+                        new_payments = False
                 except Exception as e:
                     app.logger.error(
                         "Saving a Bunq payment resulted in an exception:\n" + repr(e)
@@ -307,6 +418,233 @@ def get_new_payments(project_id):
         )
 
 
+# Returns the project ids of all subprojects, used by a RuleMatcher to apply
+# the rules of a project to the payments of its subprojects
+def get_subproject_projects():
+    return dict(db.session.query(Subproject.id, Subproject.project_id))
+
+
+# Compile the categorization rules of all (sub)projects, or only those of
+# the given project or subproject, into one RuleMatcher
+def get_rule_matcher(project_id=None, subproject_id=None):
+    rules = CategorizationRule.query
+    if subproject_id:
+        rules = rules.filter_by(subproject_id=subproject_id)
+    elif project_id:
+        rules = rules.filter_by(project_id=project_id)
+    return RuleMatcher(rules.all(), get_subproject_projects())
+
+
+# Apply the categorization rules of a project (including the rules of its
+# subprojects) or of a single subproject to all of its payments that don't
+# have a category yet. Returns the number of categorized payments.
+def apply_categorization_rules(project_id=None, subproject_id=None):
+    if subproject_id:
+        rules = CategorizationRule.query.filter_by(subproject_id=subproject_id)
+        scope = Payment.subproject_id == subproject_id
+    else:
+        subproject_ids = db.session.query(Subproject.id).filter_by(
+            project_id=project_id
+        ).subquery()
+        rules = CategorizationRule.query.filter(or_(
+            CategorizationRule.project_id == project_id,
+            CategorizationRule.subproject_id.in_(subproject_ids)
+        ))
+        scope = or_(
+            Payment.project_id == project_id,
+            Payment.subproject_id.in_(subproject_ids)
+        )
+
+    matcher = RuleMatcher(rules.all(), get_subproject_projects())
+    if not len(matcher):
+        return 0
+
+    # Only select the columns the matcher needs and group the matching
+    # payment ids per update so each group is a single UPDATE query
+    updates = {}
+    payments = db.session.query(
+        Payment.id,
+        Payment.project_id,
+        Payment.subproject_id,
+        Payment.counterparty_alias_value,
+        Payment.counterparty_alias_name,
+        Payment.description,
+        Payment.amount_value
+    ).filter(scope, Payment.category_id.is_(None)).yield_per(1000)
+    for payment in payments:
+        rule = matcher.match(payment)
+        if rule:
+            updates.setdefault(
+                (rule.category_id, rule.route), []
+            ).append(payment.id)
+
+    categorized_count = 0
+    for (category_id, route), payment_ids in updates.items():
+        new_payment_data = {}
+        if category_id:
+            new_payment_data['category_id'] = category_id
+        if route:
+            new_payment_data['route'] = route
+        for i in range(0, len(payment_ids), 1000):
+            Payment.query.filter(
+                Payment.id.in_(payment_ids[i:i + 1000])
+            ).update(new_payment_data, synchronize_session=False)
+        categorized_count += len(payment_ids)
+    db.session.commit()
+
+    return categorized_count
+
+
+# Balances are stored as floats, so allow for rounding differences when
+# checking whether consecutive payments add up
+BALANCE_TOLERANCE = 0.005
+
+
+# Find gaps in the ledgers of the given monetary accounts (or all accounts
+# if none are given). Each Bunq payment stores the balance after the
+# mutation, so for consecutive payments (ordered by bank_payment_id) the
+# previous balance plus the amount should equal the new balance. If it
+# doesn't then one or more payments between the two are missing. The
+# check is done in a single query using window functions.
+def get_balance_gaps(monetary_account_ids=None):
+    window = {
+        'partition_by': Payment.monetary_account_id,
+        'order_by': Payment.bank_payment_id
+    }
+    ledger = db.session.query(
+        Payment.monetary_account_id.label('monetary_account_id'),
+        Payment.bank_payment_id.label('bank_payment_id'),
+        Payment.amount_value.label('amount_value'),
+        Payment.balance_after_mutation_value.label('balance'),
+        func.lag(Payment.bank_payment_id).over(**window).label(
+            'previous_bank_payment_id'
+        ),
+        func.lag(Payment.balance_after_mutation_value).over(**window).label(
+            'previous_balance'
+        )
+    ).filter(
+        Payment.bank_payment_id.isnot(None),
+        Payment.balance_after_mutation_value.isnot(None)
+    )
+    if monetary_account_ids is not None:
+        ledger = ledger.filter(
+            Payment.monetary_account_id.in_(monetary_account_ids)
+        )
+    ledger = ledger.subquery()
+
+    missing_amount = (
+        ledger.c.balance - ledger.c.previous_balance - ledger.c.amount_value
+    )
+    gaps = db.session.query(
+        ledger.c.monetary_account_id,
+        ledger.c.previous_bank_payment_id,
+        ledger.c.bank_payment_id,
+        missing_amount.label('missing_amount')
+    ).filter(
+        ledger.c.previous_balance.isnot(None),
+        func.abs(missing_amount) > BALANCE_TOLERANCE
+    ).order_by(
+        ledger.c.monetary_account_id,
+        ledger.c.bank_payment_id
+    )
+
+    # The missing payments lie strictly between after_id and before_id
+    return [
+        {
+            'monetary_account_id': gap.monetary_account_id,
+            'after_id': gap.previous_bank_payment_id,
+            'before_id': gap.bank_payment_id,
+            'missing_amount': round(gap.missing_amount, 2)
+        }
+        for gap in gaps
+    ]
+
+
+# Retrieve only the payments of a monetary account with a bank_payment_id
+# between after_id and before_id. The Bunq API context of the project the
+# monetary account belongs to needs to be loaded.
+def get_missing_payments(monetary_account_id, after_id, before_id,
+                         matcher=None):
+    new_payments_count = 0
+    newer_id = after_id
+    while newer_id < before_id:
+        try:
+            # Bunq allows max 3 requests per 3 seconds
+            sleep(1)
+            payments = endpoint.Payment.list(
+                monetary_account_id=monetary_account_id,
+                params={'newer_id': newer_id, 'count': 200}
+            )
+        except Exception as e:
+            app.logger.info(
+                "Getting Bunq payments resulted in an exception:\n" + repr(e)
+            )
+            break
+
+        if not payments.value:
+            break
+
+        for full_payment in payments.value:
+            try:
+                payment = _transform_payment(full_payment)
+                newer_id = max(newer_id, payment['bank_payment_id'])
+                if payment['bank_payment_id'] >= before_id:
+                    continue
+                if _save_payment(payment, matcher):
+                    new_payments_count += 1
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(
+                    "Saving a Bunq payment resulted in an exception:\n" + repr(e)
+                )
+
+        if not payments.pagination.has_next_page():
+            break
+
+    return new_payments_count
+
+
+# Check the ledgers of all monetary accounts of a project for gaps and,
+# if refetch is True, retrieve the missing payments of each gap
+def verify_balances(project_id, refetch=True):
+    monetary_accounts = get_all_monetary_account_active(project_id)
+    if not monetary_accounts:
+        return []
+
+    gaps = get_balance_gaps([x._id_ for x in monetary_accounts])
+    matcher = None
+    if gaps and refetch:
+        matcher = get_rule_matcher()
+    for gap in gaps:
+        app.logger.warning(
+            'Project %s: balance gap of %s in monetary account %s between '
+            'payments %s and %s' % (
+                project_id,
+                gap['missing_amount'],
+                gap['monetary_account_id'],
+                gap['after_id'],
+                gap['before_id']
+            )
+        )
+        if refetch:
+            new_payments_count = get_missing_payments(
+                gap['monetary_account_id'],
+                gap['after_id'],
+                gap['before_id'],
+                matcher
+            )
+            app.logger.info(
+                'Project %s: retrieved %s missing payments for monetary '
+                'account %s' % (
+                    project_id,
+                    new_payments_count,
+                    gap['monetary_account_id']
+                )
+            )
+
+    return gaps
+
+
 def human_format(num):
     magnitude = 0
     while abs(num) >= 1000:
@@ -314,18 +652,15 @@ def human_format(num):
         num /= 1000.0
 
     if magnitude > 0:
-        return '%s%s' % (locale.format("%.1f", num), ['', 'K', 'M'][magnitude])
+        return '%s%s' % (
+            formatting.format_one_decimal(num), ['', 'K', 'M'][magnitude]
+        )
     else:
-        return locale.format("%.1f", round(num))
+        return formatting.format_one_decimal(round(num))
 
 
 def format_currency(num, currency_symbol='€ '):
-    return '%s%s' % (
-        currency_symbol,
-        locale.format(
-            "%d", round(num), grouping=True, monetary=True
-        )
-    )
+    return '%s%s' % (currency_symbol, formatting.format_whole_amount(round(num)))
 
 
 def calculate_project_amounts(project_id):
@@ -362,11 +697,11 @@ def calculate_project_amounts(project_id):
 
     if denominator == 0:
         amounts['percentage_spent_str'] = (
-            format_percent(0)
+            formatting.format_percent(0)
         )
     else:
         amounts['percentage_spent_str'] = (
-            format_percent(
+            formatting.format_percent(
                 amounts['spent'] / denominator
             )
         )
@@ -416,11 +751,11 @@ def calculate_subproject_amounts(subproject_id):
 
     if denominator == 0:
         amounts['percentage_spent_str'] = (
-            format_percent(0)
+            formatting.format_percent(0)
         )
     else:
         amounts['percentage_spent_str'] = (
-            format_percent(
+            formatting.format_percent(
                 amounts['spent'] / denominator
             )
         )
@@ -472,43 +807,203 @@ def validate_on_submit(form, request):
         return False
 
 
-def _set_user_role(user, admin=False, project_id=0, subproject_id=0):
-    if admin:
-        user.admin = True
-        db.session.commit()
-    if project_id:
-        project = Project.query.get(project_id)
-        if user in project.users:
-            raise ValueError('Gebruiker niet toegevoegd: deze gebruiker was al initiatiefnemer van dit initiatief')
-        project.users.append(user)
-        db.session.commit()
-    if subproject_id:
-        subproject = Subproject.query.get(subproject_id)
-        if user in subproject.users:
-            raise ValueError('Gebruiker niet toegevoegd: deze gebruiker was al activiteitnemer van deze activiteit')
-        subproject.users.append(user)
-        db.session.commit()
+# Number of users and memberships looked up and inserted per query by
+# add_users
+USER_BATCH_SIZE = 500
+
+EMAIL_ADDRESS = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def _batches(items, size=USER_BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Add users to (sub)projects in bulk, e.g., all activity leads of a
+# programme. invites is a list of (email, project_id, subproject_id) tuples
+# (the ids can be 0). Existing users are looked up and memberships are
+# inserted in batches and the invitations of the new users are queued in the
+# outbox, all in one transaction. Returns the emails of the invited (new)
+# users, the number of added memberships and the invites of which the user
+# already was a member of the (sub)project.
+def add_users(invites, admin=False):
+    invites = [
+        (email.strip(), project_id or 0, subproject_id or 0)
+        for email, project_id, subproject_id in invites
+    ]
+    for model, index, name in [
+        (Project, 1, 'Initiatief'), (Subproject, 2, 'Activiteit')
+    ]:
+        target_ids = {x[index] for x in invites if x[index]}
+        found_ids = set()
+        for batch in _batches(target_ids):
+            found_ids.update(
+                x[0] for x in db.session.query(model.id).filter(
+                    model.id.in_(batch)
+                )
+            )
+        if target_ids - found_ids:
+            raise ValueError(
+                '%s %s bestaat niet' % (name, min(target_ids - found_ids))
+            )
 
+    emails = list(dict.fromkeys(x[0] for x in invites))
+    users = {}
+    for batch in _batches(emails):
+        users.update(
+            (user.email, user)
+            for user in User.query.filter(User.email.in_(batch))
+        )
 
-def add_user(email, admin=False, project_id=0, subproject_id=0):
-    # Check if a user already exists with this email address
-    user = User.query.filter_by(email=email).first()
+    new_users = [User(email=email) for email in emails if email not in users]
+    if new_users:
+        # Hashing is slow on purpose, so instead of hashing a random password
+        # per user the new users get an unusable password; they choose their
+        # own password via the invitation
+        for user in new_users:
+            user.set_unusable_password()
+        db.session.add_all(new_users)
+        # The invitation tokens contain the ids of the users
+        db.session.flush()
+        users.update((user.email, user) for user in new_users)
 
-    if user:
-        _set_user_role(user, admin, project_id, subproject_id)
-    if not user:
-        user = User(email=email)
-        user.set_password(urandom(24))
-        db.session.add(user)
-        db.session.commit()
+    if admin:
+        user_ids = [user.id for user in users.values() if not user.admin]
+        for batch in _batches(user_ids):
+            User.query.filter(User.id.in_(batch)).update(
+                {'admin': True}, synchronize_session=False
+            )
+        mark_permissions_changed(db.session, user_ids)
+
+    membership_count = 0
+    existing = []
+    for table, column, index in [
+        (project_user, 'project_id', 1), (subproject_user, 'subproject_id', 2)
+    ]:
+        # (user id, (sub)project id) -> (email, project_id, subproject_id)
+        memberships = {}
+        for email, project_id, subproject_id in invites:
+            if index == 1 and project_id:
+                memberships[(users[email].id, project_id)] = (
+                    email, project_id, 0
+                )
+            elif index == 2 and subproject_id:
+                memberships[(users[email].id, subproject_id)] = (
+                    email, 0, subproject_id
+                )
+        if not memberships:
+            continue
 
-        _set_user_role(user, admin, project_id, subproject_id)
+        target_ids = {x[1] for x in memberships}
+        present = set()
+        for batch in _batches({x[0] for x in memberships}):
+            present.update(
+                db.session.query(table.c.user_id, table.c[column]).filter(
+                    table.c.user_id.in_(batch),
+                    table.c[column].in_(list(target_ids))
+                )
+            )
+        existing += [
+            invite for membership, invite in memberships.items()
+            if membership in present
+        ]
+        rows = [
+            {'user_id': user_id, column: target_id}
+            for user_id, target_id in memberships
+            if (user_id, target_id) not in present
+        ]
+        for batch in _batches(rows):
+            db.session.execute(table.insert(), batch)
+        membership_count += len(rows)
+
+        # The inserts bypass the flush, so register the changes ourselves
+        mark_permissions_changed(db.session, [x['user_id'] for x in rows])
+        if column == 'project_id':
+            mark_changed(db.session, project_ids=[x[column] for x in rows])
+        else:
+            mark_changed(db.session, subproject_ids=[x[column] for x in rows])
 
-        # Send the new user an invitation email
+    for user in new_users:
         send_invite(user)
+    db.session.commit()
+    return [user.email for user in new_users], membership_count, existing
+
+
+# Parse the invites entered on the project page: one email address per line,
+# optionally followed by a comma, semicolon or tab and the name of an
+# activity of the project. Lines without an activity are added to the given
+# subproject, or to the project itself if it is 0. Raises a ValueError
+# listing the invalid lines.
+def parse_invites(text, project, subproject_id=0):
+    subproject_ids = {
+        x.name.strip().lower(): x.id for x in project.subprojects
+    }
+    invites = []
+    errors = []
+    for number, line in enumerate(text.splitlines(), 1):
+        # Skip empty lines and a header row
+        if not line.strip() or (number == 1 and '@' not in line):
+            continue
+        parts = re.split(r'[,;\t]', line, 1) + ['']
+        email = parts[0].strip(' "')
+        subproject_name = parts[1].strip(' \t,;"')
+        if not EMAIL_ADDRESS.match(email) or len(email) > 120:
+            errors.append('regel %s: ongeldig e-mailadres "%s"' % (number, email))
+        elif subproject_name:
+            if subproject_name.lower() not in subproject_ids:
+                errors.append(
+                    'regel %s: onbekende activiteit "%s"' % (
+                        number, subproject_name
+                    )
+                )
+            else:
+                invites.append(
+                    (email, 0, subproject_ids[subproject_name.lower()])
+                )
+        elif subproject_id:
+            invites.append((email, 0, subproject_id))
+        else:
+            invites.append((email, project.id, 0))
+    if errors:
+        raise ValueError(
+            'Niemand is uitgenodigd, controleer de volgende regels: %s' % (
+                '; '.join(errors)
+            )
+        )
+    return invites
+
+
+def add_user(email, admin=False, project_id=0, subproject_id=0):
+    # Check the memberships of an existing user before anything is saved
+    user_id = db.session.query(User.id).filter_by(email=email.strip()).scalar()
+    if user_id:
+        if project_id and db.session.query(project_user).filter_by(
+                user_id=user_id, project_id=project_id).count():
+            raise ValueError('Gebruiker niet toegevoegd: deze gebruiker was al initiatiefnemer van dit initiatief')
+        if subproject_id and db.session.query(subproject_user).filter_by(
+                user_id=user_id, subproject_id=subproject_id).count():
+            raise ValueError('Gebruiker niet toegevoegd: deze gebruiker was al activiteitnemer van deze activiteit')
+
+    add_users([(email, project_id, subproject_id)], admin=admin)
 
 
 def get_export_timestamp():
     return datetime.now(
         app.config['TZ']
     ).isoformat()[:19].replace('-', '_').replace('T', '-').replace(':', '_')
+
+
+# Path of a file in a folder of the upload folder, see app/storage.py
+def get_upload_path(folder, filename):
+    return os.path.join(
+        os.path.abspath(
+            os.path.join(
+                app.instance_path, '../%s/%s' % (
+                    app.config['UPLOAD_FOLDER'],
+                    folder
+                )
+            )
+        ),
+        filename
+    )
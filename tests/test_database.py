@@ -2,10 +2,30 @@
 
 import unittest
 
-from app import app, db, util
-from app.models import User, Project, Payment, Subproject, DebitCard
+from app import (
+    app, db, formatting, garbage_collection, images, log, mail, outbox,
+    payment_import, profiling, statements, storage, util
+)
+from app.form_processing import process_payment_batch, process_payment_patch
+from flask import g
+from app.permissions import ANONYMOUS, Permissions, load_permissions
+from app.models import (
+    User, Project, Payment, Subproject, DebitCard, Category, CategorizationRule,
+    Blob, File, OutboxMessage, SessionUser, get_variant_filename, load_user
+)
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
 from decimal import *
+from io import BytesIO
+from moto import mock_s3
+from PIL import Image
+from time import monotonic
+import json
+import logging
+import os
 import pandas as pd
+import tempfile
+import zipfile
 
 
 def payment(r, av, sad):
@@ -198,3 +218,1158 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(s1.debit_cards[1].card_id, 2)
         self.assertEqual(d1.subproject.name, 'testsubproject1')
         self.assertEqual(d2.subproject.name, 'testsubproject1')
+
+    def test_balance_gaps(self):
+        # Account 1 is missing a payment of -20 between ids 2 and 4, account
+        # 2 is complete
+        ledger = [
+            (1, 1, 100, 100), (1, 2, -30, 70), (1, 4, -10, 40), (1, 5, 5, 45),
+            (2, 3, 50, 50), (2, 6, -25, 25)
+        ]
+        for monetary_account_id, bank_payment_id, amount, balance in ledger:
+            db.session.add(Payment(
+                monetary_account_id=monetary_account_id,
+                bank_payment_id=bank_payment_id,
+                amount_value=amount,
+                balance_after_mutation_value=balance
+            ))
+        # Manual payments have no balance and are ignored
+        db.session.add(Payment(amount_value=-500, type='MANUAL'))
+        db.session.commit()
+
+        gaps = util.get_balance_gaps()
+        self.assertEqual(len(gaps), 1)
+        self.assertEqual(gaps[0]['monetary_account_id'], 1)
+        self.assertEqual(gaps[0]['after_id'], 2)
+        self.assertEqual(gaps[0]['before_id'], 4)
+        self.assertEqual(gaps[0]['missing_amount'], -20)
+
+        self.assertEqual(util.get_balance_gaps([2]), [])
+
+    def test_apply_categorization_rules(self):
+        project = Project(name="Regels", contains_subprojects=False)
+        db.session.add(project)
+        db.session.commit()
+        category = Category(name="boodschappen", project_id=project.id)
+        db.session.add(category)
+        db.session.commit()
+        db.session.add(CategorizationRule(
+            project_id=project.id,
+            counterparty_name="albert heijn",
+            amount_max=0,
+            category_id=category.id,
+            route="uitgaven"
+        ))
+        payments = [
+            Payment(project_id=project.id, amount_value=-12.5,
+                    counterparty_alias_name="Albert Heijn 1234"),
+            Payment(project_id=project.id, amount_value=12.5,
+                    counterparty_alias_name="Albert Heijn 1234"),
+            Payment(project_id=project.id, amount_value=-3,
+                    counterparty_alias_name="Jumbo")
+        ]
+        db.session.add_all(payments)
+        db.session.commit()
+
+        self.assertEqual(
+            util.apply_categorization_rules(project_id=project.id), 1
+        )
+        self.assertEqual(payments[0].category_id, category.id)
+        self.assertEqual(payments[0].route, "uitgaven")
+        self.assertIsNone(payments[1].category_id)
+        self.assertIsNone(payments[2].category_id)
+
+        # The rules of a project also apply to the payments of its
+        # subprojects
+        subproject = Subproject(name="Buurtfeest", project_id=project.id)
+        db.session.add(subproject)
+        db.session.commit()
+        payment = Payment(
+            subproject_id=subproject.id, amount_value=-7,
+            counterparty_alias_name="Albert Heijn 5678"
+        )
+        db.session.add(payment)
+        db.session.commit()
+        self.assertEqual(
+            util.apply_categorization_rules(project_id=project.id), 1
+        )
+        self.assertEqual(payment.category_id, category.id)
+
+    def test_import_statement(self):
+        project = Project(
+            name="Import", iban="NL12INGB0001234567", contains_subprojects=False
+        )
+        db.session.add(project)
+        db.session.commit()
+        statement = (
+            b':20:STATEMENT\r\n'
+            b':25:NL12INGB0001234567 EUR\r\n'
+            b':60F:C200101EUR100,00\r\n'
+            b':61:2001020102C50,00NTRFNONREF\r\n'
+            b':86:/CNTP/NL65BUNQ9900000188/BUNQNL2A/S. Daddy///REMI/USTD//'
+            b'Sponsoring/\r\n'
+            b':61:2001030103D20,50NTRFNONREF\r\n'
+            b':86:/CNTP/NL13BUNQ9900299981/BUNQNL2A/Winkel///REMI/USTD//'
+            b'Materiaal/\r\n'
+            b':62F:C200103EUR129,50\r\n'
+        )
+
+        self.assertEqual(
+            statements.import_statement(BytesIO(statement)), (2, 0)
+        )
+        # Importing the same statement again doesn't add payments
+        self.assertEqual(
+            statements.import_statement(BytesIO(statement)), (0, 2)
+        )
+
+        payments = Payment.query.order_by(Payment.created).all()
+        self.assertEqual(len(payments), 2)
+        self.assertEqual(payments[0].project_id, project.id)
+        self.assertEqual(payments[0].amount_value, 50)
+        self.assertEqual(payments[0].counterparty_alias_name, "S. Daddy")
+        self.assertEqual(payments[0].description, "Sponsoring")
+        self.assertEqual(payments[0].route, "inkomsten")
+        self.assertEqual(payments[1].amount_value, -20.5)
+        self.assertEqual(payments[1].balance_after_mutation_value, 129.5)
+        self.assertEqual(payments[1].route, "uitgaven")
+
+        # CAMT.053 entries are parsed one by one
+        entry = (
+            '<Ntry><Amt Ccy="EUR">%s</Amt><CdtDbtInd>%s</CdtDbtInd>'
+            '<BookgDt><Dt>2020-01-0%s</Dt></BookgDt>'
+            '<AddtlNtryInf>%s</AddtlNtryInf></Ntry>'
+        )
+        camt053 = (
+            '<Document><BkToCstmrStmt><Stmt><Acct><Id>'
+            '<IBAN>NL12INGB0001234567</IBAN></Id></Acct>%s%s</Stmt>'
+            '</BkToCstmrStmt></Document>' % (
+                entry % ('10.00', 'CRDT', 4, 'Gift'),
+                entry % ('2.50', 'DBIT', 5, 'Koffie')
+            )
+        ).encode('utf-8')
+        entries = list(statements.parse_camt053(BytesIO(camt053)))
+        self.assertEqual([x['amount_value'] for x in entries], [10, -2.5])
+        self.assertEqual(entries[1]['description'], 'Koffie')
+        self.assertEqual(entries[0]['alias_value'], 'NL12INGB0001234567')
+
+        # A CSV row without a date is rejected with its line number
+        with self.assertRaisesRegex(ValueError, 'line 3'):
+            statements.import_statement(BytesIO(
+                b'Datum;Bedrag\n2020-01-02;10,00\n;5,00\n'
+            ), statement_format='csv')
+
+    def test_import_manual_payments(self):
+        project = Project(name="Bulk", contains_subprojects=False)
+        db.session.add(project)
+        db.session.commit()
+        category = Category(name="Materiaal", project_id=project.id)
+        db.session.add(category)
+        db.session.commit()
+
+        invalid = (
+            b'datum;bedrag;categorie;korte beschrijving\n'
+            b'01-02-2020;-20,50;materiaal;verf\n'
+            b'31-02-2020;abc;onbekend;kwasten\n'
+        )
+        with self.assertRaises(payment_import.PaymentImportError) as e:
+            payment_import.import_manual_payments(
+                BytesIO(invalid), 'transacties.csv', project
+            )
+        self.assertEqual(len(e.exception.errors), 1)
+        self.assertTrue(e.exception.errors[0].startswith('Rij 3'))
+        self.assertEqual(Payment.query.count(), 0)
+
+        valid = (
+            b'datum;bedrag;categorie;korte beschrijving\n'
+            b'01-02-2020;-20,50;materiaal;verf\n'
+            b'03-02-2020;100;;subsidie\n'
+        )
+        self.assertEqual(
+            payment_import.import_manual_payments(
+                BytesIO(valid), 'transacties.csv', project
+            ),
+            2
+        )
+        payments = Payment.query.order_by(Payment.created).all()
+        self.assertEqual(payments[0].category_id, category.id)
+        self.assertEqual(payments[0].route, "uitgaven")
+        self.assertEqual(payments[0].type, "MANUAL")
+        self.assertEqual(payments[1].route, "inkomsten")
+        self.assertIsNone(payments[1].category_id)
+
+        # Payments referring to the same attachment get their own File
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            z.writestr('bon.pdf', b'bon')
+        archive.seek(0)
+        with_attachments = (
+            b'datum;bedrag;bestand\n'
+            b'20210105;-5;bon.pdf\n'
+            b'44201;-6;bon.pdf\n'
+        )
+        instance_path = app.instance_path
+        with tempfile.TemporaryDirectory() as folder:
+            app.instance_path = os.path.join(folder, 'instance')
+            try:
+                payment_import.import_manual_payments(
+                    BytesIO(with_attachments), 'transacties.csv', project,
+                    archive_file=archive
+                )
+                new_payments = Payment.query.filter(
+                    Payment.amount_value.in_([-5, -6])
+                ).all()
+                self.assertEqual(
+                    [x.created.date() for x in new_payments],
+                    [datetime(2021, 1, 5).date()] * 2
+                )
+                files = [x.attachments[0] for x in new_payments]
+                self.assertNotEqual(files[0].id, files[1].id)
+                self.assertEqual(files[0].blob_id, files[1].blob_id)
+                self.assertEqual(files[0].blob.reference_count, 2)
+                storage.delete_file(files[0].id)
+                self.assertEqual(len(new_payments[1].attachments), 1)
+            finally:
+                app.instance_path = instance_path
+
+    def test_payment_batch(self):
+        project = Project(name="Batch", contains_subprojects=False)
+        other_project = Project(name="Ander", contains_subprojects=False)
+        db.session.add_all([project, other_project])
+        db.session.commit()
+        category = Category(name="Materiaal", project_id=project.id)
+        payments = [
+            Payment(project_id=project.id, amount_value=-10, route="uitgaven"),
+            Payment(project_id=project.id, amount_value=-20, route="uitgaven"),
+            Payment(project_id=other_project.id, amount_value=-30)
+        ]
+        db.session.add(category)
+        db.session.add_all(payments)
+        db.session.commit()
+
+        result, status = process_payment_batch(
+            {
+                'payment_ids': [payments[0].id, payments[1].id],
+                'category_id': category.id,
+                'route': 'inbesteding',
+                'hidden': True
+            },
+            project, True, []
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(result['updated'], 2)
+        for payment in payments[:2]:
+            db.session.refresh(payment)
+            self.assertEqual(payment.category_id, category.id)
+            self.assertEqual(payment.route, "inbesteding")
+            self.assertTrue(payment.hidden)
+
+        # Payments of another project can't be edited
+        result, status = process_payment_batch(
+            {'payment_ids': [payments[0].id, payments[2].id], 'hidden': False},
+            project, True, []
+        )
+        self.assertEqual(status, 403)
+        db.session.refresh(payments[0])
+        self.assertTrue(payments[0].hidden)
+
+        result, status = process_payment_batch(
+            {'payment_ids': [payments[0].id], 'route': 'onbekend'},
+            project, True, []
+        )
+        self.assertEqual(status, 400)
+
+        # Only project owners can hide payments
+        subproject = Subproject(name="Klein", project_id=project.id)
+        db.session.add(subproject)
+        db.session.commit()
+        subproject_payment = Payment(
+            subproject_id=subproject.id, amount_value=-40, route="uitgaven"
+        )
+        db.session.add(subproject_payment)
+        db.session.commit()
+        result, status = process_payment_batch(
+            {'payment_ids': [subproject_payment.id], 'hidden': True},
+            project, False, [subproject.id]
+        )
+        self.assertEqual(status, 403)
+        db.session.refresh(subproject_payment)
+        self.assertFalse(subproject_payment.hidden)
+
+    def test_project_read_only(self):
+        project = Project(name="Groot", contains_subprojects=False)
+        db.session.add(project)
+        db.session.commit()
+        db.session.add_all([
+            Payment(
+                project_id=project.id, amount_value=-x, route="uitgaven",
+                type="MANUAL", created=datetime(2021, 1, 1),
+                hidden=x % 10 == 0
+            )
+            for x in range(1, 1001)
+        ])
+        db.session.commit()
+
+        # The page is streamed, so read it while the request is still active
+        with app.test_client() as client:
+            response = client.get('/project/%s' % (project.id))
+            html = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 200)
+        # Anonymous visitors don't get any forms or hidden payments
+        self.assertNotIn('csrf_token', html)
+        self.assertNotIn('payment-form', html)
+        self.assertEqual(html.count('<tr class="manual-payment"'), 900)
+
+    def test_versions(self):
+        project = Project(name="Versies", contains_subprojects=True)
+        db.session.add(project)
+        db.session.commit()
+        subproject = Subproject(name="Activiteit", project_id=project.id)
+        db.session.add(subproject)
+        db.session.commit()
+        project_version = project.version
+        subproject_version = subproject.version
+
+        # Payments of a subproject also change the project page
+        payment = Payment(subproject_id=subproject.id, amount_value=-10)
+        db.session.add(payment)
+        db.session.commit()
+        self.assertEqual(subproject.version, subproject_version + 1)
+        self.assertEqual(project.version, project_version + 1)
+
+        # Bulk updates bypass the flush, but are registered as well
+        Payment.query.filter_by(id=payment.id).update(
+            {'short_user_description': 'koffie'}
+        )
+        db.session.commit()
+        self.assertEqual(subproject.version, subproject_version + 2)
+        self.assertEqual(project.version, project_version + 2)
+
+        # Nothing changed, so the version stays the same
+        db.session.commit()
+        self.assertEqual(project.version, project_version + 2)
+
+        etag, last_modified = util.get_project_validators(project)
+        with app.test_client() as client:
+            response = client.get(
+                '/project/%s' % (project.id),
+                headers={'If-None-Match': 'W/"%s"' % (etag)}
+            )
+            self.assertEqual(response.status_code, 304)
+
+            Category.query.filter_by(subproject_id=subproject.id).delete()
+            db.session.add(Category(name="Nieuw", subproject_id=subproject.id))
+            db.session.commit()
+            response = client.get(
+                '/project/%s' % (project.id),
+                headers={'If-None-Match': 'W/"%s"' % (etag)}
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], 'W/"%s"' % (etag))
+
+    def test_export(self):
+        project = Project(name="Export", contains_subprojects=False)
+        db.session.add(project)
+        db.session.commit()
+        db.session.add_all([
+            Payment(
+                project_id=project.id, amount_value=-12.5, route="uitgaven",
+                type="MANUAL", created=datetime(2021, 3, 1),
+                alias_name="Initiatief", counterparty_alias_name="Winkel",
+                short_user_description="verf"
+            ),
+            Payment(
+                project_id=project.id, amount_value=-1, route="uitgaven",
+                type="MANUAL", created=datetime(2021, 3, 2), hidden=True
+            )
+        ])
+        db.session.commit()
+
+        with app.test_client() as client:
+            response = client.get('/project/%s/export.jsonl' % (project.id))
+            self.assertIn('attachment;', response.headers['Content-Disposition'])
+            lines = response.get_data(as_text=True).splitlines()
+            # Hidden payments are not exported for anonymous visitors
+            self.assertEqual(len(lines), 1)
+            row = json.loads(lines[0])
+            self.assertEqual(row['verzender'], 'Initiatief')
+            self.assertEqual(row['ontvanger'], 'Winkel')
+            self.assertEqual(row['datum'], '01-03-2021')
+
+            response = client.get('/project/%s/export.xlsx' % (project.id))
+            with zipfile.ZipFile(BytesIO(response.get_data())) as xlsx:
+                self.assertIn('verf', xlsx.read('xl/worksheets/sheet1.xml').decode())
+
+    def test_payment_patch(self):
+        project = Project(name="Patch", contains_subprojects=False)
+        db.session.add(project)
+        db.session.commit()
+        payments = [
+            Payment(project_id=project.id, amount_value=-10, route="uitgaven", type="MANUAL"),
+            Payment(project_id=project.id, amount_value=-20, route="uitgaven", type="IMPORT")
+        ]
+        db.session.add_all(payments)
+        db.session.commit()
+
+        with app.test_request_context():
+            errors = process_payment_patch(
+                {'short_user_description': 'koffie', 'amount_value': '-12,50'},
+                payments[0], False
+            )
+            self.assertEqual(errors, [])
+            db.session.refresh(payments[0])
+            self.assertEqual(payments[0].short_user_description, 'koffie')
+            self.assertEqual(payments[0].amount_value, -12.5)
+            self.assertEqual(payments[0].route, 'uitgaven')
+
+            # Only the amount of manual payments can be edited and only
+            # project owners can hide payments
+            self.assertTrue(
+                process_payment_patch({'amount_value': '5'}, payments[1], True)
+            )
+            self.assertTrue(
+                process_payment_patch({'hidden': True}, payments[1], False)
+            )
+            self.assertTrue(
+                process_payment_patch(
+                    {'short_user_description': 'x' * 51}, payments[1], True
+                )
+            )
+            db.session.refresh(payments[1])
+            self.assertEqual(payments[1].amount_value, -20)
+            self.assertFalse(payments[1].hidden)
+
+    def test_formatting(self):
+        self.assertEqual(formatting.format_amount(-1234567.891), '-1.234.567,89')
+        self.assertEqual(formatting.format_export_amount(1234.5), '1234,50')
+        self.assertEqual(util.format_currency(1234.5), '€ 1.234')
+        self.assertEqual(util.human_format(1250000), '1,2M')
+        self.assertEqual(formatting.format_percent(0.25), '25%')
+        self.assertEqual(
+            formatting.format_amounts([1, -0.5]), ['1,00', '-0,50']
+        )
+
+    def test_permissions(self):
+        user = User(email='test@example.com')
+        project = Project(name="Groot")
+        db.session.add_all([user, project])
+        db.session.commit()
+        subproject = Subproject(name="Klein", project_id=project.id)
+        other_subproject = Subproject(name="Ander", project_id=project.id)
+        db.session.add_all([subproject, other_subproject])
+        db.session.commit()
+
+        permissions = load_permissions(user)
+        self.assertFalse(permissions.is_project_owner(project.id))
+        self.assertFalse(permissions.can_edit_subproject(subproject))
+        self.assertEqual(user.permissions_version, 0)
+
+        # Membership changes bump the version, so cached permissions are
+        # reloaded
+        subproject.users.append(user)
+        db.session.commit()
+        self.assertEqual(user.permissions_version, 1)
+        permissions = load_permissions(user)
+        self.assertEqual(permissions.get_subproject_ids(project.id), [subproject.id])
+        self.assertTrue(permissions.can_edit_subproject(subproject))
+        self.assertFalse(permissions.can_edit_subproject(other_subproject))
+
+        user.projects.append(project)
+        db.session.commit()
+        self.assertEqual(user.permissions_version, 2)
+        permissions = load_permissions(user)
+        self.assertTrue(permissions.is_project_owner(project.id))
+        self.assertTrue(permissions.can_edit_subproject(other_subproject))
+
+        User.query.filter_by(id=user.id).update({'admin': True})
+        db.session.commit()
+        self.assertEqual(user.permissions_version, 3)
+        self.assertTrue(load_permissions(user).admin)
+
+        # Other changes don't
+        user.first_name = 'Test'
+        db.session.commit()
+        self.assertEqual(user.permissions_version, 3)
+
+    def test_visibility(self):
+        project = Project(name="Groot")
+        hidden_project = Project(name="Verborgen", hidden=True)
+        db.session.add_all([project, hidden_project])
+        db.session.commit()
+        subproject = Subproject(name="Klein", project_id=project.id)
+        hidden_subproject = Subproject(
+            name="Verborgen", project_id=project.id, hidden=True
+        )
+        db.session.add_all([subproject, hidden_subproject])
+        db.session.commit()
+        created = datetime(2021, 1, 1)
+        db.session.add_all([
+            Payment(
+                subproject_id=subproject.id, amount_value=-1, created=created
+            ),
+            Payment(
+                subproject_id=subproject.id, amount_value=-2, hidden=True,
+                created=created
+            ),
+            Payment(
+                subproject_id=hidden_subproject.id, amount_value=-3,
+                hidden=True, created=created
+            )
+        ])
+        db.session.commit()
+
+        def visible(permissions):
+            return (
+                Project.query.filter(permissions.visible_projects()).count(),
+                Subproject.query.filter(
+                    permissions.visible_subprojects()
+                ).count(),
+                Payment.query.filter(permissions.visible_payments()).count()
+            )
+
+        self.assertEqual(visible(ANONYMOUS), (1, 1, 1))
+        self.assertEqual(visible(Permissions(admin=True)), (2, 2, 3))
+        self.assertEqual(
+            visible(Permissions(project_ids=[project.id])), (1, 2, 3)
+        )
+        self.assertEqual(
+            visible(Permissions(subprojects=[(subproject.id, project.id)])),
+            (1, 1, 2)
+        )
+        self.assertEqual(
+            visible(Permissions(project_ids=[hidden_project.id])), (2, 1, 1)
+        )
+
+        # A subproject is only shown in its own project, if that is visible
+        subproject_of_hidden = Subproject(
+            name="Klein", project_id=hidden_project.id
+        )
+        db.session.add(subproject_of_hidden)
+        db.session.commit()
+        urls = [
+            '/project/%s/subproject/%s' % (project.id, subproject.id),
+            '/project/%s/subproject/%s' % (
+                hidden_project.id, subproject_of_hidden.id
+            ),
+            '/project/%s/subproject/%s' % (
+                project.id, subproject_of_hidden.id
+            ),
+        ]
+        with app.test_client() as client:
+            pages = [client.get(url).get_data(as_text=True) for url in urls]
+            export = client.get(urls[1] + '/export.csv').get_data(as_text=True)
+        self.assertNotIn('Bestand niet gevonden', pages[0])
+        self.assertIn('Bestand niet gevonden', pages[1])
+        self.assertIn('Bestand niet gevonden', pages[2])
+        self.assertIn('Bestand niet gevonden', export)
+
+    def test_page_weight(self):
+        user = User(
+            email='test@example.com', first_name='Test', last_name='Test',
+            biography='Test'
+        )
+        project = Project(name="Groot", contains_subprojects=False)
+        project.users.append(user)
+        db.session.add_all([user, project])
+        db.session.commit()
+        # The objects are detached once a request is finished
+        user_id = user.id
+        project_id = project.id
+
+        def get_page_size(payment_count):
+            db.session.bulk_insert_mappings(Payment, [
+                {
+                    'project_id': project_id, 'amount_value': -1,
+                    'route': 'uitgaven', 'type': 'MANUAL',
+                    'created': datetime(2021, 1, 1)
+                }
+                for x in range(
+                    payment_count
+                    - Payment.query.filter_by(project_id=project_id).count()
+                )
+            ])
+            db.session.commit()
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session['user_id'] = str(user_id)
+                    session['_fresh'] = True
+                response = client.get('/project/%s' % (project_id))
+                # The page is streamed, so read it while the request is
+                # still active
+                html = response.get_data(as_text=True)
+            self.assertEqual(response.status_code, 200)
+            # Only the owner's page contains the form to add payments
+            self.assertIn('new_payment_form-', html)
+            return len(html.encode('utf-8'))
+
+        # The owner's page contains a single edit modal, so each row only adds
+        # the row itself
+        small_page_size = get_page_size(100)
+        size_per_row = (get_page_size(200) - small_page_size) / 100
+        # About 2950 bytes when measured, some room for small changes to the
+        # row
+        self.assertLess(size_per_row, 3200)
+
+    def test_image_variants(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # A photo taken with a phone held upright
+            path = os.path.join(folder, 'bon.jpg')
+            exif = Image.Exif()
+            # Orientation: rotated 90 degrees
+            exif[0x0112] = 6
+            Image.new('RGB', (500, 1000)).save(path, exif=exif.tobytes())
+
+            widths = images.create_variants(path, folder, 'bon.jpg')
+            # Rotated to 1000x500 and not upscaled
+            self.assertEqual(widths, [320, 640, 1000])
+            for width in widths:
+                for extension in ['webp', 'jpg']:
+                    variant = Image.open(os.path.join(
+                        folder, get_variant_filename('bon.jpg', width, extension)
+                    ))
+                    self.assertEqual(variant.width, width)
+                    self.assertNotIn('exif', variant.info)
+
+        f = File(filename='bon.png', mimetype='image/png', variants=[320, 640])
+        with app.test_request_context():
+            self.assertEqual(
+                f.get_srcset('transaction-attachment', 'webp'),
+                '/upload/transaction-attachment/bon_320w.webp 320w, '
+                '/upload/transaction-attachment/bon_640w.webp 640w'
+            )
+
+    def test_attachment_access(self):
+        project = Project(name="Bonnen", contains_subprojects=False)
+        db.session.add(project)
+        db.session.commit()
+        for hidden in [False, True]:
+            payment = Payment(
+                project_id=project.id, amount_value=-1, route='uitgaven',
+                type='MANUAL', hidden=hidden
+            )
+            payment.attachments.append(File(
+                filename='bon-%s.png' % (hidden), mimetype='image/png',
+                variants=[320]
+            ))
+            db.session.add(payment)
+        db.session.commit()
+
+        app.config['X_ACCEL_REDIRECT'] = True
+        with app.test_client() as client:
+            response = client.get(
+                '/upload/transaction-attachment/bon-False_320w.webp'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/webp')
+            self.assertEqual(
+                response.headers['X-Accel-Redirect'],
+                '/protected-upload/transaction-attachment/bon-False_320w.webp'
+            )
+            # Attachments of hidden payments and unknown files can't be seen
+            for filename in ['bon-True.png', 'bon-True_320w.jpg', 'bon.png']:
+                response = client.get(
+                    '/upload/transaction-attachment/' + filename
+                )
+                self.assertEqual(response.status_code, 404)
+            # Nor through the folder of the (public) user images
+            response = client.get('/upload/user-image/bon-True.png')
+            self.assertEqual(response.status_code, 404)
+
+        image = File(filename='avatar.png', mimetype='image/png')
+        db.session.add(image)
+        db.session.commit()
+        other = User(email='ander@example.com')
+        db.session.add_all([
+            User(email='test@example.com', image=image.id), other
+        ])
+        db.session.commit()
+        # The objects are detached once a request is finished
+        image_id = image.id
+        other_id = other.id
+        with app.test_client() as client:
+            response = client.get('/upload/user-image/avatar.png')
+            self.assertEqual(response.status_code, 200)
+
+            # Users can only remove their own image
+            with client.session_transaction() as session:
+                session['user_id'] = str(other_id)
+                session['_fresh'] = True
+            client.post('/profiel-bewerken', data={
+                'edit_attachment_form-id': image_id,
+                'edit_attachment_form-remove': 'Verwijderen',
+            })
+        self.assertIsNotNone(File.query.get(image_id))
+
+    def test_storage(self):
+        instance_path = app.instance_path
+        with tempfile.TemporaryDirectory() as folder:
+            app.instance_path = os.path.join(folder, 'instance')
+            try:
+                files = [
+                    storage.create_file(BytesIO(b'bon'), filename, 'bon')
+                    for filename in ['bon.PDF', 'kopie.pdf']
+                ]
+                db.session.add_all(files)
+                db.session.commit()
+
+                # The same content is stored once
+                blob = files[0].blob
+                self.assertEqual(blob.sha256, sha256(b'bon').hexdigest())
+                self.assertEqual(blob.reference_count, 2)
+                self.assertEqual(files[1].blob_id, blob.id)
+                self.assertEqual(files[0].filename, blob.sha256 + '.pdf')
+                path = storage.get_backend().get_path(storage.get_key(files[1]))
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), b'bon')
+                self.assertEqual(os.listdir(os.path.dirname(path)), [blob.sha256])
+
+                # Files uploaded before blobs were used are moved in place
+                legacy_path = util.get_upload_path(
+                    'transaction-attachment', '2020-01-01T10:00:00_bon.pdf'
+                )
+                os.makedirs(os.path.dirname(legacy_path))
+                with open(legacy_path, 'wb') as f:
+                    f.write(b'bon')
+                legacy_file = File(
+                    filename='2020-01-01T10:00:00_bon.pdf',
+                    mimetype='application/pdf'
+                )
+                db.session.add(legacy_file)
+                db.session.commit()
+                self.assertTrue(storage.migrate_file(legacy_file))
+                db.session.commit()
+                self.assertEqual(legacy_file.blob_id, blob.id)
+                self.assertFalse(os.path.exists(legacy_path))
+                self.assertEqual(blob.reference_count, 3)
+
+                # Deleting Files releases their reference
+                File.query.filter(
+                    File.id.in_([files[0].id, legacy_file.id])
+                ).delete(synchronize_session=False)
+                db.session.commit()
+                self.assertEqual(Blob.query.get(blob.id).reference_count, 1)
+            finally:
+                app.instance_path = instance_path
+
+    def test_partial_upload(self):
+        instance_path = app.instance_path
+        with tempfile.TemporaryDirectory() as folder:
+            app.instance_path = os.path.join(folder, 'instance')
+            try:
+                content = b'%PDF-1.4 ' + b'x' * 100
+                token, direct_upload = storage.start_upload(len(content))
+                self.assertIsNone(direct_upload)
+                self.assertEqual(storage.get_partial_upload_size(token), 0)
+                self.assertEqual(
+                    storage.append_partial_upload(
+                        token, BytesIO(content[:50]), 0, len(content)
+                    ),
+                    50
+                )
+                # A chunk at the wrong offset or beyond the size is refused
+                with self.assertRaises(ValueError):
+                    storage.append_partial_upload(
+                        token, BytesIO(content[10:]), 10, len(content)
+                    )
+                with self.assertRaises(ValueError):
+                    storage.append_partial_upload(
+                        token, BytesIO(content[50:] + b'x'), 50, len(content)
+                    )
+                self.assertEqual(storage.get_partial_upload_size(token), 50)
+                storage.append_partial_upload(
+                    token, BytesIO(content[50:]), 50, len(content)
+                )
+
+                # The mimetype follows from the content, not the extension
+                file = storage.complete_partial_upload(token, 'scan.png', 'bon')
+                self.assertEqual(file.mimetype, 'application/pdf')
+                self.assertEqual(file.blob.sha256, sha256(content).hexdigest())
+                self.assertIsNone(storage.get_partial_upload_size(token))
+            finally:
+                app.instance_path = instance_path
+
+        self.assertEqual(
+            storage.sniff_mimetype(b'\xff\xd8\xff\xe0', 'foto.jpg'), 'image/jpeg'
+        )
+        self.assertEqual(
+            storage.sniff_mimetype(b'PK\x03\x04', 'begroting.xlsx'),
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+        self.assertEqual(
+            storage.sniff_mimetype(b'<html>', 'bon.txt'), 'text/plain'
+        )
+        self.assertEqual(
+            storage.sniff_mimetype(b'<html>', 'bon.pdf'),
+            'application/octet-stream'
+        )
+
+    def test_garbage_collection(self):
+        instance_path = app.instance_path
+        with tempfile.TemporaryDirectory() as folder:
+            app.instance_path = os.path.join(folder, 'instance')
+            try:
+                old = datetime.now(timezone.utc) - timedelta(days=2)
+                backend = storage.get_backend()
+
+                # Attached Files are kept, unattached Files only once they
+                # are older than the grace period
+                project = Project(name='Bonnen', contains_subprojects=False)
+                db.session.add(project)
+                db.session.commit()
+                payment = Payment(
+                    project_id=project.id, amount_value=-1, route='uitgaven',
+                    type='MANUAL'
+                )
+                attached, orphan, recent = [
+                    storage.create_file(BytesIO(content), 'bon.pdf', 'bon')
+                    for content in [b'bon', b'oud', b'nieuw']
+                ]
+                legacy = File(filename='2020_bon.png', mimetype='image/png')
+                payment.attachments.extend([attached, legacy])
+                attached.created = orphan.created = legacy.created = old
+                db.session.add_all([payment, orphan, recent])
+                # A Blob without Files of which the reference count drifted
+                storage.store_stream(BytesIO(b'kwijt'), 'kwijt.pdf')
+                db.session.commit()
+
+                # Stored files without Blob or File, an abandoned partial
+                # upload and a legacy file and its variant
+                stored = {
+                    storage.get_blob_key(sha256(b'los').hexdigest()): b'los',
+                    storage.get_blob_key(sha256(b'vers').hexdigest()): b'vers',
+                    'transaction-attachment/2020_bon.png': b'bon',
+                    'transaction-attachment/2020_bon_320w.webp': b'bon',
+                    'transaction-attachment/2020_weg.png': b'weg',
+                }
+                for key, content in stored.items():
+                    path = backend.get_path(key)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'wb') as f:
+                        f.write(content)
+                    if key != storage.get_blob_key(sha256(b'vers').hexdigest()):
+                        os.utime(path, (old.timestamp(), old.timestamp()))
+                token, _ = storage.start_upload(10)
+                partial_upload_path = storage.get_partial_upload_path(token)
+                os.utime(partial_upload_path, (old.timestamp(), old.timestamp()))
+
+                # The walk through storage continues where it stopped
+                result = garbage_collection.collect_garbage(limit=2)
+                self.assertFalse(result.complete)
+                self.assertTrue(
+                    os.path.exists(garbage_collection.get_checkpoint_path())
+                )
+                self.assertEqual((result.files, result.blobs), (1, 2))
+                objects, reclaimed = result.objects, result.reclaimed
+                result = garbage_collection.collect_garbage()
+                self.assertTrue(result.complete)
+                self.assertFalse(
+                    os.path.exists(garbage_collection.get_checkpoint_path())
+                )
+                self.assertEqual(objects + result.objects, 3)
+                self.assertEqual(reclaimed + result.reclaimed, 3 + 5 + 3 + 3)
+
+                self.assertEqual(
+                    {x.id for x in File.query},
+                    {attached.id, legacy.id, recent.id}
+                )
+                self.assertEqual(
+                    [x.sha256 for x in Blob.query.order_by(Blob.id)],
+                    [sha256(b'bon').hexdigest(), sha256(b'nieuw').hexdigest()]
+                )
+                self.assertEqual(
+                    sorted(x[0] for x in backend.list()),
+                    sorted([
+                        storage.get_key(attached),
+                        storage.get_key(recent),
+                        storage.get_blob_key(sha256(b'vers').hexdigest()),
+                        'transaction-attachment/2020_bon.png',
+                        'transaction-attachment/2020_bon_320w.webp',
+                    ])
+                )
+            finally:
+                app.instance_path = instance_path
+
+    @mock_s3
+    def test_s3_storage(self):
+        config = dict(app.config)
+        instance_path = app.instance_path
+        with tempfile.TemporaryDirectory() as folder:
+            app.instance_path = os.path.join(folder, 'instance')
+            app.config.update(
+                STORAGE_BACKEND='s3',
+                S3_BUCKET='open-poen',
+                S3_REGION='us-east-1',
+                S3_ACCESS_KEY_ID='test',
+                S3_SECRET_ACCESS_KEY='test'
+            )
+            try:
+                backend = storage.get_backend()
+                self.assertEqual(backend.name, 's3')
+                backend.client.create_bucket(Bucket='open-poen')
+
+                file = storage.create_file(BytesIO(b'bon'), 'bon.pdf', 'bon')
+                db.session.add(file)
+                db.session.commit()
+                key = storage.get_key(file)
+                self.assertTrue(backend.exists(key))
+                self.assertEqual(backend.open(key).read(), b'bon')
+
+                # Files are downloaded from the bucket with a presigned URL
+                with app.test_request_context():
+                    response = backend.get_download_response(
+                        key, 'application/pdf'
+                    )
+                self.assertEqual(response.status_code, 302)
+                self.assertIn(key, response.headers['Location'])
+
+                # and uploaded to it directly
+                token, direct_upload = storage.start_upload(3)
+                self.assertIn('url', direct_upload)
+                self.assertIn('key', direct_upload['fields'])
+                upload_key = storage.get_direct_upload_key(token)
+                backend.client.put_object(
+                    Bucket='open-poen', Key=upload_key, Body=b'bon'
+                )
+                copy = storage.complete_direct_upload(
+                    token, 'kopie.pdf', 'bon', 3
+                )
+                db.session.add(copy)
+                db.session.commit()
+                self.assertEqual(copy.blob_id, file.blob_id)
+                self.assertFalse(backend.exists(upload_key))
+
+                # The content is deleted with the last File referring to it
+                storage.delete_file(file.id)
+                self.assertTrue(backend.exists(key))
+                storage.delete_file(copy.id)
+                self.assertFalse(backend.exists(key))
+            finally:
+                app.config.clear()
+                app.config.update(config)
+                app.instance_path = instance_path
+
+    def test_outbox(self):
+        sender = app.config['FROM']
+        app.config['FROM'] = 'info@example.com'
+        try:
+            with app.test_request_context():
+                util.add_user('nieuw@example.com')
+        finally:
+            app.config['FROM'] = sender
+        # The invitation is queued with the user instead of sent right away
+        message = OutboxMessage.query.one()
+        self.assertEqual(message.recipients, ['nieuw@example.com'])
+        self.assertIsNone(message.sent)
+        self.assertEqual(outbox.get_status()['queued'], 1)
+
+        # Flask-Mail refuses a message without recipients
+        db.session.add(OutboxMessage(subject='Leeg', recipients=[]))
+        db.session.commit()
+
+        mail_state = app.extensions['mail']
+        suppress = mail_state.suppress
+        mail_state.suppress = True
+        try:
+            # Delivered in an app context, as by `flask outbox deliver`
+            with app.app_context(), mail.record_messages() as outgoing:
+                self.assertEqual(outbox.deliver(), (1, 1))
+                # The failed message is retried later
+                self.assertEqual(outbox.deliver(), (0, 0))
+        finally:
+            mail_state.suppress = suppress
+        self.assertEqual(
+            [x.recipients for x in outgoing], [['nieuw@example.com']]
+        )
+        self.assertEqual(
+            OutboxMessage.query.filter_by(subject='Leeg').one().attempts, 1
+        )
+        status = outbox.get_status()
+        self.assertEqual((status['queued'], status['sent_last_hour']), (1, 1))
+
+    def test_add_users(self):
+        project = Project(name='Programma', contains_subprojects=True)
+        db.session.add(project)
+        db.session.commit()
+        subproject = Subproject(project_id=project.id, name='Buurtfeest')
+        user = User(email='bestaand@example.com')
+        subproject.users.append(user)
+        db.session.add(subproject)
+        db.session.commit()
+        permissions_version = user.permissions_version
+        # The objects are detached once the request context is removed
+        project_id = project.id
+        subproject_id = subproject.id
+        user_id = user.id
+
+        invites = util.parse_invites(
+            'e-mailadres;activiteit\n'
+            'nieuw1@example.com\n'
+            '\n'
+            'nieuw2@example.com, buurtfeest\n'
+            '"bestaand@example.com";"Buurtfeest"\n',
+            project
+        )
+        self.assertEqual(invites, [
+            ('nieuw1@example.com', project.id, 0),
+            ('nieuw2@example.com', 0, subproject.id),
+            ('bestaand@example.com', 0, subproject.id),
+        ])
+        with self.assertRaises(ValueError):
+            util.parse_invites('geen-adres\nnieuw@example.com, Kermis', project)
+
+        with app.test_request_context():
+            invited, membership_count, existing = util.add_users(
+                invites + [('bestaand@example.com', project_id, 0)]
+            )
+        self.assertEqual(invited, ['nieuw1@example.com', 'nieuw2@example.com'])
+        self.assertEqual(membership_count, 3)
+        self.assertEqual(existing, [('bestaand@example.com', 0, subproject_id)])
+        self.assertEqual(
+            sorted(x.email for x in Project.query.get(project_id).users),
+            ['bestaand@example.com', 'nieuw1@example.com']
+        )
+        self.assertEqual(
+            sorted(x.email for x in Subproject.query.get(subproject_id).users),
+            ['bestaand@example.com', 'nieuw2@example.com']
+        )
+        # The new users can't log in before choosing a password
+        new_user = User.query.filter_by(email='nieuw1@example.com').first()
+        self.assertFalse(new_user.check_password('!'))
+        self.assertFalse(new_user.check_password(''))
+        # Only the new users are invited and the permissions cached in the
+        # session of the existing user are invalidated
+        self.assertEqual(
+            sorted(x.recipients[0] for x in OutboxMessage.query),
+            ['nieuw1@example.com', 'nieuw2@example.com']
+        )
+        self.assertEqual(
+            User.query.get(user_id).permissions_version,
+            permissions_version + 1
+        )
+
+        # Inviting a member again doesn't change anything
+        with app.test_request_context():
+            with self.assertRaises(ValueError):
+                util.add_user(
+                    'bestaand@example.com', admin=True,
+                    subproject_id=subproject_id
+                )
+        user = User.query.get(user_id)
+        self.assertFalse(user.admin)
+        self.assertEqual(user.permissions_version, permissions_version + 1)
+
+    def test_logging(self):
+        def error(lineno):
+            return logging.makeLogRecord({
+                'name': 'app', 'levelno': logging.ERROR, 'levelname': 'ERROR',
+                'msg': 'Betaling %s overslaan', 'args': (lineno,),
+                'lineno': lineno
+            })
+
+        # Log lines are JSON objects with the id of the request
+        record = error(1)
+        with app.test_request_context(headers={'X-Request-ID': 'abc'}):
+            log.RequestIdFilter().filter(record)
+        record = log.StructuredQueueHandler(None).prepare(record)
+        line = json.loads(log.JsonFormatter().format(record))
+        self.assertEqual(line['message'], 'Betaling 1 overslaan')
+        self.assertEqual(line['request_id'], 'abc')
+
+        # Errors are bundled per location in a digest
+        digests = []
+        handler = log.DigestMailHandler(
+            lambda subject, body: digests.append((subject, body)),
+            interval=3600
+        )
+        handler.last_sent = monotonic()
+        for lineno in [10, 10, 10, 20]:
+            handler.handle(error(lineno))
+        self.assertEqual(digests, [])
+        handler.close()
+        self.assertEqual(len(digests), 1)
+        self.assertEqual(digests[0][0], '4 error(s) at 2 different location(s)')
+        self.assertTrue(digests[0][1].startswith('3x Betaling 10 overslaan'))
+
+    def test_session_user(self):
+        user = User(
+            email='test@example.com', first_name='Test', last_name='Test',
+            biography='Test'
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        with app.test_request_context():
+            # The first request stores a snapshot of the user in the session,
+            # the next ones use it
+            self.assertIsInstance(load_user(str(user.id)), User)
+            session_user = load_user(str(user.id))
+            self.assertIsInstance(session_user, SessionUser)
+            self.assertTrue(session_user.is_active())
+            self.assertEqual(session_user.first_name, 'Test')
+            self.assertEqual(session_user.email, 'test@example.com')
+
+            # Editing the profile invalidates the snapshot, other changes don't
+            User.query.filter_by(id=user.id).update({'biography': 'Nieuw'})
+            db.session.commit()
+            self.assertEqual(user.session_version, 1)
+            self.assertEqual(load_user(str(user.id)).biography, 'Nieuw')
+            user.hidden = True
+            db.session.commit()
+            self.assertEqual(user.session_version, 1)
+            self.assertIsInstance(load_user(str(user.id)), SessionUser)
+
+        # The user is detached once the request context is removed
+        user_id = str(User.query.filter_by(email='test@example.com').one().id)
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session['user_id'] = user_id
+                session['_fresh'] = True
+            self.assertEqual(client.get('/').status_code, 200)
+            with client.session_transaction() as session:
+                self.assertEqual(session['user']['biography'], 'Nieuw')
+
+            # Logging out removes the snapshot
+            client.get('/logout')
+            with client.session_transaction() as session:
+                self.assertNotIn('user', session)
+                session['user_id'] = user_id
+                session['_fresh'] = True
+            self.assertEqual(client.get('/').status_code, 200)
+
+            # A deactivated user is logged out on the next request
+            User.query.filter_by(id=user_id).update({'active': False})
+            db.session.commit()
+            self.assertEqual(client.get('/').status_code, 302)
+            with client.session_transaction() as session:
+                self.assertNotIn('user_id', session)
+
+    def test_profiling(self):
+        db.session.add_all([User(email='%s@example.com' % x) for x in range(5)])
+        db.session.commit()
+        db.session.expire_all()
+
+        # Loading the users one by one repeats the same statement, the length
+        # of an IN list doesn't matter
+        profile = profiling.Profile()
+        with app.test_request_context():
+            g.profile = profile
+            for user_id in range(1, 6):
+                User.query.get(user_id)
+            User.query.filter(User.id.in_([1, 2])).all()
+            User.query.filter(User.id.in_([1, 2, 3])).all()
+        self.assertEqual(profile.to_dict()['queries'], 7)
+        repeated = profile.get_repeated_statements(threshold=3)
+        self.assertEqual(len(repeated), 1)
+        self.assertEqual(repeated[0][1], 5)
+        self.assertEqual(len(profile.get_repeated_statements(threshold=1)), 2)
+
+        app.config['PROFILING'] = True
+        try:
+            with app.test_client() as client:
+                response = client.get('/')
+        finally:
+            app.config['PROFILING'] = False
+        self.assertEqual(response.status_code, 200)
+        server_timing = response.headers['Server-Timing']
+        self.assertIn('sql;dur=', server_timing)
+        self.assertIn('render;dur=', server_timing)
+        self.assertIn('total;dur=', server_timing)
@@ -1,7 +1,7 @@
 from app import app, db, cli
 from app.models import (
     User, Project, Subproject, DebitCard, Funder, Payment, UserStory, IBAN,
-    File, Category
+    File, Category, CategorizationRule
 )
 
 
@@ -18,5 +18,6 @@ def make_shell_context():
         'IBAN': IBAN,
         'UserStory': UserStory,
         'File': File,
-        'Category': Category
+        'Category': Category,
+        'CategorizationRule': CategorizationRule
     }